@@ -0,0 +1,438 @@
+import json
+import os
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+import scipy.sparse as sparse
+
+
+# Name of the shard written by applying an Annotator to a split of the candidates
+SHARD_NAME = 'split_%s'
+
+# Number of annotations a CSRShardWriter keeps in memory, before writing them out as a part; also the
+# number of annotations it merges at a time when writing the shard
+PART_SIZE = 2**20
+
+# Arrays of a shard, or of a part of one, each as a <name>.npy file
+SHARD_ARRAYS = ['cids', 'indptr', 'indices', 'data']
+
+
+class CSRAnnotationStore(object):
+    """
+    Stores annotations on disk as CSR matrices, rather than as one Annotation row per (candidate, key)
+    in the database, e.g. for feature matrices too large for the Feature table.
+
+    Each key group is a directory with a keys.json file, the list of the names of the keys of the
+    columns, and one shard per split of annotated candidates, itself a directory of .npy files: the
+    (sorted) candidate id of each row, and the indptr, indices and data arrays of the CSR matrix:
+
+        <path>/<key_group>/keys.json
+        <path>/<key_group>/<shard>/{cids,indptr,indices,data}.npy
+
+    The shards are opened memory-mapped, so loading the matrix of a split neither reads nor copies its
+    annotations. The values are stored with the given dtype.
+    """
+    def __init__(self, path, dtype=np.float32):
+        self.path    = path
+        self.dtype   = dtype
+        self.writers = {}
+
+    def group_path(self, key_group=0):
+        return os.path.join(self.path, str(key_group or 0))
+
+    def shard_path(self, shard, key_group=0):
+        return os.path.join(self.group_path(key_group), shard)
+
+    def shards(self, key_group=0):
+        """Returns the names of the shards of the key group"""
+        path = self.group_path(key_group)
+        if not os.path.isdir(path):
+            return []
+        return sorted(name for name in os.listdir(path)
+                      if os.path.isdir(os.path.join(path, name)) and not name.startswith('.'))
+
+    def has_shard(self, shard, key_group=0):
+        return os.path.isdir(self.shard_path(shard, key_group))
+
+    def keys(self, key_group=0):
+        """Returns the names of the keys of the key group, in column order"""
+        path = os.path.join(self.group_path(key_group), 'keys.json')
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            keys = json.load(f)
+        return HashedKeys(**keys) if isinstance(keys, dict) else keys
+
+    def save_keys(self, key_names, key_group=0):
+        path = self.group_path(key_group)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, 'keys.json.tmp'), 'w') as f:
+            json.dump(key_names.to_json() if isinstance(key_names, HashedKeys) else list(key_names), f)
+        os.rename(os.path.join(path, 'keys.json.tmp'), os.path.join(path, 'keys.json'))
+
+    def clear(self, key_group=0, shard=None):
+        """
+        Deletes a shard, or if shard is None, all the shards and the keys of the key group, and discards
+        their writers
+        """
+        self.discard(shard, key_group)
+        path = self.group_path(key_group) if shard is None else self.shard_path(shard, key_group)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+    def open_shard(self, shard, key_group=0, n_keys=None):
+        """
+        Returns the candidate ids of the rows of a shard and its CSR matrix, memory-mapped copy-on-write
+        (so the matrix can be modified in place, without changing the shard); the matrix has a column
+        for each of the n_keys (by default, all) keys of the key group.
+        """
+        cids, indptr, indices, data = load_arrays(self.shard_path(shard, key_group), mmap_mode='c')
+        n_keys = len(self.keys(key_group)) if n_keys is None else n_keys
+        return cids, sparse.csr_matrix((data, indices, indptr), shape=(len(cids), n_keys), copy=False)
+
+    def writer(self, shard, key_group=0, add_keys=True, merge=False):
+        """
+        Returns the CSRShardWriter of a shard, opening it if it is not already open; annotations with
+        unseen keys are skipped unless add_keys is True. If merge is True, the existing annotations of
+        the shard are kept, unless overwritten.
+        """
+        if (key_group, shard) not in self.writers:
+            self.writers[(key_group, shard)] = CSRShardWriter(self, shard, key_group, add_keys, merge)
+        return self.writers[(key_group, shard)]
+
+    def close(self, shard, key_group=0, cids=None):
+        """Writes out the shard opened by writer, if any; see CSRShardWriter.close"""
+        writer = self.writers.pop((key_group, shard), None)
+        if writer is not None:
+            writer.close(cids)
+
+    def discard(self, shard=None, key_group=0):
+        """
+        Discards the writer of a shard, or if shard is None, of all the shards of the key group, along
+        with the annotations appended to it; the shard itself is left as it was
+        """
+        for writer_key in list(self.writers):
+            if writer_key[0] == key_group and shard in (None, writer_key[1]):
+                self.writers.pop(writer_key).discard()
+
+    def load_matrix(self, matrix_class, annotation_key_class, split=0, cids=None, key_group=0,
+        key_names=None, zero_one=False, load_as_array=False):
+        """
+        Returns the annotations of a split as a matrix_class matrix, as load_matrix does; if cids is
+        None, this is the shard of the split, opened without copying. Otherwise, the rows of the given
+        candidate ids are gathered from all the shards.
+
+        The keys of the matrix are indexed by name, and returned by get_key as transient AnnotationKeys.
+        """
+        keys = self.keys(key_group)
+        if cids is None:
+            row_cids, X = self.open_shard(SHARD_NAME % split, key_group, len(keys))
+        else:
+            row_cids = np.unique(np.asarray(cids, dtype=np.int64))
+            X        = self._gather(row_cids, key_group, len(keys))
+
+        # Selecting keys or mapping the values to {0,1} copies the matrix
+        if key_names is not None:
+            key_names = frozenset(key_names)
+            cols      = [j for j, key_name in enumerate(keys) if key_name in key_names]
+            X         = X[:, cols]
+            keys      = [keys[j] for j in cols]
+        if zero_one:
+            X = sparse.csr_matrix(((X.data == 1).astype(X.dtype), X.indices, X.indptr), shape=X.shape)
+            X.eliminate_zeros()
+
+        # Note: the names are unicode, which on Python 2 np.array(keys, dtype=str) would encode
+        col_index = keys.array() if isinstance(keys, HashedKeys) else np.array(keys, dtype='U')
+        Xr = matrix_class((X.data, X.indices, X.indptr), shape=X.shape, copy=False, row_index=row_cids,
+                          annotation_key_cls=annotation_key_class, col_index=col_index)
+        return np.squeeze(Xr.toarray()) if load_as_array else Xr
+
+    def _gather(self, cids, key_group, n_keys):
+        """Returns the rows of the (sorted, distinct) candidate ids from all shards, as a CSR matrix"""
+        blocks, positions = [], []
+        found = np.zeros(len(cids), dtype=bool)
+        for shard in self.shards(key_group):
+            shard_cids, X = self.open_shard(shard, key_group, n_keys)
+            if len(shard_cids) == 0:
+                continue
+            rows  = np.minimum(np.searchsorted(shard_cids, cids), len(shard_cids) - 1)
+            match = (shard_cids[rows] == cids) & ~found
+            if match.any():
+                blocks.append(X[rows[match]])
+                positions.append(np.nonzero(match)[0])
+                found |= match
+
+        # Candidates without annotations get empty rows
+        missing = np.nonzero(~found)[0]
+        blocks.append(sparse.csr_matrix((len(missing), n_keys), dtype=self.dtype))
+        positions.append(missing)
+        X = sparse.vstack(blocks, format='csr')
+        return X[np.argsort(np.concatenate(positions), kind='mergesort')]
+
+
+class CSRShardWriter(object):
+    """
+    Writes annotations, appended as (candidate ids, key names, values) columns, to one shard of a
+    CSRAnnotationStore, replacing any previous version when closed.
+
+    At most PART_SIZE annotations are kept in memory: when they fill up, they are written out as a
+    part, i.e. a CSR matrix in the same format as a shard, in a temporary directory of the key group.
+    close then merges the parts into the shard, PART_SIZE annotations at a time.
+    """
+    def __init__(self, store, shard, key_group=0, add_keys=True, merge=False):
+        self.store      = store
+        self.shard      = shard
+        self.key_group  = key_group
+        self.add_keys   = add_keys
+        self.merge      = merge
+        self.keys       = store.keys(key_group)
+        self.key_index  = dict((key_name, j) for j, key_name in enumerate(self.keys))\
+                          if not isinstance(self.keys, HashedKeys) else None
+        self.columns    = ([], [], [])
+        self.n_buffered = 0
+        self.parts      = []
+        self.parts_path = None
+
+    def append(self, cids, key_names, values):
+        if isinstance(self.keys, HashedKeys):
+            return self.append_hashed(cids, key_names, values)
+        cols = np.empty(len(key_names), dtype=np.int64)
+        for i, key_name in enumerate(key_names):
+            j = self.key_index.get(key_name)
+            if j is None and self.add_keys:
+                j = self.key_index[key_name] = len(self.keys)
+                self.keys.append(key_name)
+            cols[i] = -1 if j is None else j
+        keep = cols >= 0
+        self._buffer(np.asarray(cids, dtype=np.int64)[keep], cols[keep],
+                     np.asarray(values, dtype=self.store.dtype)[keep])
+
+    def append_hashed(self, cids, key_names, values):
+        """
+        Appends annotations to a hashed key group, see HashedKeys; the annotations of a candidate with
+        keys hashed to the same column are summed, so all of them must be appended at once.
+        """
+        cols, signs = self.keys.columns(key_names)
+        self.keys.sample(cols, key_names)
+        cids   = np.asarray(cids, dtype=np.int64)
+        values = np.asarray(values, dtype=self.store.dtype) * signs
+        if len(cids) > 0:
+            order  = np.lexsort((cols, cids))
+            cids, cols, values = cids[order], cols[order], values[order]
+            first  = np.ones(len(cids), dtype=bool)
+            first[1:] = (cids[1:] != cids[:-1]) | (cols[1:] != cols[:-1])
+            starts = np.nonzero(first)[0]
+            cids, cols, values = cids[starts], cols[starts], np.add.reduceat(values, starts)
+        self._buffer(cids, cols, values)
+
+    def _buffer(self, cids, cols, values):
+        for column, values in zip(self.columns, [cids, cols, values]):
+            column.append(values)
+        self.n_buffered += len(cids)
+        if self.n_buffered >= PART_SIZE:
+            self.write_part()
+
+    def _pop_buffer(self):
+        """Returns the buffered annotations as a CSR matrix (see to_csr_arrays), and empties the buffer"""
+        columns = [np.concatenate(column) if len(column) > 0 else np.zeros(0, dtype=dtype)
+                   for column, dtype in zip(self.columns, [np.int64, np.int64, self.store.dtype])]
+        self.columns    = ([], [], [])
+        self.n_buffered = 0
+        return to_csr_arrays(*columns)
+
+    def write_part(self):
+        """Writes the buffered annotations out as a part, and empties the buffer"""
+        if self.parts_path is None:
+            group_path = self.store.group_path(self.key_group)
+            if not os.path.isdir(group_path):
+                os.makedirs(group_path)
+            self.parts_path = tempfile.mkdtemp(prefix='.%s-parts' % self.shard, dir=group_path)
+        path = os.path.join(self.parts_path, str(len(self.parts)))
+        os.mkdir(path)
+        for name, array in zip(SHARD_ARRAYS, self._pop_buffer()):
+            np.save(os.path.join(path, name + '.npy'), array)
+        self.parts.append(path)
+
+    def discard(self):
+        """Deletes the parts written so far, and empties the buffer"""
+        if self.parts_path is not None:
+            shutil.rmtree(self.parts_path)
+        self.columns    = ([], [], [])
+        self.n_buffered = 0
+        self.parts      = []
+        self.parts_path = None
+
+    def close(self, cids=None):
+        """
+        Writes the shard. The rows are the candidates with annotations and the given candidate ids,
+        e.g. all the candidates of the split, so that candidates without annotations get empty rows.
+        """
+        # The parts, memory-mapped, and the buffer; when merging, the existing shard comes first, so that
+        # the new annotations overwrite its values
+        parts = []
+        if self.merge and self.store.has_shard(self.shard, self.key_group):
+            parts.append(load_arrays(self.store.shard_path(self.shard, self.key_group)))
+        parts.extend(load_arrays(path) for path in self.parts)
+        parts.append(self._pop_buffer())
+        extra    = [] if cids is None else [np.asarray(cids, dtype=np.int64)]
+        row_cids = np.unique(np.concatenate([part[0] for part in parts] + extra))
+
+        # The number of annotations in the parts up to each row bounds the number in the shard; the rows
+        # are merged in ranges of about PART_SIZE of them
+        ends = np.zeros(len(row_cids), dtype=np.int64)
+        for part_cids, part_indptr, _, _ in parts:
+            ends += part_indptr[np.searchsorted(part_cids, row_cids, side='right')]
+        n_max  = int(ends[-1]) if len(ends) > 0 else 0
+        bounds = np.searchsorted(ends, np.arange(PART_SIZE, n_max, PART_SIZE), side='right')
+        bounds = np.unique(np.concatenate([[0], bounds, [len(row_cids)]]))
+
+        # 32-bit indices, if they fit, are used by scipy without copying
+        idx_type = np.int32 if max(n_max, len(self.keys)) < 2**31 else np.int64
+        indptr   = np.zeros(len(row_cids) + 1, dtype=idx_type)
+
+        # Write the shard to a temporary directory, then move it in place of any previous version; the
+        # indices and values of each range of rows are appended to raw files as they are merged
+        group_path = self.store.group_path(self.key_group)
+        if not os.path.isdir(group_path):
+            os.makedirs(group_path)
+        tmp_path = tempfile.mkdtemp(prefix='.' + self.shard, dir=group_path)
+        n        = 0
+        with open(os.path.join(tmp_path, 'indices.raw'), 'wb') as indices_file, \
+             open(os.path.join(tmp_path, 'data.raw'), 'wb') as data_file:
+            for r0, r1 in zip(bounds[:-1], bounds[1:]):
+                a_cids, cols, values = merge_rows(parts, row_cids[r0], row_cids[r1 - 1])
+                counts = np.bincount(np.searchsorted(row_cids, a_cids) - r0, minlength=r1 - r0)
+                indptr[r0 + 1:r1 + 1] = n + np.cumsum(counts)
+                n += len(values)
+                cols.astype(idx_type).tofile(indices_file)
+                values.astype(self.store.dtype).tofile(data_file)
+        del parts
+        np.save(os.path.join(tmp_path, 'cids.npy'), row_cids)
+        np.save(os.path.join(tmp_path, 'indptr.npy'), indptr)
+        for name, dtype in [('indices', idx_type), ('data', self.store.dtype)]:
+            raw_to_npy(os.path.join(tmp_path, name), dtype, n)
+        self.store.clear(self.key_group, self.shard)
+        os.rename(tmp_path, self.store.shard_path(self.shard, self.key_group))
+        self.store.save_keys(self.keys, self.key_group)
+        self.discard()
+
+
+def load_arrays(path, mmap_mode='r'):
+    """Returns the (candidate ids, indptr, indices, data) arrays of a shard or part, memory-mapped"""
+    return [np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in SHARD_ARRAYS]
+
+
+def to_csr_arrays(cids, cols, values):
+    """
+    Returns annotations as the (candidate ids, indptr, indices, data) arrays of a CSR matrix, with a
+    row per distinct candidate id; the annotations are sorted by candidate and key, keeping the last
+    value of each (candidate, key)
+    """
+    cids, cols, values = dedupe(cids, cols, values)
+    row_cids, counts   = np.unique(cids, return_counts=True)
+    indptr             = np.zeros(len(row_cids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return row_cids, indptr, cols, values
+
+
+def dedupe(cids, cols, values):
+    """Sorts annotations by candidate and key, keeping the last value of each (candidate, key)"""
+    order  = np.lexsort((cols, cids))
+    cids, cols, values = cids[order], cols[order], values[order]
+    last   = np.ones(len(cids), dtype=bool)
+    last[:-1] = (cids[1:] != cids[:-1]) | (cols[1:] != cols[:-1])
+    return cids[last], cols[last], values[last]
+
+
+def merge_rows(parts, first_cid, last_cid):
+    """
+    Returns the annotations of the candidates with ids between first_cid and last_cid (inclusive) in
+    a list of CSR parts, as (candidate ids, key columns, values) arrays sorted by candidate and key;
+    the value in the last part is kept for each (candidate, key), and zero values are dropped
+    """
+    columns = ([], [], [])
+    for part_cids, indptr, indices, data in parts:
+        a, b   = np.searchsorted(part_cids, first_cid), np.searchsorted(part_cids, last_cid, side='right')
+        ranges = np.asarray(indptr[a:b + 1], dtype=np.int64)
+        if len(ranges) < 2:
+            continue
+        for column, values in zip(columns, [np.repeat(np.asarray(part_cids[a:b]), np.diff(ranges)),
+                                            np.asarray(indices[ranges[0]:ranges[-1]], dtype=np.int64),
+                                            np.asarray(data[ranges[0]:ranges[-1]])]):
+            column.append(values)
+    if len(columns[0]) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    cids, cols, values = dedupe(*[np.concatenate(column) for column in columns])
+    keep = values != 0
+    return cids[keep], cols[keep], values[keep]
+
+
+def raw_to_npy(path, dtype, n):
+    """Converts the raw array of n dtype values in <path>.raw to <path>.npy, PART_SIZE values at a time"""
+    array = np.lib.format.open_memmap(path + '.npy', mode='w+', dtype=dtype, shape=(n,))
+    if n > 0:
+        raw = np.memmap(path + '.raw', dtype=dtype, mode='r', shape=(n,))
+        for i in range(0, n, PART_SIZE):
+            array[i:i + PART_SIZE] = raw[i:i + PART_SIZE]
+        del raw
+    array.flush()
+    del array
+    os.remove(path + '.raw')
+
+
+class HashedKeys(object):
+    """
+    The keys of a hashed key group: rather than one column per distinct key name, each key name is
+    hashed (by CRC32) to one of 2**hash_bits columns, so that the number of columns, and the memory
+    used to map key names to them, stay fixed however many distinct keys there are. If signed is True,
+    another bit of the hash gives the sign of the values, so that collisions tend to cancel out.
+
+    The columns are named hash_<column>. For debugging, up to sample_size of the key names hashed to
+    each column are kept, as a dict from column to key names, in names.
+    """
+    def __init__(self, hash_bits, signed=False, sample_size=0, names=None):
+        if not 0 < hash_bits < 32:
+            raise ValueError("hash_bits must be between 1 and 31.")
+        self.hash_bits   = hash_bits
+        self.signed      = signed
+        self.sample_size = sample_size
+        self.names       = dict((int(j), list(key_names)) for j, key_names in (names or {}).items())
+
+    def __len__(self):
+        return 2 ** self.hash_bits
+
+    def __getitem__(self, j):
+        if not -len(self) <= j < len(self):
+            raise IndexError(j)
+        return 'hash_%s' % (j % len(self))
+
+    def __iter__(self):
+        return ('hash_%s' % j for j in range(len(self)))
+
+    def array(self):
+        """Returns the names of the columns, as an array"""
+        return np.char.add('hash_', np.arange(len(self)).astype(str))
+
+    def columns(self, key_names):
+        """Returns the columns of the key names, and the signs of their values, as arrays"""
+        hashes = np.array([zlib.crc32(key_name.encode('utf-8')) & 0xffffffff for key_name in key_names],
+                          dtype=np.int64)
+        cols   = hashes & (len(self) - 1)
+        signs  = 1 - 2 * ((hashes >> 31) & 1) if self.signed else np.ones(len(hashes), dtype=np.int64)
+        return cols, signs
+
+    def sample(self, cols, key_names):
+        """Adds key names to the sampled names of their columns, up to sample_size per column"""
+        if self.sample_size <= 0:
+            return
+        for j, key_name in zip(cols.tolist(), key_names):
+            sampled = self.names.setdefault(j, [])
+            if len(sampled) < self.sample_size and key_name not in sampled:
+                sampled.append(key_name)
+
+    def to_json(self):
+        return {'hash_bits': self.hash_bits, 'signed': self.signed, 'sample_size': self.sample_size,
+                'names': dict((str(j), key_names) for j, key_names in self.names.items())}
@@ -1,45 +1,167 @@
+from collections import defaultdict
+from functools import partial
+import hashlib
+import json
+import numbers
 import numpy as np
-from pandas import DataFrame, Series
+import os
+import re
+import shutil
+import tempfile
+from pandas import DataFrame, Index, Series
+from pandas.util import hash_pandas_object
 import scipy.sparse as sparse
+from sqlalchemy import BigInteger, Float, cast, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import selectinload, with_polymorphic
+from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import bindparam, select
+from types import BuiltinFunctionType, ModuleType
 
+from .annotation_store import SHARD_NAME, HashedKeys
 from .features import get_span_feats
 from .models import (
     GoldLabel, GoldLabelKey, Label, LabelKey, Feature, FeatureKey, Candidate,
-    Marginal
+    Marginal, Context, Sentence, Span
 )
-from .models.meta import new_sessionmaker
+from .models.annotation import AnnotationKeyMixin
+from .models.meta import begin_transaction, insert_columns, load_columns, new_sessionmaker, snorkel_postgres, stream_ids
 from .udf import UDF, UDFRunner
 from .utils import (
-    matrix_conflicts,
-    matrix_coverage,
-    matrix_overlaps,
-    matrix_tp,
-    matrix_fp,
-    matrix_fn,
-    matrix_tn
+    ProgressBar,
+    chunks,
+    matrix_lf_stats
 )
-from future.utils import iteritems
+from future.utils import iteritems, string_types
+
+
+# Number of Annotations buffered by AnnotatorUDF.reduce before they are written to the database
+REDUCE_FLUSH_SIZE = 50000
+
+# Maximum number of values in an IN clause (SQLite's default limit on host parameters is 999)
+IN_CLAUSE_SIZE = 500
+
+# Number of rows per multi-row INSERT statement on Postgres
+INSERT_CHUNK_SIZE = 5000
+
+# Default number of candidates loaded and annotated together by AnnotatorUDF.apply_batch
+CANDIDATE_BATCH_SIZE = 100
+
+# Contexts, loaded along with the columns of the Spans among them
+ContextSpan = with_polymorphic(Context, [Span])
+
+# Parameters of the hash of (candidate id, key id) pairs used by annotation_watermark, both prime
+WATERMARK_HASH_MULTIPLIER = 1000003
+WATERMARK_HASH_MODULUS    = 999983
+
+# Arrays of a csr_AnnotationMatrix saved by csr_AnnotationMatrix.save, each as a <name>.npy file
+MATRIX_ARRAYS = ['data', 'indices', 'indptr', 'row_index', 'col_index']
+
+
+class ReverseIndex(object):
+    """
+    Maps the ids in an array back to their positions, like a dict, by binary search over a sorted copy
+    of the array, which is only built on first use
+    """
+    def __init__(self, ids):
+        self.ids    = ids
+        self.order  = None
+        self.sorted = None
+
+    def positions(self, ids):
+        """Returns the positions of an array of ids, with -1 for the ids not in the index"""
+        if self.order is None:
+            self.order  = np.argsort(self.ids, kind='mergesort')
+            self.sorted = self.ids[self.order]
+        ids = np.asarray(ids)
+        if len(self.sorted) == 0:
+            return np.full(ids.shape, -1, dtype=np.int64)
+        i = np.minimum(np.searchsorted(self.sorted, ids), len(self.sorted) - 1)
+        return np.where(self.sorted[i] == ids, self.order[i], -1)
+
+    def __getitem__(self, id):
+        position = int(self.positions(id))
+        if position < 0:
+            raise KeyError(id)
+        return position
+
+    def get(self, id, default=None):
+        position = int(self.positions(id))
+        return position if position >= 0 else default
+
+    def __contains__(self, id):
+        return int(self.positions(id)) >= 0
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def as_index_array(index):
+    """Returns a row / column index as an array, converting it if given as a dict from position to id"""
+    if isinstance(index, dict):
+        return np.array([index[i] for i in range(len(index))])
+    return None if index is None else np.asarray(index)
+
 
 class csr_AnnotationMatrix(sparse.csr_matrix):
     """
     An extension of the scipy.sparse.csr_matrix class for holding sparse annotation matrices
     and related helper methods.
+
+    The candidate id of each row and the key id (or name) of each column are held as arrays, row_index
+    and col_index, which are carried along when the matrix is indexed by slices, index arrays or
+    boolean masks; candidate_index and key_index, the reverse mappings, are ReverseIndexes built on
+    first use.
     """
     def __init__(self, arg1, **kwargs):
         # Note: Currently these need to return None if unset, otherwise matrix copy operations break...
-        self.candidate_index    = kwargs.pop('candidate_index', None)
+        # The reverse mappings are derived from the indexes, so they are not needed if given as well
+        candidate_index         = kwargs.pop('candidate_index', None)
+        key_index               = kwargs.pop('key_index', None)
         self.row_index          = kwargs.pop('row_index', None)
         self.annotation_key_cls = kwargs.pop('annotation_key_cls', None)
-        self.key_index          = kwargs.pop('key_index', None)
         self.col_index          = kwargs.pop('col_index', None)
+        if self.row_index is None and isinstance(candidate_index, dict):
+            self.row_index = dict((i, cid) for cid, i in iteritems(candidate_index))
+        if self.col_index is None and isinstance(key_index, dict):
+            self.col_index = dict((j, kid) for kid, j in iteritems(key_index))
 
         # Note that scipy relies on the first three letters of the class to define matrix type...
         super(csr_AnnotationMatrix, self).__init__(arg1, **kwargs)
 
+    @property
+    def row_index(self):
+        return self._row_index
+
+    @row_index.setter
+    def row_index(self, index):
+        self._row_index       = as_index_array(index)
+        self._candidate_index = None
+
+    @property
+    def col_index(self):
+        return self._col_index
+
+    @col_index.setter
+    def col_index(self, index):
+        self._col_index = as_index_array(index)
+        self._key_index = None
+
+    @property
+    def candidate_index(self):
+        if self._candidate_index is None and self._row_index is not None:
+            self._candidate_index = ReverseIndex(self._row_index)
+        return self._candidate_index
+
+    @property
+    def key_index(self):
+        if self._key_index is None and self._col_index is not None:
+            self._key_index = ReverseIndex(self._col_index)
+        return self._key_index
+
     def get_candidate(self, session, i):
         """Return the Candidate object corresponding to row i"""
-        return session.query(Candidate).filter(Candidate.id == self.row_index[i]).one()
+        return session.query(Candidate).filter(Candidate.id == int(self.row_index[i])).one()
 
     def get_row_index(self, candidate):
         """Return the row index of the Candidate"""
@@ -47,81 +169,145 @@ class csr_AnnotationMatrix(sparse.csr_matrix):
 
     def get_key(self, session, j):
         """Return the AnnotationKey object corresponding to column j"""
+        # Note: Matrices loaded from a CSRAnnotationStore index their keys by name, not by id
+        key = self.col_index[j]
+        if isinstance(key, string_types):
+            return self.annotation_key_cls(name=key)
         return session.query(self.annotation_key_cls)\
-                .filter(self.annotation_key_cls.id == self.col_index[j]).one()
+                .filter(self.annotation_key_cls.id == int(key)).one()
+
+    def get_key_names(self, session):
+        """Return the names of the AnnotationKeys of all columns, loaded with one query per IN_CLAUSE_SIZE keys"""
+        keys = self.col_index.tolist()
+        if all(isinstance(key, string_types) for key in keys):
+            return keys
+        names = {}
+        for ids_chunk in chunks(keys, IN_CLAUSE_SIZE):
+            names.update(session.query(self.annotation_key_cls.id, self.annotation_key_cls.name)
+                                .filter(self.annotation_key_cls.id.in_(ids_chunk)))
+        return [names[key] for key in keys]
 
     def get_col_index(self, key):
         """Return the cow index of the AnnotationKey"""
-        return self.key_index[key.id]
+        return self.key_index[key.id if key.id is not None else key.name]
+
+    def __getitem__(self, key):
+        X = super(csr_AnnotationMatrix, self).__getitem__(key)
+        if not sparse.issparse(X):
+            return X
+        if not isinstance(X, csr_AnnotationMatrix):
+            X = self.__class__(X)
+        X.annotation_key_cls = self.annotation_key_cls
 
-    def _get_sliced_indexes(self, s, axis, index, inv_index):
+        # Remap the row and column indexes, by indexing them in the same way
+        row_key, col_key = key if isinstance(key, tuple) and len(key) == 2 else (key, slice(None))
+        X.row_index = self._get_sliced_index(self.row_index, row_key, X.shape[0])
+        X.col_index = self._get_sliced_index(self.col_index, col_key, X.shape[1])
+        return X
+
+    @staticmethod
+    def _get_sliced_index(index, key, n):
         """
-        Remaps the indexes between matrix rows/cols and candidates/keys.
-        Note: This becomes a massive performance bottleneck if not implemented
-        properly, so be careful of changing!
+        Returns the part of a row / column index selected by the key of one axis: a slice (as a view),
+        an int, an index array or a boolean mask; or None for other keys, e.g. sparse masks
         """
-        if isinstance(s, slice):
-            # Check for empty slice
-            if s.start is None and s.stop is None:
-                return index, inv_index
-            else:
-                idxs = np.arange(self.shape[axis])[s]
-        # csr_matrix._get_submatrix only handles slice or int, so this is int
+        if index is None or sparse.issparse(key):
+            return None
+        if isinstance(key, slice):
+            sliced = index[key]
         else:
-            idxs = np.array([s])
-        index_new, inv_index_new = {}, {}
-        for i_new, i in enumerate(idxs):
-            k = index[i]
-            index_new[i_new] = k
-            inv_index_new[k] = i_new
-        return index_new, inv_index_new
-
-    def _get_submatrix(self, row_slice, col_slice):
-        # Get the slice of the matrix
-        X = super(csr_AnnotationMatrix, self)._get_submatrix(row_slice,
-            col_slice)
-        X.annotation_key_cls = self.annotation_key_cls
+            key    = np.asarray(key)
+            sliced = index[np.ravel(key)] if key.ndim <= 1 or min(key.shape) == 1 else None
+        return sliced if sliced is not None and len(sliced) == n else None
 
-        # # Remap the row and column indexes
-        X.row_index, X.candidate_index = self._get_sliced_indexes(
-            row_slice, 0, self.row_index, self.candidate_index)
-        X.col_index, X.key_index = self._get_sliced_indexes(
-            col_slice, 1, self.col_index, self.key_index)
-        return X
+    def save(self, path, watermark=None):
+        """
+        Saves the matrix to a directory, replacing any previous version: its CSR arrays and row / column
+        indexes as .npy files, and a meta.json file with the names of its class and AnnotationKey
+        class, and the watermark (see annotation_watermark) of the annotations it was loaded from.
+        """
+        parent = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp_path = tempfile.mkdtemp(prefix='.' + os.path.basename(path), dir=parent)
+        for name in MATRIX_ARRAYS:
+            array = getattr(self, name)
+            if array is not None:
+                np.save(os.path.join(tmp_path, name + '.npy'), array)
+        meta = {
+            'matrix_class'       : self.__class__.__name__,
+            'annotation_key_cls' : getattr(self.annotation_key_cls, '__name__', None),
+            'shape'              : list(self.shape),
+            'watermark'          : watermark
+        }
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, mmap=True, watermark=None):
+        """
+        Loads a matrix saved by save, with its arrays memory-mapped unless mmap is False. If a watermark
+        is given, returns None if the matrix was saved with another one, i.e. if its annotations have
+        changed since (see annotation_watermark).
+
+        The arrays are mapped copy-on-write, so the matrix can be modified in place (e.g. by
+        GenerativeModel.train) without changing the saved one.
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if watermark is not None and json.loads(json.dumps(watermark)) != meta['watermark']:
+            return None
+        arrays = {}
+        for name in MATRIX_ARRAYS:
+            array_path = os.path.join(path, name + '.npy')
+            if os.path.exists(array_path):
+                arrays[name] = np.load(array_path, mmap_mode='c' if mmap else None)
+        matrix_class = find_subclass(cls, meta['matrix_class']) or cls
+        return matrix_class((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(meta['shape']),
+                            copy=False, row_index=arrays.get('row_index'), col_index=arrays.get('col_index'),
+                            annotation_key_cls=find_subclass(AnnotationKeyMixin, meta['annotation_key_cls']))
 
     def stats(self):
         """Return summary stats about the annotations"""
         raise NotImplementedError()
 
 
+def find_subclass(cls, name):
+    """Returns the subclass of cls (or cls itself) with the given name, or None"""
+    classes = [cls]
+    while len(classes) > 0:
+        c = classes.pop()
+        if c.__name__ == name:
+            return c
+        classes.extend(c.__subclasses__())
+    return None
+
+
 try:
     class csr_LabelMatrix(csr_AnnotationMatrix):
 
         def lf_stats(self, session, labels=None, est_accs=None):
-            """Returns a pandas DataFrame with the LFs and various per-LF statistics"""
-            lf_names = [self.get_key(session, j).name for j in range(self.shape[1])]
+            """
+            Returns a pandas DataFrame with the LFs and various per-LF statistics; given gold labels,
+            the TP, FP, FN and TN counts for binary labels, or the Correct and Incorrect counts for
+            categorical ones, and the empirical accuracy
+            """
+            lf_names = self.get_key_names(session)
+            ls = None
+            if labels is not None:
+                ls = np.ravel(labels.todense() if sparse.issparse(labels) else labels)
+            stats = matrix_lf_stats(self, ls)
 
             # Default LF stats
             col_names = ['j', 'Coverage', 'Overlaps', 'Conflicts']
-            d = {
-                'j'         : range(self.shape[1]),
-                'Coverage'  : Series(data=matrix_coverage(self), index=lf_names),
-                'Overlaps'  : Series(data=matrix_overlaps(self), index=lf_names),
-                'Conflicts' : Series(data=matrix_conflicts(self), index=lf_names)
-            }
             if labels is not None:
-                col_names.extend(['TP', 'FP', 'FN', 'TN', 'Empirical Acc.'])
-                ls = np.ravel(labels.todense() if sparse.issparse(labels) else labels)
-                tp = matrix_tp(self, ls)
-                fp = matrix_fp(self, ls)
-                fn = matrix_fn(self, ls)
-                tn = matrix_tn(self, ls)
-                ac = (tp+tn).astype(float) / (tp+tn+fp+fn)
-                d['Empirical Acc.'] = Series(data=ac, index=lf_names)
-                d['TP']             = Series(data=tp, index=lf_names)
-                d['FP']             = Series(data=fp, index=lf_names)
-                d['FN']             = Series(data=fn, index=lf_names)
-                d['TN']             = Series(data=tn, index=lf_names)
+                col_names.extend(['TP', 'FP', 'FN', 'TN'] if 'TP' in stats else ['Correct', 'Incorrect'])
+                col_names.append('Empirical Acc.')
+            d = dict((name, Series(data=stats[name], index=lf_names)) for name in col_names[1:])
+            d['j'] = range(self.shape[1])
 
             if est_accs is not None:
                 col_names.append('Learned Acc.')
@@ -137,14 +323,24 @@ except:
 
 
 class Annotator(UDFRunner):
-    """Abstract class for annotating candidates and persisting these annotations to DB"""
-    def __init__(self, annotation_class, annotation_key_class, f_gen):
+    """
+    Abstract class for annotating candidates and persisting these annotations to DB, or to a
+    CSRAnnotationStore if store is given
+    """
+    def __init__(self, annotation_class, annotation_key_class, f_gen, store=None):
         self.annotation_class     = annotation_class
         self.annotation_key_class = annotation_key_class
-        super(Annotator, self).__init__(AnnotatorUDF,
-                                        annotation_class=annotation_class,
-                                        annotation_key_class=annotation_key_class,
-                                        f_gen=f_gen)
+        self.store                = store
+        if store is None:
+            super(Annotator, self).__init__(AnnotatorUDF,
+                                            annotation_class=annotation_class,
+                                            annotation_key_class=annotation_key_class,
+                                            f_gen=f_gen)
+        else:
+            super(Annotator, self).__init__(StoreAnnotatorUDF,
+                                            annotation_class=annotation_class,
+                                            annotation_key_class=annotation_key_class,
+                                            f_gen=f_gen, store=store)
 
     def apply(self, split=0, key_group=0, replace_key_set=True, cids_query=None,
         **kwargs):
@@ -152,22 +348,37 @@ class Annotator(UDFRunner):
         if replace_key_set:
             self.reducer.key_cache = {}
 
+        # Annotations left buffered in the reducer by a run which raised are dropped
+        self.reducer.buffer = ([], [], [])
+
         # Get the cids based on the split, and also the count
         SnorkelSession = new_sessionmaker()
         session = SnorkelSession()
         cids_query = cids_query or session.query(Candidate.id)\
                                           .filter(Candidate.split == split)
 
-        # Note: In the current UDFRunner implementation, we load all these into memory and fill a
-        # multiprocessing JoinableQueue with them before starting... so might as well load them here and pass in.
-        # Also, if we try to pass in a query iterator instead, with AUTOCOMMIT on, we get a TXN error...
-        cids       = cids_query.all()
-        cids_count = len(cids)
-
-        # Run the Annotator
-        super(Annotator, self).apply(cids, split=split, key_group=key_group,
-            replace_key_set=replace_key_set, cids_query=cids_query,
-            count=cids_count, **kwargs)
+        # Note: The cids are streamed to the UDFRunner rather than loaded into memory up front, in pages
+        # which each use a dedicated connection, since iterating the query with AUTOCOMMIT on gives a TXN
+        # error; no cursor is left open between pages, as it would block the checkpoint commits on SQLite
+        cids_count = cids_query.count()
+        cids       = stream_ids(cids_query)
+
+        # Run the Annotator, on batches of candidates
+        # The shard of a CSRAnnotationStore is written at the end, with a row for each candidate; as
+        # it is not written incrementally, the run cannot be checkpointed
+        if self.store is not None and (kwargs.get('checkpoint') or kwargs.get('resume')):
+            raise ValueError("Checkpointing is not supported when writing to a CSRAnnotationStore.")
+        kwargs.setdefault('batch_size', CANDIDATE_BATCH_SIZE)
+        try:
+            super(Annotator, self).apply(cids, split=split, key_group=key_group,
+                replace_key_set=replace_key_set, cids_query=cids_query,
+                count=cids_count, **kwargs)
+            if self.store is not None:
+                self.store.close(SHARD_NAME % split, key_group, load_columns(cids_query, [np.int64])[0])
+        finally:
+            # If the run raised, the annotations it appended to the shard must not be written by the next
+            if self.store is not None:
+                self.store.discard(SHARD_NAME % split, key_group)
 
         # Load the matrix
         return self.load_matrix(session, split=split, cids_query=cids_query,
@@ -180,6 +391,9 @@ class Annotator(UDFRunner):
         If replace_key_set=True, deletes *all* Annotations (of this Annotation sub-class)
         and also deletes all AnnotationKeys (of this sub-class)
         """
+        if self.store is not None:
+            self.store.clear(key_group, None if replace_key_set else SHARD_NAME % split)
+            return
         query = session.query(self.annotation_class)
 
         # If replace_key_set=False, then we just delete the annotations for candidates in our split
@@ -196,6 +410,10 @@ class Annotator(UDFRunner):
             query = query.filter(self.annotation_key_class.group == key_group)
             query.delete(synchronize_session='fetch')
 
+    def get_job_name(self, split=0, key_group=0, **kwargs):
+        return "%s:%s:%s:%s" % (self.__class__.__name__, self.annotation_class.__name__, key_group,
+            split)
+
     def apply_existing(self, split=0, key_group=0, cids_query=None, **kwargs):
         """Alias for apply that emphasizes we are using an existing AnnotatorKey set."""
         return self.apply(split=split, key_group=key_group,
@@ -221,8 +439,15 @@ class AnnotatorUDF(UDF):
         # For caching key ids during the reduce step
         self.key_cache = {}
 
+        # Annotations buffered by reduce, as (candidate ids, key names, values) columns
+        self.buffer = ([], [], [])
+
         super(AnnotatorUDF, self).__init__(**kwargs)
 
+    @staticmethod
+    def get_input_key(cid):
+        return str(cid[0])
+
     def apply(self, cid, **kwargs):
         """
         Applies a given function to a Candidate, yielding a set of Annotations as key_name, value pairs
@@ -230,141 +455,320 @@ class AnnotatorUDF(UDF):
         Note: Accepts a candidate _id_ as argument, because of issues with putting Candidate subclasses
         into Queues (can't pickle...)
         """
+        c = self.session.query(Candidate).filter(Candidate.id == cid[0]).one()
+        return self.annotate(c)
+
+    def annotate(self, c):
+        """Yields the Annotations of a loaded Candidate as (cid, key_name, value) tuples"""
         seen = set()
-        cid = cid[0]
-        c    = self.session.query(Candidate).filter(Candidate.id == cid).one()
         for key_name, value in self.anno_generator(c):
 
             # Note: Make sure no duplicates emitted here!
-            if (cid, key_name) not in seen:
-                seen.add((cid, key_name))
-                yield cid, key_name, value
+            if key_name not in seen:
+                seen.add(key_name)
+                yield c.id, key_name, value
 
-    def reduce(self, y, clear, key_group, replace_key_set, **kwargs):
+    def apply_batch(self, cids, **kwargs):
         """
-        Inserts Annotations into the database.
+        Applies the UDF to a batch of candidate ids, returning the Annotations as a columnar chunk,
+        i.e. a tuple of (candidate ids, key names, values) lists; this is much cheaper to send
+        between processes than one (cid, key_name, value) tuple at a time.
+        The candidates of the batch are loaded together, see load_candidates.
+        """
+        chunk = ([], [], [])
+        candidates, sentences = self.load_candidates([cid[0] for cid in cids])
+        for c in candidates:
+            for y in self.annotate(c):
+                for column, v in zip(chunk, y):
+                    column.append(v)
+        return chunk
+
+    def load_candidates(self, cids):
+        """
+        Loads the Candidates with the given ids in a few queries, rather than in several per candidate
+        as their contexts are accessed: one for their types, then per Candidate subclass, one for the
+        candidates and one per argument for their contexts (including the Span columns), and finally
+        one for the Sentences of the Spans, each loaded once even if shared by several candidates.
+
+        Returns the candidates, in order, and the Sentences; the latter must stay referenced while the
+        candidates are used, so that they stay in the session's identity map (which is weak-referencing),
+        from which Span.sentence is then loaded.
+        """
+        types = defaultdict(list)
+        for cid, candidate_type in self.session.query(Candidate.id, Candidate.type)\
+                                               .filter(Candidate.id.in_(cids)):
+            types[candidate_type].append(cid)
+        by_id = {}
+        for candidate_type, type_cids in iteritems(types):
+            C = Candidate.__mapper__.polymorphic_map[candidate_type].class_
+            q = self.session.query(C).filter(C.id.in_(type_cids))
+            q = q.options(*[selectinload(getattr(C, arg).of_type(ContextSpan)) for arg in C.__argnames__])
+            for c in q:
+                by_id[c.id] = c
+        missing = [cid for cid in cids if cid not in by_id]
+        if len(missing) > 0:
+            raise NoResultFound("No Candidates with ids %s" % missing)
+        candidates = [by_id[cid] for cid in cids]
+
+        # Note: the contexts are read from __dict__, so as to not trigger lazy loads
+        sentence_ids = set(context.sentence_id for c in candidates for context in
+                           (c.__dict__.get(arg) for arg in c.__argnames__) if isinstance(context, Span))
+        sentences = []
+        for ids_chunk in chunks(list(sentence_ids), IN_CLAUSE_SIZE):
+            sentences.extend(self.session.query(Sentence).filter(Sentence.id.in_(ids_chunk)))
+        return candidates, sentences
+
+    def count_outputs(self, chunk):
+        return len(chunk[0])
+
+    def reduce_batch(self, chunk, **kwargs):
+        """Buffers a columnar chunk of Annotations, as returned by apply_batch"""
+        for column, values in zip(self.buffer, chunk):
+            column.extend(values)
+        if len(self.buffer[0]) >= REDUCE_FLUSH_SIZE:
+            self.flush(**kwargs)
+
+    def reduce(self, y, **kwargs):
+        """Buffers a single (cid, key_name, value) Annotation"""
+        for column, v in zip(self.buffer, y):
+            column.append(v)
+        if len(self.buffer[0]) >= REDUCE_FLUSH_SIZE:
+            self.flush(**kwargs)
+
+    def flush(self, clear, key_group, replace_key_set, **kwargs):
+        """
+        Inserts the buffered Annotations into the database in bulk.
         For Annotations with unseen AnnotationKeys (in key_group, if not None), either adds these
-        AnnotationKeys if create_new_keyset is True, else skips these Annotations.
+        AnnotationKeys if replace_key_set is True, else skips these Annotations.
         """
-        cid, key_name, value = y
-
-        # Prepares queries
-        # Annoation updating only needs to be done if clear=False
-        if not clear:
-            anno_update_query = self.annotation_class.__table__.update()
-            anno_update_query = anno_update_query.where(self.annotation_class.candidate_id == bindparam('cid'))
-            anno_update_query = anno_update_query.where(self.annotation_class.key_id == bindparam('kid'))
-            anno_update_query = anno_update_query.values(value=bindparam('value'))
-
-        # We only need to insert AnnotationKeys if replace_key_set=True
-        # Note that in current configuration, we never update AnnotationKeys!
-        if replace_key_set:
-            key_insert_query = self.annotation_key_class.__table__.insert()
-
-        # If we are replacing the AnnotationKeys (replace_key_set=True), then we assume they will
-        # all have been handled by *this* reduce thread, and hence be in the cache already
-        # So we only need key select queries if replace_key_set=False
+        cids, key_names, values = self.buffer
+        self.buffer = ([], [], [])
+        if len(cids) == 0:
+            return
+        self._load_key_ids(key_names, key_group, replace_key_set)
+
+        # If AnnotationKey does not exist and replace_key_set = False, skip
+        inserts, deletes = [], defaultdict(list)
+        for cid, key_name, value in zip(cids, key_names, values):
+            key_id = self.key_cache.get(key_name)
+            if key_id is None:
+                continue
+            if value != 0:
+                inserts.append({'candidate_id': cid, 'key_id': key_id, 'value': value})
+
+            # A zero value is never stored, so any existing Annotation is removed
+            elif not clear:
+                deletes[key_id].append(cid)
+
+        # Annotation updating only needs to be done if clear=False; otherwise we just insert
+        table = self.annotation_class.__table__
+        for key_id, key_cids in iteritems(deletes):
+            for cids_chunk in chunks(key_cids, IN_CLAUSE_SIZE):
+                self.session.execute(table.delete()
+                    .where(table.c.key_id == key_id)
+                    .where(table.c.candidate_id.in_(cids_chunk)))
+        self.insert(inserts, upsert=not clear)
+
+    def insert(self, rows, upsert=False):
+        """Inserts Annotations, given as candidate_id, key_id, value dicts, or upserts them if upsert=True"""
+        if len(rows) == 0:
+            return
+        table = self.annotation_class.__table__
+
+        # On Postgres, insert as multi-row VALUES statements (psycopg2's executemany runs one
+        # statement per row)
+        if snorkel_postgres:
+            for rows_chunk in chunks(rows, INSERT_CHUNK_SIZE):
+                query = pg_insert(table).values(rows_chunk)
+                if upsert:
+                    query = query.on_conflict_do_update(
+                        index_elements=[table.c.key_id, table.c.candidate_id],
+                        set_={'value': query.excluded.value})
+                self.session.execute(query)
+
+        # On SQLite, executemany is efficient
         else:
-            key_select_query = select([self.annotation_key_class.id])\
-                                .where(self.annotation_key_class.name == bindparam('name'))
-            if key_group is not None:
-                key_select_query = key_select_query.where(self.annotation_key_class.group == key_group)
-
-        anno_insert_query = self.annotation_class.__table__.insert()
-
-        # Check if the AnnotationKey already exists, and gets its id
-        key_id = None
-        if key_name in self.key_cache:
-            key_id = self.key_cache[key_name]
-        else:
-            key_args = {'name': key_name, 'group': key_group} if key_group else {'name': key_name}
+            query = table.insert().prefix_with('OR REPLACE') if upsert else table.insert()
+            self.session.execute(query, rows)
 
-            # If we are replacing the AnnotationKeys (replace_key_set=True), then we assume they will
-            # all have been handled by *this* reduce thread, and hence be in the cache already
-            if not replace_key_set:
-                key_id = self.session.execute(key_select_query, key_args).first()
-
-            # Key not in cache but exists in DB; add to cache
-            if key_id is not None:
-                key_id                   = key_id[0]
+    def _load_key_ids(self, key_names, key_group, replace_key_set):
+        """
+        Adds the ids of all AnnotationKeys in key_names to the key cache, using one query per
+        IN_CLAUSE_SIZE unseen names. Unseen AnnotationKeys are inserted if replace_key_set=True.
+        Note that in current configuration, we never update AnnotationKeys!
+        """
+        # Collect unseen names in order of first appearance, which determines the key id order
+        new_names = []
+        for key_name in key_names:
+            if key_name not in self.key_cache:
+                self.key_cache[key_name] = None
+                new_names.append(key_name)
+        if len(new_names) == 0:
+            return
+
+        # Keys not in cache but already in DB
+        key_cls = self.annotation_key_class
+        for names_chunk in chunks(new_names, IN_CLAUSE_SIZE):
+            key_select_query = select([key_cls.id, key_cls.name]).where(key_cls.name.in_(names_chunk))
+            if key_group is not None:
+                key_select_query = key_select_query.where(key_cls.group == key_group)
+            for key_id, key_name in self.session.execute(key_select_query):
                 self.key_cache[key_name] = key_id
 
-            # Key not in cache or DB; add to both if create_new_keyset = True
-            elif replace_key_set:
-                key_id   = self.session.execute(key_insert_query, key_args).inserted_primary_key[0]
-                self.key_cache[key_name] = key_id
+        # Keys not in cache or DB; add to both if replace_key_set = True, else these are skipped
+        missing = [key_name for key_name in new_names if self.key_cache[key_name] is None]
+        if len(missing) > 0 and replace_key_set:
+            key_args = [{'name': key_name, 'group': key_group} if key_group else {'name': key_name}
+                        for key_name in missing]
+            self.session.execute(key_cls.__table__.insert(), key_args)
+            for names_chunk in chunks(missing, IN_CLAUSE_SIZE):
+                key_select_query = select([key_cls.id, key_cls.name])\
+                                    .where(key_cls.name.in_(names_chunk))\
+                                    .where(key_cls.group == (key_group or 0))
+                for key_id, key_name in self.session.execute(key_select_query):
+                    self.key_cache[key_name] = key_id
+
+        # Drop the names which could not be resolved, so that they are checked again next flush
+        for key_name in missing:
+            if self.key_cache[key_name] is None:
+                del self.key_cache[key_name]
+
+
+class StoreAnnotatorUDF(AnnotatorUDF):
+    """AnnotatorUDF which writes the Annotations of each split to a shard of a CSRAnnotationStore"""
+    def __init__(self, annotation_class, annotation_key_class, f_gen, store, **kwargs):
+        self.store = store
+        super(StoreAnnotatorUDF, self).__init__(annotation_class, annotation_key_class, f_gen, **kwargs)
+
+    def flush(self, clear, key_group, replace_key_set, split=0, **kwargs):
+        cids, key_names, values = self.buffer
+        self.buffer = ([], [], [])
+        if len(cids) > 0:
+            writer = self.store.writer(SHARD_NAME % split, key_group, add_keys=replace_key_set,
+                                       merge=not clear)
+            writer.append(cids, key_names, values)
+
+
+class InMemoryAnnotatorUDF(AnnotatorUDF):
+    """AnnotatorUDF which collects the Annotations in memory, as columns, instead of writing them"""
+    def __init__(self, annotation_class, annotation_key_class, f_gen, **kwargs):
+        super(InMemoryAnnotatorUDF, self).__init__(annotation_class, annotation_key_class, f_gen,
+                                                   **kwargs)
+        self.collected = ([], [], [])
 
-        # If AnnotationKey does not exist and create_new_keyset = False, skip
-        if key_id is not None:
+    def flush(self, **kwargs):
+        for column, values in zip(self.collected, self.buffer):
+            column.extend(values)
+        self.buffer = ([], [], [])
 
-            # Updates the Annotation, assuming one might already exist, if try_update = True
-            if not clear:
-                res = self.session.execute(anno_update_query, {'cid': cid, 'kid': key_id, 'value': value})
 
-            # If Annotation does not exist, insert
-            if (clear or res.rowcount == 0) and value != 0:
-                self.session.execute(anno_insert_query, {'candidate_id': cid, 'key_id': key_id, 'value': value})
+def annotation_watermark(annotation_key_class, annotation_class, session, split=0, cids_query=None,
+    key_group=0):
+    """
+    Returns a watermark of the annotations of a split of candidates (or of cids_query) and a key
+    group in the DB: the count and max id of the candidates and of the keys, and the count of the
+    annotations with checksums of their values: their sum, their sums weighted by candidate id and by
+    key id, and their sum weighted by a hash of the (candidate id, key id) pair. It is computed by
+    aggregate queries, so much faster than loading the annotations, and changes whenever candidates,
+    keys or annotations are added or deleted, or values are changed or moved to other candidates or
+    keys, unless the changes happen to cancel out in all the checksums.
+    """
+    cid_query = cids_query or session.query(Candidate.id)\
+                                     .filter(Candidate.split == split)
+    cid_sq    = cid_query.subquery()
+    cid_col   = list(cid_sq.c)[0]
+    watermark = list(session.query(func.count(cid_col), func.max(cid_col)).one())
+    watermark.extend(session.query(func.count(annotation_key_class.id), func.max(annotation_key_class.id))
+                            .filter(annotation_key_class.group == key_group).one())
+
+    # Note: the weighted sums are computed as floats, which cannot overflow (unlike SQLite integers)
+    value     = annotation_class.value
+    cid       = cast(annotation_class.candidate_id, BigInteger)
+    kid       = cast(annotation_class.key_id, BigInteger)
+    pair_hash = (cid * WATERMARK_HASH_MULTIPLIER + kid) % WATERMARK_HASH_MODULUS
+    watermark.extend(session.query(func.count(annotation_class.key_id), func.sum(value),
+                                   func.sum(cast(cid, Float) * value), func.sum(cast(kid, Float) * value),
+                                   func.sum(cast(pair_hash, Float) * value))
+                            .join(annotation_key_class, annotation_class.key_id == annotation_key_class.id)
+                            .filter(annotation_key_class.group == key_group)
+                            .filter(annotation_class.candidate_id.in_(cid_query.subquery())).one())
+    return watermark
 
 
 def load_matrix(matrix_class, annotation_key_class, annotation_class, session,
     split=0, cids_query=None, key_group=0, key_names=None, zero_one=False,
-    load_as_array=False):
+    load_as_array=False, store=None, cache=None):
     """
     Returns the annotations corresponding to a split of candidates with N members
     and an AnnotationKey group with M distinct keys as an N x M CSR sparse matrix.
+
+    The rows and columns are ordered by candidate id and key id respectively.
+    If a CSRAnnotationStore is given, the annotations are loaded from it instead; see
+    CSRAnnotationStore.load_matrix.
+
+    If cache is a path, the matrix is saved there (see csr_AnnotationMatrix.save) and reloaded from it
+    by later calls, memory-mapped, as long as the watermark of its annotations is unchanged; see
+    annotation_watermark. The cache is keyed on nothing else, so use one path per set of arguments.
     """
     cid_query = cids_query or session.query(Candidate.id)\
                                      .filter(Candidate.split == split)
-    cid_query = cid_query.order_by(Candidate.id)
+
+    # The shard of the split is opened directly; other sets of candidates are gathered from all shards
+    if store is not None:
+        cids = None
+        if cids_query is not None or not store.has_shard(SHARD_NAME % split, key_group):
+            cids, = load_columns(cid_query, [np.int64])
+        return store.load_matrix(matrix_class, annotation_key_class, split=split, cids=cids,
+            key_group=key_group, key_names=key_names, zero_one=zero_one, load_as_array=load_as_array)
+
+    # A cached matrix is reused if it was loaded with the same arguments from the same annotations
+    if cache is not None:
+        watermark = annotation_watermark(annotation_key_class, annotation_class, session, split=split,
+                        cids_query=cids_query, key_group=key_group)
+        watermark.extend([sorted(key_names) if key_names is not None else None, zero_one])
+        Xr = matrix_class.load(cache, watermark=watermark) if os.path.isdir(cache) else None
+        if Xr is None:
+            Xr = load_matrix(matrix_class, annotation_key_class, annotation_class, session, split=split,
+                    cids_query=cids_query, key_group=key_group, key_names=key_names, zero_one=zero_one)
+            Xr.save(cache, watermark=watermark)
+        return np.squeeze(Xr.toarray()) if load_as_array else Xr
 
     keys_query = session.query(annotation_key_class.id)
     keys_query = keys_query.filter(annotation_key_class.group == key_group)
     if key_names is not None:
         keys_query = keys_query.filter(annotation_key_class.name.in_(frozenset(key_names)))
-    keys_query = keys_query.order_by(annotation_key_class.id)
-
-    # First, we query to construct the row index map
-    cid_to_row = {}
-    row_to_cid = {}
-    for cid, in cid_query.all():
-        if cid not in cid_to_row:
-            j = len(cid_to_row)
-
-            # Create both mappings
-            cid_to_row[cid] = j
-            row_to_cid[j]   = cid
-
-    # Second, we query to construct the column index map
-    kid_to_col = {}
-    col_to_kid = {}
-    for kid, in keys_query.all():
-        if kid not in kid_to_col:
-            j = len(kid_to_col)
-
-            # Create both mappings
-            kid_to_col[kid] = j
-            col_to_kid[j]   = kid
-
-    # Create sparse matrix in LIL format for incremental construction
-    X = sparse.lil_matrix((len(cid_to_row), len(kid_to_col)), dtype=np.int64)
-
-    # NOTE: This is much faster as it allows us to skip the above join (which for some reason is
-    # unreasonably slow) by relying on our symbol tables from above; however this will get slower with
-    # The total number of annotations in DB which is weird behavior...
+
+    # First, we load the sorted, distinct candidate ids and key ids; row / column i is the i-th id
+    cids, = load_columns(cid_query, [np.int64])
+    kids, = load_columns(keys_query, [np.int64])
+    cids  = np.unique(cids)
+    kids  = np.unique(kids)
+
+    # Then we stream the annotations of these candidates as columns, and map their ids to rows /
+    # columns by binary search, dropping the annotations of other keys
+    # NOTE: The candidates are selected by a semi-join (IN subquery), which uses the
+    # (candidate_id, key_id) index of the annotation table, so that the load time scales with the size
+    # of the split rather than with the total number of annotations in the DB; the keys are filtered
+    # here, as adding them to the IN lookups makes e.g. SQLite probe every (candidate, key) pair
     q = session.query(annotation_class.candidate_id, annotation_class.key_id, annotation_class.value)
-    q = q.order_by(annotation_class.candidate_id)
-
-    # Iteratively construct row index and output sparse matrix
-    for cid, kid, val in q.all():
-        if cid in cid_to_row and kid in kid_to_col:
-            # Optionally restricts val range to {0,1}, mapping -1 -> 0
-            if zero_one:
-                val = 1 if val == 1 else 0
-            X[cid_to_row[cid], kid_to_col[kid]] = int(val)
-
-    # Return as an AnnotationMatrix
-    Xr = matrix_class(X, candidate_index=cid_to_row, row_index=row_to_cid,
-                        annotation_key_cls=annotation_key_class, key_index=kid_to_col, col_index=col_to_kid)
+    q = q.filter(annotation_class.candidate_id.in_(cid_query.subquery()))
+    a_cids, a_kids, values = load_columns(q, [np.int64, np.int64, np.float64])
+    cols = np.searchsorted(kids, a_kids)
+    keep = cols < len(kids)
+    keep[keep] = kids[cols[keep]] == a_kids[keep]
+    rows = np.searchsorted(cids, a_cids[keep])
+    cols = cols[keep]
+
+    # Optionally restricts val range to {0,1}, mapping -1 -> 0
+    values = values[keep].astype(np.int64)
+    if zero_one:
+        values = (values == 1).astype(np.int64)
+    nonzero = values != 0
+
+    # Return as an AnnotationMatrix, built in one step from the (value, (row, col)) coordinates
+    Xr = matrix_class((values[nonzero], (rows[nonzero], cols[nonzero])), shape=(len(cids), len(kids)),
+                        dtype=np.int64, row_index=cids, annotation_key_cls=annotation_key_class,
+                        col_index=kids)
     return np.squeeze(Xr.toarray()) if load_as_array else Xr
 
 
@@ -386,8 +790,11 @@ class LabelAnnotator(Annotator):
     :param lfs: A _list_ of labeling functions (LFs)
     """
     def __init__(self, lfs=None, label_generator=None):
+        # The LFs actually run by apply, i.e. all of them unless re-applying incrementally
+        self.lfs        = lfs
+        self.active_lfs = lfs
         if lfs is not None:
-            labels = lambda c : [(lf.__name__, lf(c)) for lf in lfs]
+            labels = lambda c : [(lf.__name__, lf(c)) for lf in self.active_lfs]
         elif label_generator is not None:
             labels = lambda c : label_generator(c)
         else:
@@ -420,17 +827,318 @@ class LabelAnnotator(Annotator):
 
         super(LabelAnnotator, self).__init__(Label, LabelKey, f_gen)
 
+    def apply(self, split=0, key_group=0, replace_key_set=True, cids_query=None, incremental=False,
+        **kwargs):
+        """
+        Applies the LFs to the candidates and returns the resulting csr_LabelMatrix.
+
+        If incremental=True (and replace_key_set=True), only the LFs which are new or were changed
+        since the last run, as detected by their fingerprints (see lf_fingerprint), are re-applied;
+        the Labels of the other LFs are kept, and the Labels and LabelKeys of the LFs which were removed
+        are deleted. This assumes that the unchanged LFs were last applied to the same candidates.
+        """
+        # The fingerprints are computed once, before the run, as hashing the LFs can be costly
+        fingerprints = None
+        if replace_key_set and self.lfs is not None:
+            fingerprints = dict((lf.__name__, lf_fingerprint(lf)) for lf in self.lfs)
+        if not incremental or not replace_key_set:
+            X = super(LabelAnnotator, self).apply(split=split, key_group=key_group,
+                replace_key_set=replace_key_set, cids_query=cids_query, **kwargs)
+            if fingerprints is not None:
+                self._save_fingerprints(key_group, fingerprints)
+            return X
+        if self.lfs is None:
+            raise ValueError("Incremental re-application requires the lfs kwarg.")
+
+        # Compare the fingerprints of the LFs with those of the existing LabelKeys
+        SnorkelSession = new_sessionmaker()
+        session        = SnorkelSession()
+        begin_transaction(session)
+        keys         = session.query(LabelKey.id, LabelKey.name, LabelKey.fingerprint)\
+                              .filter(LabelKey.group == key_group).all()
+        current      = set(name for _, name, fingerprint in keys
+                           if fingerprint is not None and fingerprints.get(name) == fingerprint)
+        removed      = [key_id for key_id, name, _ in keys if name not in fingerprints]
+        changed      = [key_id for key_id, name, _ in keys if name in fingerprints and name not in current]
+
+        # Delete the Labels of the changed and removed LFs, and the LabelKeys of the removed ones; the
+        # changed LFs keep their LabelKeys, and thus their columns in the matrix
+        for key_ids in chunks(removed + changed, IN_CLAUSE_SIZE):
+            session.query(Label).filter(Label.key_id.in_(key_ids)).delete(synchronize_session=False)
+        for key_ids in chunks(removed, IN_CLAUSE_SIZE):
+            session.query(LabelKey).filter(LabelKey.id.in_(key_ids)).delete(synchronize_session=False)
+        session.commit()
+        session.close()
+
+        # Re-apply only the new and changed LFs, without clearing the Labels of the others
+        self.active_lfs = [lf for lf in self.lfs if lf.__name__ not in current]
+        try:
+            if len(self.active_lfs) > 0:
+                X = super(LabelAnnotator, self).apply(split=split, key_group=key_group,
+                    replace_key_set=True, cids_query=cids_query, **dict(kwargs, clear=False))
+            else:
+                X = self.load_matrix(SnorkelSession(), split=split, key_group=key_group,
+                    cids_query=cids_query)
+        finally:
+            self.active_lfs = self.lfs
+        self._save_fingerprints(key_group, fingerprints)
+        return X
+
+    def apply_in_memory(self, candidates, parallelism=None, key_group=0, progress_bar=True, **kwargs):
+        """
+        Applies the LFs to a list of loaded Candidates, and returns the csr_LabelMatrix directly,
+        without writing any Labels to the database; only the missing LabelKeys are inserted, so that
+        the matrix can be used as one loaded by load_label_matrix (e.g. for lf_stats), and stored
+        later with persist.
+
+        With parallelism > 1, the candidates are passed to the UDF processes by id, and the Labels are
+        sent back and collected by this process; the other kwargs are passed on to UDFRunner.apply.
+        """
+        if parallelism is None or parallelism < 2:
+            udf = InMemoryAnnotatorUDF(**self.udf_init_kwargs)
+            pb  = ProgressBar(len(candidates)) if progress_bar and len(candidates) > 0 else None
+            for i, c in enumerate(candidates):
+                if pb:
+                    pb.bar(i)
+                for y in udf.annotate(c):
+                    udf.reduce(y)
+            if pb:
+                pb.close()
+        else:
+            runner = UDFRunner(InMemoryAnnotatorUDF, **self.udf_init_kwargs)
+            udf    = runner.reducer
+            kwargs.setdefault('batch_size', CANDIDATE_BATCH_SIZE)
+            runner.apply([(c.id,) for c in candidates], clear=False, parallelism=parallelism,
+                progress_bar=progress_bar, count=len(candidates), key_group=key_group,
+                replace_key_set=True, **kwargs)
+        udf.flush()
+        a_cids, key_names, values = udf.collected
+
+        # Look up the LabelKeys, inserting the missing ones
+        udf._load_key_ids(key_names, key_group, True)
+        udf.session.commit()
+        udf.session.close()
+
+        # Rows and columns are ordered by candidate id and key id, as by load_label_matrix
+        a_kids = np.array([udf.key_cache[key_name] for key_name in key_names], dtype=np.int64)
+        a_cids = np.array(a_cids, dtype=np.int64)
+        values = np.array(values, dtype=np.int64)
+        cids   = np.unique(np.array([c.id for c in candidates], dtype=np.int64))
+        kids   = np.unique(a_kids)
+        nonzero = values != 0
+        rows    = np.searchsorted(cids, a_cids[nonzero])
+        cols    = np.searchsorted(kids, a_kids[nonzero])
+
+        return csr_LabelMatrix((values[nonzero], (rows, cols)), shape=(len(cids), len(kids)),
+                    dtype=np.int64, row_index=cids, annotation_key_cls=LabelKey, col_index=kids)
+
+    def persist(self, L):
+        """
+        Writes a csr_LabelMatrix, e.g. as returned by apply_in_memory, to the database: replaces the
+        Labels of its candidates for its LabelKeys with its non-zero entries.
+        """
+        udf = AnnotatorUDF(**self.udf_init_kwargs)
+        begin_transaction(udf.session)
+        cids  = L.row_index.tolist()
+        kids  = L.col_index.tolist()
+        table = Label.__table__
+
+        # Note: both IN clauses count towards the limit on the number of host parameters
+        for kids_chunk in chunks(kids, IN_CLAUSE_SIZE // 2):
+            for cids_chunk in chunks(cids, IN_CLAUSE_SIZE // 2):
+                udf.session.execute(table.delete()
+                    .where(table.c.key_id.in_(kids_chunk))
+                    .where(table.c.candidate_id.in_(cids_chunk)))
+        X = L.tocoo()
+        udf.insert([{'candidate_id': cids[i], 'key_id': kids[j], 'value': v}
+                    for i, j, v in zip(X.row.tolist(), X.col.tolist(), X.data.tolist()) if v != 0])
+        udf.session.commit()
+        udf.session.close()
+
+    def _save_fingerprints(self, key_group, fingerprints):
+        """Stores the fingerprints of the LFs, given by name, on their LabelKeys"""
+        table   = LabelKey.__table__
+        session = new_sessionmaker()()
+        begin_transaction(session)
+        session.execute(table.update()
+            .where(table.c.name == bindparam('lf_name'))
+            .where(table.c.group == key_group)
+            .values(fingerprint=bindparam('lf_fingerprint')),
+            [{'lf_name': name, 'lf_fingerprint': fingerprint} for name, fingerprint in iteritems(fingerprints)])
+        session.commit()
+        session.close()
+
     def load_matrix(self, session, **kwargs):
         return load_label_matrix(session, **kwargs)
 
 
+def lf_fingerprint(lf):
+    """
+    Returns a fingerprint of a labeling function, which changes when the LF is edited: a hash of its
+    name, bytecode, constants, default arguments and closure, and of the global functions and values
+    it references, recursively. Values are hashed by content: numbers and strings by their repr,
+    containers element by element, numpy arrays, sparse matrices and pandas objects by their data.
+    Other objects (e.g. instances of other classes) cannot be hashed reliably, so an LF which depends on
+    one gets a new fingerprint on every call, and is thus re-applied on every run.
+    """
+    h = hashlib.sha1()
+    h.update(getattr(lf, '__name__', '').encode('utf-8'))
+    _hash_callable(h, lf, set())
+    return h.hexdigest()
+
+
+def _hash_callable(h, f, seen):
+    if isinstance(f, partial):
+        _hash_callable(h, f.func, seen)
+        _hash_value(h, (f.args, f.keywords), seen)
+        return
+    if getattr(f, '__self__', None) is not None and hasattr(f, '__func__'):
+        _hash_value(h, f.__self__, seen)
+        f = f.__func__
+    code = getattr(f, '__code__', None)
+    if code is None:
+        _hash_value(h, f, seen)
+        return
+    if code in seen:
+        return
+    seen.add(code)
+    _hash_code(h, code, seen)
+    _hash_value(h, f.__defaults__, seen)
+    for cell in f.__closure__ or ():
+        _hash_value(h, cell.cell_contents, seen)
+    for name in code.co_names:
+        if name in f.__globals__:
+            h.update(name.encode('utf-8'))
+            _hash_value(h, f.__globals__[name], seen)
+
+
+def _hash_code(h, code, seen):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode('utf-8'))
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            _hash_code(h, const, seen)
+        else:
+            _hash_value(h, const, seen)
+
+
+def _hash_array(h, x):
+    h.update(('%s%s' % (x.dtype.str, x.shape)).encode('utf-8'))
+    h.update(np.ascontiguousarray(x).tobytes())
+
+
+def _hash_value(h, x, seen):
+    if x is None or isinstance(x, (bool, numbers.Number, string_types, bytes)):
+        h.update(repr(x).encode('utf-8'))
+    elif isinstance(x, ModuleType):
+        h.update(x.__name__.encode('utf-8'))
+    elif isinstance(x, type):
+        h.update(('%s.%s' % (x.__module__, x.__name__)).encode('utf-8'))
+    elif isinstance(x, BuiltinFunctionType):
+        h.update(('%s.%s' % (x.__module__, x.__name__)).encode('utf-8'))
+        if getattr(x, '__self__', None) is not None and not isinstance(x.__self__, ModuleType):
+            _hash_value(h, x.__self__, seen)
+    elif callable(x) and (hasattr(x, '__code__') or isinstance(x, partial)):
+        _hash_callable(h, x, seen)
+    elif isinstance(x, type(re.compile(''))):
+        h.update(repr((x.pattern, x.flags)).encode('utf-8'))
+
+    # Containers are hashed element by element; a container within itself is not followed again
+    elif isinstance(x, (tuple, list, dict, set, frozenset)):
+        if id(x) in seen:
+            return
+        seen.add(id(x))
+        try:
+            _hash_container(h, x, seen)
+        finally:
+            seen.discard(id(x))
+    elif isinstance(x, np.ndarray) and x.dtype != object:
+        _hash_array(h, x)
+    elif isinstance(x, np.ndarray):
+        _hash_value(h, (x.shape, x.ravel().tolist()), seen)
+    elif isinstance(x, np.generic):
+        _hash_array(h, np.asarray(x))
+    elif sparse.issparse(x):
+        x = x.tocsr()
+        h.update(repr(x.shape).encode('utf-8'))
+        for a in [x.data, x.indices, x.indptr]:
+            _hash_array(h, a)
+    elif isinstance(x, (DataFrame, Series, Index)):
+        try:
+            _hash_value(h, [list(x.columns) if isinstance(x, DataFrame) else x.name,
+                            hash_pandas_object(x).values], seen)
+        except TypeError:
+            _hash_opaque(h)
+
+    # Anything else cannot be reliably hashed, e.g. by its repr, which may be truncated
+    else:
+        _hash_opaque(h)
+
+
+def _hash_container(h, x, seen):
+    h.update(type(x).__name__.encode('utf-8'))
+    if isinstance(x, (tuple, list)):
+        for y in x:
+            _hash_value(h, y, seen)
+    elif isinstance(x, dict):
+        # Note: the keys are sorted by repr, as they may not be comparable with each other
+        for key, y in sorted(iteritems(x), key=lambda item: repr(item[0])):
+            _hash_value(h, key, seen)
+            _hash_value(h, y, seen)
+
+    # Note: the iteration order of sets of e.g. strings varies between interpreter runs
+    elif all(isinstance(y, (numbers.Number, string_types, bytes)) for y in x):
+        h.update(repr(sorted(repr(y) for y in x)).encode('utf-8'))
+    else:
+        for digest in sorted(_value_digest(y, seen) for y in x):
+            h.update(digest)
+
+
+def _value_digest(x, seen):
+    h = hashlib.sha1()
+    _hash_value(h, x, seen)
+    return h.digest()
+
+
+def _hash_opaque(h):
+    """Makes the fingerprint unique, so that the LF is considered as changed"""
+    h.update(os.urandom(16))
+
+
 class FeatureAnnotator(Annotator):
-    """Apply feature generators to the candidates, generating Feature annotations"""
-    def __init__(self, f=get_span_feats):
-        super(FeatureAnnotator, self).__init__(Feature, FeatureKey, f)
+    """
+    Apply feature generators to the candidates, generating Feature annotations
+
+    :param store: A CSRAnnotationStore to write the features to, instead of the Feature table
+    :param hash_bits: If given, the features are hashed to 2**hash_bits columns of the store, rather
+        than having a column (and FeatureKey) each; see HashedKeys
+    :param signed_hash: If True, the sign of the values of hashed features is also given by the hash
+    :param sample_names: The number of feature names to keep per hashed column for debugging, see
+        HashedKeys.names
+    """
+    def __init__(self, f=get_span_feats, store=None, hash_bits=None, signed_hash=False, sample_names=0):
+        if hash_bits is not None and store is None:
+            raise ValueError("Feature hashing requires a CSRAnnotationStore.")
+        self.hash_bits    = hash_bits
+        self.signed_hash  = signed_hash
+        self.sample_names = sample_names
+        super(FeatureAnnotator, self).__init__(Feature, FeatureKey, f, store=store)
+
+    def apply(self, split=0, key_group=0, **kwargs):
+        if self.hash_bits is not None and not isinstance(self.store.keys(key_group), HashedKeys):
+            self.store.save_keys(HashedKeys(self.hash_bits, self.signed_hash, self.sample_names), key_group)
+        return super(FeatureAnnotator, self).apply(split=split, key_group=key_group, **kwargs)
+
+    def clear(self, session, split=0, key_group=0, replace_key_set=True, cids_query=None, **kwargs):
+        super(FeatureAnnotator, self).clear(session, split=split, key_group=key_group,
+            replace_key_set=replace_key_set, cids_query=cids_query, **kwargs)
+
+        # Clearing the key set of a hashed key group keeps it hashed, but resets its sampled names
+        if self.hash_bits is not None and replace_key_set:
+            self.store.save_keys(HashedKeys(self.hash_bits, self.signed_hash, self.sample_names), key_group)
 
     def load_matrix(self, session, **kwargs):
-        return load_feature_matrix(session, **kwargs)
+        return load_feature_matrix(session, store=self.store, **kwargs)
 
 
 def save_marginals(session, X, marginals, training=True):
@@ -446,51 +1154,33 @@ def save_marginals(session, X, marginals, training=True):
 
     Note: The marginals for k=0 are not stored, only for k = 1,...,K
     """
-    # Make sure that we are working with a numpy array
-    try:
-        shape = marginals.shape
-    except:
-        marginals = np.array(marginals)
-        shape = marginals.shape
+    marginals = np.asarray(marginals, dtype=np.float64)
 
     # Handle binary input as M x 1-dim array; assume elements represent
-    # poksitive (k=1) class values
-    if len(shape) == 1:
+    # positive (k=1) class values
+    if marginals.ndim == 1:
         marginals = np.vstack([1-marginals, marginals]).T
 
-    # Only add values for classes k=1,...,K
-    marginal_tuples = []
-    for i in range(shape[0]):
-        for k in range(1, shape[1] if len(shape) > 1 else 2):
-            if marginals[i, k] > 0:
-                marginal_tuples.append((i, k, marginals[i, k]))
+    # The candidate ids of the rows, from the matrix's row index or from the objects
+    if isinstance(X, csr_AnnotationMatrix):
+        cids = np.asarray(X.row_index, dtype=np.int64)
+    else:
+        cids = np.array([x.id for x in X], dtype=np.int64)
+
+    # Only add (non-zero) values for classes k=1,...,K
+    rows, ks = np.nonzero(marginals[:, 1:] > 0)
+    ks      += 1
 
     # NOTE: This will delete all existing marginals of type `training`
+    begin_transaction(session)
     session.query(Marginal).filter(Marginal.training == training).\
-        delete(synchronize_session='fetch')
-
-    # Prepare bulk INSERT query
-    q = Marginal.__table__.insert()
-
-    # Check whether X is an AnnotationMatrix or not
-    anno_matrix = isinstance(X, csr_AnnotationMatrix)
-    if not anno_matrix:
-        X = list(X)
-
-    # Prepare values
-    insert_vals = []
-    for i, k, p in marginal_tuples:
-        cid = X.get_candidate(session, i).id if anno_matrix else X[i].id
-        insert_vals.append({
-            'candidate_id': cid,
-            'training': training,
-            'value': k,
-            # We cast p in case its a numpy type, which psycopg2 does not handle
-            'probability': float(p)
-        })
-
-    # Execute update
-    session.execute(q, insert_vals)
+        delete(synchronize_session=False)
+    insert_columns(session, Marginal.__table__, [
+        ('candidate_id', cids[rows]),
+        ('training',     np.repeat(bool(training), len(rows))),
+        ('value',        ks),
+        ('probability',  marginals[rows, ks]),
+    ])
     session.commit()
     print("Saved %s marginals" % len(marginals))
 
@@ -498,48 +1188,38 @@ def save_marginals(session, X, marginals, training=True):
 def load_marginals(session, X=None, split=0, training=True):
     """Load the marginal probs. for a given split of Candidates"""
 
-    # Load marginal tuples from db
-    marginal_tuples = session.query(
-        Marginal.candidate_id,
-        Marginal.value,
-        Marginal.probability
-    ).join(Candidate)\
-        .filter(Candidate.split == split)\
-        .filter(Marginal.training == training).all()
+    # Load the marginals from db as columns
+    q = session.query(Marginal.candidate_id, Marginal.value, Marginal.probability)\
+               .join(Candidate)\
+               .filter(Candidate.split == split)\
+               .filter(Marginal.training == training)
+    m_cids, ks, probs = load_columns(q, [np.int64, np.int64, np.float64])
 
-    # Assemble cols 1,...,K of marginals matrix
+    # Get the candidate id of each row, and the cardinality
     if X is not None:
         # For now, handle feature matrix vs. list of objects with try / except
         try:
             cardinality = X.get_candidate(session, 0).cardinality
-            marginals = np.zeros((X.shape[0], cardinality))
-            for cid, k, p in marginal_tuples:
-                marginals[X.candidate_index[cid], k] = p
+            cids = np.asarray(X.row_index, dtype=np.int64)
         except:
             cardinality = X[0].cardinality
-            marginals = np.zeros((len(X), cardinality))
-            candidate_index = dict([(x.id, i) for i, x in enumerate(X)])
-            for cid, k, p in marginal_tuples:
-                marginals[candidate_index[cid], k] = p
+            cids = np.array([x.id for x in X], dtype=np.int64)
     else:
-        cardinality = session.query(Candidate).get(marginal_tuples[0][0]).cardinality
-
-        # Loads cid map
-        cids = session.query(Candidate.id).filter(Candidate.split == split)\
-                .order_by(Candidate.id).all()
-        cid_map = {}
-        for i, (cid,) in enumerate(cids):
-            cid_map[cid] = i
-
-        marginals = np.zeros((len(cid_map), cardinality))
-        for i, (cid, k, p) in enumerate(marginal_tuples):
-            marginals[cid_map[cid], k] = p
+        cardinality = session.query(Candidate).get(int(m_cids[0])).cardinality
+        cids, = load_columns(session.query(Candidate.id).filter(Candidate.split == split), [np.int64])
+        cids  = np.sort(cids)
+
+    # Assemble cols 1,...,K of marginals matrix, mapping candidate ids to rows by binary search;
+    # marginals of candidates without a row are skipped
+    order = np.argsort(cids, kind='mergesort')
+    pos   = np.minimum(np.searchsorted(cids, m_cids, sorter=order), max(len(cids) - 1, 0))
+    keep  = cids[order[pos]] == m_cids if len(cids) > 0 else np.zeros(len(m_cids), dtype=bool)
+    marginals = np.zeros((len(cids), cardinality))
+    marginals[order[pos[keep]], ks[keep]] = probs[keep]
 
     # Add first column if k > 2, else ravel
     if cardinality > 2:
-        row_sums = marginals.sum(axis=1)
-        for i in range(marginals.shape[0]):
-            marginals[i, 0] = 1 - row_sums[i]
+        marginals[:, 0] = 1 - marginals.sum(axis=1)
     else:
         marginals = np.ravel(marginals[:, 1])
     return marginals
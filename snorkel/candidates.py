@@ -4,8 +4,10 @@ from itertools import product
 import re
 from sqlalchemy.sql import select
 
-from .models import Candidate, TemporarySpan, Sentence
+from .models import Candidate, Context, TemporarySpan, Sentence
+from .models.context import IN_CLAUSE_SIZE, load_ids_or_insert
 from .udf import UDF, UDFRunner
+from .utils import chunks
 
 QUEUE_COLLECT_TIMEOUT = 5
 
@@ -28,6 +30,7 @@ class CandidateExtractor(UDFRunner):
                                 where A and B are Contexts. Only applies to binary relations. Default is False.
     """
     def __init__(self, candidate_class, cspaces, matchers, self_relations=False, nested_relations=False, symmetric_relations=False):
+        self.candidate_class = candidate_class
         super(CandidateExtractor, self).__init__(CandidateExtractorUDF,
                                                  candidate_class=candidate_class,
                                                  cspaces=cspaces,
@@ -42,6 +45,9 @@ class CandidateExtractor(UDFRunner):
     def clear(self, session, split, **kwargs):
         session.query(Candidate).filter(Candidate.split == split).delete()
 
+    def get_job_name(self, split=0, **kwargs):
+        return "%s:%s:%s" % (self.__class__.__name__, self.candidate_class.__name__, split)
+
 
 class CandidateExtractorUDF(UDF):
     def __init__(self, candidate_class, cspaces, matchers, self_relations, nested_relations, symmetric_relations, **kwargs):
@@ -68,18 +74,30 @@ class CandidateExtractorUDF(UDF):
 
         super(CandidateExtractorUDF, self).__init__(**kwargs)
 
-    def apply(self, context, clear, split, **kwargs):
+    @staticmethod
+    def get_input_key(context):
+        return context.stable_id
+
+    def apply(self, context, **kwargs):
+        """
+        Yields the argument tuples of the Candidates in context, as tuples of TemporaryContexts (e.g.
+        TemporarySpans), not Candidates: they are loaded or inserted, and the Candidates created, by
+        persist_batch.
+        """
         # Generate TemporaryContexts that are children of the context using the candidate_space and filtered
         # by the Matcher
         for i in range(self.arity):
             self.child_context_sets[i].clear()
-            for tc in self.matchers[i].apply(self.candidate_spaces[i].apply(context)):
-                tc.load_id_or_insert(self.session)
+            if isinstance(self.candidate_spaces[i], Ngrams):
+                tcs = self.matchers[i].scan_ngrams(self.candidate_spaces[i], context)
+            else:
+                tcs = self.matchers[i].apply(self.candidate_spaces[i].apply(context))
+            for tc in tcs:
                 self.child_context_sets[i].add(tc)
 
-        # Generates and persists candidates
+        # Generates the candidate argument tuples; these are persisted by persist_batch, so that apply
+        # itself never writes to the DB
         extracted = set()
-        candidate_args = {'split': split}
         for args in product(*[enumerate(child_contexts) for child_contexts in self.child_context_sets]):
 
             # TODO: Make this work for higher-order relations
@@ -101,21 +119,99 @@ class CandidateExtractorUDF(UDF):
                 # Keep track of extracted
                 extracted.add((a,b))
 
-            # Assemble candidate arguments
-            for i, arg_name in enumerate(self.candidate_class.__argnames__):
-                candidate_args[arg_name + '_id'] = args[i][1].id
-
-            # Checking for existence
-            if not clear:
-                q = select([self.candidate_class.id])
-                for key, value in candidate_args.items():
-                    q = q.where(getattr(self.candidate_class, key) == value)
-                candidate_id = self.session.execute(q).first()
-                if candidate_id is not None:
-                    continue
+            yield tuple(tc for _, tc in args)
+
+    def apply_batch(self, xs, **kwargs):
+        """
+        Returns the argument tuples yielded by apply for a batch of contexts. If they are sent to a single
+        writer, TemporarySpans of saved Sentences are sent as (sentence_id, char_start, char_end) tuples,
+        rather than pickled along with their Sentence; persist_batch turns them back into TemporarySpans.
+        """
+        arg_tuples = [args for x in xs for args in self.apply(x, **kwargs)]
+        if not self.send_outputs:
+            return arg_tuples
+        return [tuple(span_to_ids(arg) for arg in args) for args in arg_tuples]
+
+    def persist_batch(self, arg_tuples, clear, split, **kwargs):
+        """
+        Inserts the argument Contexts, and then the Candidates, for argument tuples yielded by apply (or
+        returned by apply_batch). Unless clear is True, Candidates whose arguments are those of an
+        existing Candidate are skipped; the existing argument tuples are loaded for the whole batch at
+        once, see load_existing_arg_ids.
+        """
+        arg_tuples = ids_to_spans(self.session, arg_tuples)
+        load_ids_or_insert(self.session, [arg for args in arg_tuples for arg in args])
+        existing = set() if clear else load_existing_arg_ids(self.session, self.candidate_class,
+                                                             [[arg.id for arg in args] for args in arg_tuples])
+        for args in arg_tuples:
+            arg_ids = tuple(arg.id for arg in args)
+            if arg_ids not in existing:
+                existing.add(arg_ids)
+                self.session.add(get_new_candidate(self.session, self.candidate_class, args, split,
+                    check_for_existing=False))
+
+
+def span_to_ids(tc):
+    """Returns a TemporarySpan of a saved Sentence as a (sentence_id, char_start, char_end) tuple"""
+    if type(tc) is TemporarySpan and tc.meta is None and tc.sentence.id is not None:
+        return (tc.sentence.id, tc.char_start, tc.char_end)
+    return tc
+
+
+def ids_to_spans(session, arg_tuples):
+    """
+    Returns the argument tuples with the (sentence_id, char_start, char_end) tuples of span_to_ids
+    turned back into TemporarySpans, loading their Sentences with one query per IN_CLAUSE_SIZE ids
+    """
+    sentence_ids = set(arg[0] for args in arg_tuples for arg in args if isinstance(arg, tuple))
+    if len(sentence_ids) == 0:
+        return arg_tuples
+    sentences = {}
+    for ids_chunk in chunks(sorted(sentence_ids), IN_CLAUSE_SIZE):
+        sentences.update((c.id, c) for c in session.query(Context).filter(Context.id.in_(ids_chunk)))
+    return [tuple(TemporarySpan(sentences[arg[0]], arg[1], arg[2]) if isinstance(arg, tuple) else arg
+                  for arg in args) for args in arg_tuples]
+
 
-            # Add Candidate to session
-            yield self.candidate_class(**candidate_args)
+def load_existing_arg_ids(session, candidate_class, arg_id_tuples):
+    """
+    Returns the set of the tuples of argument Context ids, among arg_id_tuples, of the existing
+    Candidates of candidate_class, with one query per IN_CLAUSE_SIZE values of the first argument
+    (the leading column of the unique index on the argument ids).
+    """
+    arg_columns = [getattr(candidate_class, arg_name + '_id') for arg_name in candidate_class.__argnames__]
+    first_ids   = sorted(set(arg_ids[0] for arg_ids in arg_id_tuples))
+    arg_id_set  = set(tuple(arg_ids) for arg_ids in arg_id_tuples)
+    existing    = set()
+    for ids_chunk in chunks(first_ids, IN_CLAUSE_SIZE):
+        for row in session.execute(select(arg_columns).where(arg_columns[0].in_(ids_chunk))):
+            if tuple(row) in arg_id_set:
+                existing.add(tuple(row))
+    return existing
+
+
+def get_new_candidate(session, candidate_class, args, split, check_for_existing=True, arg_cids=None):
+    """
+    Loads or inserts the TemporaryContexts args, and returns a new Candidate over them, or None if
+    check_for_existing=True and the Candidate already exists.
+    """
+    # Assemble candidate arguments
+    candidate_args = {'split': split}
+    for i, arg_name in enumerate(candidate_class.__argnames__):
+        args[i].load_id_or_insert(session)
+        candidate_args[arg_name + '_id'] = args[i].id
+        if arg_cids is not None:
+            candidate_args[arg_name + '_cid'] = arg_cids[i]
+
+    # Checking for existence
+    if check_for_existing:
+        q = select([candidate_class.id])
+        for key, value in candidate_args.items():
+            q = q.where(getattr(candidate_class, key) == value)
+        candidate_id = session.execute(q).first()
+        if candidate_id is not None:
+            return None
+    return candidate_class(**candidate_args)
 
 
 class CandidateSpace(object):
@@ -141,20 +237,46 @@ class Ngrams(CandidateSpace):
         self.split_rgx = r'('+r'|'.join(split_tokens)+r')' if split_tokens and len(split_tokens) > 0 else None
     
     def apply(self, context):
-
+        return self.scan(context)
+
+    def scan(self, context, is_prefix=None):
+        """
+        Yields the n-grams of the context, as apply does. If is_prefix is given, the n-grams starting at
+        each token are only extended while is_prefix holds for them, and only those are yielded (along
+        with the splits of single tokens), in the same order. Matchers which can tell whether a span is
+        the prefix of a match, e.g. DictionaryMatch, use this to skip most n-grams; see
+        Matcher.scan_ngrams.
+        """
         # These are the character offset--**relative to the sentence start**--for each _token_
         offsets = context.char_offsets
+        L       = len(offsets)
+
+        # The length of the longest n-gram starting at each token which is yielded
+        spans   = {}
+        lengths = [self.n_max] * L
+        if is_prefix is not None:
+            for i in range(L):
+                for l in range(1, min(self.n_max, L - i) + 1):
+                    ts = TemporarySpan(char_start=offsets[i], sentence=context,
+                                       char_end=offsets[i+l-1] + len(context.words[i+l-1]) - 1)
+                    if not is_prefix(ts):
+                        lengths[i] = l - 1
+                        break
+                    spans[(i, l)] = ts
 
         # Loop over all n-grams in **reverse** order (to facilitate longest-match semantics)
-        L    = len(offsets)
         seen = set()
         for l in range(1, self.n_max+1)[::-1]:
             for i in range(L-l+1):
+                if l > lengths[i] and l > 1:
+                    continue
                 w     = context.words[i+l-1]
                 start = offsets[i]
                 end   = offsets[i+l-1] + len(w) - 1
-                ts    = TemporarySpan(char_start=start, char_end=end, sentence=context)
-                if ts not in seen:
+                ts    = spans.get((i, l)) if is_prefix is not None else None
+                if ts is None:
+                    ts = TemporarySpan(char_start=start, char_end=end, sentence=context)
+                if l <= lengths[i] and ts not in seen:
                     seen.add(ts)
                     yield ts
 
@@ -177,6 +299,7 @@ class PretaggedCandidateExtractor(UDFRunner):
     """UDFRunner for PretaggedCandidateExtractorUDF"""
     def __init__(self, candidate_class, entity_types, self_relations=False,
      nested_relations=False, symmetric_relations=True, entity_sep='~@~'):
+        self.candidate_class = candidate_class
         super(PretaggedCandidateExtractor, self).__init__(
             PretaggedCandidateExtractorUDF, candidate_class=candidate_class,
             entity_types=entity_types, self_relations=self_relations,
@@ -190,6 +313,9 @@ class PretaggedCandidateExtractor(UDFRunner):
     def clear(self, session, split, **kwargs):
         session.query(Candidate).filter(Candidate.split == split).delete()
 
+    def get_job_name(self, split=0, **kwargs):
+        return "%s:%s:%s" % (self.__class__.__name__, self.candidate_class.__name__, split)
+
 
 class PretaggedCandidateExtractorUDF(UDF):
     """
@@ -207,8 +333,12 @@ class PretaggedCandidateExtractorUDF(UDF):
 
         super(PretaggedCandidateExtractorUDF, self).__init__(**kwargs)
 
-    def apply(self, context, clear, split, check_for_existing=True, **kwargs):
-        """Extract Candidates from a Context"""
+    @staticmethod
+    def get_input_key(context):
+        return context.stable_id
+
+    def apply(self, context, **kwargs):
+        """Extract Candidate argument tuples, and their entity CIDs, from a Context"""
         # For now, just handle Sentences
         if not isinstance(context, Sentence):
             raise NotImplementedError("%s is currently only implemented for Sentence contexts." % self.__name__)
@@ -227,8 +357,8 @@ class PretaggedCandidateExtractorUDF(UDF):
         # Form entity Spans
         entity_spans = defaultdict(list)
         entity_cids  = {}
-        for et, cid_idxs in entity_idxs.iteritems():
-            for cid, idxs in entity_idxs[et].iteritems():
+        for et, cid_idxs in entity_idxs.items():
+            for cid, idxs in entity_idxs[et].items():
                 while len(idxs) > 0:
                     i          = idxs.pop(0)
                     char_start = context.char_offsets[i]
@@ -237,14 +367,12 @@ class PretaggedCandidateExtractorUDF(UDF):
                         i        = idxs.pop(0)
                         char_end = context.char_offsets[i] + len(context.words[i]) - 1
 
-                    # Insert / load temporary span, also store map to entity CID
+                    # Create temporary span, also store map to entity CID
                     tc = TemporarySpan(char_start=char_start, char_end=char_end, sentence=context)
-                    tc.load_id_or_insert(self.session)
-                    entity_cids[tc.id] = cid
+                    entity_cids[tc] = cid
                     entity_spans[et].append(tc)
 
-        # Generates and persists candidates
-        candidate_args = {'split' : split}
+        # Generates candidate argument tuples; these are persisted by persist_batch
         for args in product(*[enumerate(entity_spans[et]) for et in self.entity_types]):
 
             # TODO: Make this work for higher-order relations
@@ -261,19 +389,21 @@ class PretaggedCandidateExtractorUDF(UDF):
                 elif not self.symmetric_relations and ai > bi:
                     continue
 
-            # Assemble candidate arguments
-            for i, arg_name in enumerate(self.candidate_class.__argnames__):
-                candidate_args[arg_name + '_id'] = args[i][1].id
-                candidate_args[arg_name + '_cid'] = entity_cids[args[i][1].id]
-
-            # Checking for existence
-            if check_for_existing:
-                q = select([self.candidate_class.id])
-                for key, value in candidate_args.items():
-                    q = q.where(getattr(self.candidate_class, key) == value)
-                candidate_id = self.session.execute(q).first()
-                if candidate_id is not None:
-                    continue
-
-            # Add Candidate to session
-            yield self.candidate_class(**candidate_args)
+            spans = tuple(tc for _, tc in args)
+            yield spans, tuple(entity_cids[tc] for tc in spans)
+
+    def persist_batch(self, ys, split, check_for_existing=True, **kwargs):
+        """
+        Inserts the argument Contexts, and then the Candidates, for argument tuples yielded by apply;
+        if check_for_existing is True, the existing Candidates are skipped, as in
+        CandidateExtractorUDF.persist_batch.
+        """
+        load_ids_or_insert(self.session, [arg for args, _ in ys for arg in args])
+        existing = set() if not check_for_existing else load_existing_arg_ids(self.session,
+            self.candidate_class, [[arg.id for arg in args] for args, _ in ys])
+        for args, arg_cids in ys:
+            arg_ids = tuple(arg.id for arg in args)
+            if arg_ids not in existing:
+                existing.add(arg_ids)
+                self.session.add(get_new_candidate(self.session, self.candidate_class, args, split,
+                    check_for_existing=False, arg_cids=arg_cids))
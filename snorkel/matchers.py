@@ -1,3 +1,4 @@
+from bisect import bisect_left, bisect_right
 import os
 import re
 import warnings
@@ -63,13 +64,69 @@ class Matcher(object):
         Apply the Matcher to a **generator** of candidates
         Optionally only takes the longest match (NOTE: assumes this is the *first* match)
         """
-        seen_spans = set()
-        for c in candidates:
-            if self.f(c) and (not self.longest_match_only or not any([self._is_subspan(c, s) for s in seen_spans])):
+        return self._select(c for c in candidates if self.f(c))
+
+    def _select(self, matches):
+        """Yields the matches, or if longest_match_only, those which are not a subspan of an earlier one"""
+        seen_spans = self._seen_spans()
+        for c in matches:
+            if not self.longest_match_only or not seen_spans.covers(c):
                 if self.longest_match_only:
-                    seen_spans.add(self._get_span(c))
+                    seen_spans.add(c)
                 yield c
 
+    def _seen_spans(self):
+        """The structure in which _select keeps the spans of the matches it yields"""
+        return SeenSpans(self)
+
+    def scan_ngrams(self, ngrams, context):
+        """
+        Applies the Matcher to the n-grams of a context generated by the Ngrams candidate space ngrams,
+        i.e. returns apply(ngrams.apply(context)); Matchers which can skip the n-grams which cannot match
+        override this, see Ngrams.scan
+        """
+        return self.apply(ngrams.apply(context))
+
+
+class SeenSpans(object):
+    """The spans of the matches yielded by Matcher._select, each tested in turn with Matcher._is_subspan"""
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.spans   = set()
+
+    def add(self, c):
+        self.spans.add(self.matcher._get_span(c))
+
+    def covers(self, c):
+        return any(self.matcher._is_subspan(c, s) for s in self.spans)
+
+
+class IntervalIndex(object):
+    """
+    The (char_start, char_end) intervals of the candidate Ngrams added, for subspan tests in O(log n).
+    Only the maximal intervals, i.e. those not within another one, are kept, sorted by start: their ends
+    are then sorted too, so an interval contains c iff the last one starting at or before c does not end
+    before c, which is found by binary search.
+    """
+    def __init__(self):
+        self.starts = []
+        self.ends   = []
+
+    def add(self, c):
+        if self.covers(c):
+            return
+        # The intervals within c are those from the first starting at or after c which end at or before c
+        i = bisect_left(self.starts, c.char_start)
+        j = i
+        while j < len(self.ends) and self.ends[j] <= c.char_end:
+            j += 1
+        self.starts[i:j] = [c.char_start]
+        self.ends[i:j]   = [c.char_end]
+
+    def covers(self, c):
+        i = bisect_right(self.starts, c.char_start)
+        return i > 0 and self.ends[i - 1] >= c.char_end
+
 
 WORDS = 'words'
 
@@ -83,6 +140,12 @@ class NgramMatcher(Matcher):
         """Gets a tuple that identifies a span for the specific candidate class that c belongs to"""
         return (c.char_start, c.char_end)
 
+    def _seen_spans(self):
+        """Spans are (char_start, char_end) intervals, so are kept in an IntervalIndex, unless overridden"""
+        if type(self)._is_subspan != NgramMatcher._is_subspan or type(self)._get_span != NgramMatcher._get_span:
+            return super(NgramMatcher, self)._seen_spans()
+        return IntervalIndex()
+
 
 class DictionaryMatch(NgramMatcher):
     """Selects candidate Ngrams that match against a given list d"""
@@ -95,6 +158,9 @@ class DictionaryMatch(NgramMatcher):
         except KeyError:
             raise Exception("Please supply a dictionary (list of phrases) d as d=d.")
 
+        # The sorted phrases, for prefix searches by scan_ngrams; sorted on first use
+        self.sorted_d = None
+
         # Optionally use a stemmer, preprocess the dictionary
         # Note that user can provide *an object having a stem() method*
         self.stemmer = self.opts.get('stemmer', None)
@@ -116,6 +182,25 @@ class DictionaryMatch(NgramMatcher):
         p = self._stem(p) if self.stemmer is not None else p
         return (not self.reverse) if p in self.d else self.reverse
 
+    def _is_prefix(self, c):
+        """Tests if c is the prefix of a phrase of the dictionary, by binary search in the sorted phrases"""
+        if self.sorted_d is None:
+            self.sorted_d = sorted(self.d)
+        p = c.get_attrib_span(self.attrib)
+        p = p.lower() if self.ignore_case else p
+        i = bisect_left(self.sorted_d, p)
+        return i < len(self.sorted_d) and self.sorted_d[i].startswith(p)
+
+    def scan_ngrams(self, ngrams, context):
+        """
+        Only extends the n-grams starting at each token while they are the prefix of a phrase of the
+        dictionary, so that the n-grams tested do not grow with n_max. With a stemmer, with reverse=True
+        or with child Matchers, the matches are not prefixes of phrases, so all n-grams are tested.
+        """
+        if self.stemmer is not None or self.reverse or len(self.children) > 0:
+            return super(DictionaryMatch, self).scan_ngrams(ngrams, context)
+        return self._select(c for c in ngrams.scan(context, self._is_prefix) if self._f(c))
+
 class LambdaFunctionMatch(NgramMatcher):
     """Selects candidate Ngrams that match against a given list d"""
     def init(self):
@@ -0,0 +1,182 @@
+import json
+import logging
+from sqlalchemy import event
+from time import time
+
+
+# Minimum number of seconds between two periodic reports of a run
+METRICS_INTERVAL = 5
+
+
+class MetricsSink(object):
+    """Abstract class for receiving the metrics records reported during a UDFRunner run"""
+    def emit(self, record):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class MemorySink(MetricsSink):
+    """Keeps the metrics records in memory, e.g. for inspection in a notebook"""
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    @property
+    def last(self):
+        return self.records[-1] if len(self.records) > 0 else None
+
+
+class JSONLinesSink(MetricsSink):
+    """Appends the metrics records to a file, one JSON object per line"""
+    def __init__(self, path):
+        self.path = path
+        self.f    = open(path, 'a')
+
+    def emit(self, record):
+        self.f.write(json.dumps(record, sort_keys=True) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class LoggingSink(MetricsSink):
+    """Writes a one-line summary of each metrics record to a logger"""
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('snorkel.metrics')
+        self.level  = level
+
+    def emit(self, record):
+        self.logger.log(self.level,
+            "%s%s: %d inputs (%.1f/s), %d outputs (%.1f/s), queues %s / %s, %d statements, "
+            "%d commits (%.3fs mean)", record['stage'], " [done]" if record['final'] else "",
+            record['inputs'], record['inputs_per_sec'], record['outputs'], record['outputs_per_sec'],
+            record['in_queue'], record['out_queue'], record['statements'], record['commits'],
+            record['commit_latency'])
+
+
+class WorkerMetrics(object):
+    """Counters kept by a single UDF, either running as a process or as the writer / single thread"""
+    def __init__(self, name=None):
+        self.name        = name
+        self.inputs      = 0
+        self.outputs     = 0
+        self.busy        = 0.0
+        self.idle        = 0.0
+        self.statements  = 0
+        self.commits     = 0
+        self.commit_time = 0.0
+        self.last_report = time()
+        self.engine      = None
+
+    def track(self, engine):
+        """Counts the statements issued through the given Engine, until untrack is called"""
+        self.engine = engine
+        event.listen(engine, 'before_cursor_execute', self._count_statement)
+
+    def untrack(self):
+        """Stops counting statements; the listener would otherwise stay on the Engine after the run"""
+        if self.engine is not None:
+            event.remove(self.engine, 'before_cursor_execute', self._count_statement)
+            self.engine = None
+
+    def _count_statement(self, *args, **kwargs):
+        self.statements += 1
+
+    def due(self):
+        """Returns True (and resets the timer) if a periodic report is due"""
+        if time() - self.last_report >= METRICS_INTERVAL:
+            self.last_report = time()
+            return True
+        return False
+
+    def as_dict(self):
+        return {
+            'name'        : self.name,
+            'inputs'      : self.inputs,
+            'outputs'     : self.outputs,
+            'busy'        : self.busy,
+            'idle'        : self.idle,
+            'statements'  : self.statements,
+            'commits'     : self.commits,
+            'commit_time' : self.commit_time,
+        }
+
+
+class RunMetrics(object):
+    """
+    Aggregates the WorkerMetrics of a UDFRunner run, and reports them to the sinks.
+
+    Each record reports, for the stage: the inputs and outputs processed so far and their rates, the
+    depths of the in_queue and out_queue (None if not applicable or not supported by the platform),
+    the busy and idle time of each worker, the number and mean latency of the writer's commits, and the
+    number of DB statements issued by the workers and the writer.
+    """
+    def __init__(self, stage, sinks, in_queue=None, out_queue=None):
+        self.stage       = stage
+        self.sinks       = sinks if type(sinks) in [list, tuple] else [sinks]
+        self.in_queue    = in_queue
+        self.out_queue   = out_queue
+        self.start       = time()
+        self.last_report = self.start
+        self.workers     = {}
+        self.writer      = None
+
+    def update(self, worker):
+        """Records the latest counters of a worker, given as a WorkerMetrics or its as_dict()"""
+        worker = worker.as_dict() if isinstance(worker, WorkerMetrics) else worker
+        self.workers[worker['name']] = worker
+
+    def due(self):
+        """Returns True (and resets the timer) if a periodic report is due"""
+        if time() - self.last_report >= METRICS_INTERVAL:
+            self.last_report = time()
+            return True
+        return False
+
+    def report(self, final=False):
+        elapsed = max(time() - self.start, 1e-9)
+        workers = sorted(self.workers.values(), key=lambda w: w['name'])
+        writer  = self.writer.as_dict() if self.writer is not None else None
+        inputs  = sum(w['inputs'] for w in workers)
+        outputs = sum(w['outputs'] for w in workers)
+        commits = writer['commits'] if writer is not None else sum(w['commits'] for w in workers)
+        commit_time = writer['commit_time'] if writer is not None \
+            else sum(w['commit_time'] for w in workers)
+        statements  = sum(w['statements'] for w in workers)
+        if writer is not None and writer['name'] not in self.workers:
+            statements += writer['statements']
+        record = {
+            'stage'           : self.stage,
+            'time'            : time(),
+            'elapsed'         : elapsed,
+            'final'           : final,
+            'inputs'          : inputs,
+            'outputs'         : outputs,
+            'inputs_per_sec'  : inputs / elapsed,
+            'outputs_per_sec' : outputs / elapsed,
+            'in_queue'        : queue_depth(self.in_queue),
+            'out_queue'       : queue_depth(self.out_queue),
+            'workers'         : dict((w['name'], {'busy': w['busy'], 'idle': w['idle'],
+                                    'inputs': w['inputs'], 'outputs': w['outputs']}) for w in workers),
+            'statements'      : statements,
+            'commits'         : commits,
+            'commit_latency'  : commit_time / commits if commits > 0 else 0.0,
+        }
+        for sink in self.sinks:
+            sink.emit(record)
+        return record
+
+
+def queue_depth(queue):
+    """Returns the approximate size of the queue, or None (qsize is not implemented on e.g. macOS)"""
+    if queue is None:
+        return None
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        return None
@@ -26,7 +26,7 @@ For example, the correct way to define a new type of Context is:
     from snorkel.models.meta import SnorkelBase, snorkel_engine
     SnorkelBase.metadata.create_all(snorkel_engine)
 """
-from .meta import SnorkelBase, SnorkelSession, snorkel_engine, snorkel_postgres
+from .meta import SnorkelBase, SnorkelSession, add_missing_columns, create_missing_indexes, snorkel_engine, snorkel_postgres
 from .context import Context, Document, Sentence, TemporarySpan, Span
 from .context import construct_stable_id, split_stable_id
 from .candidate import Candidate, candidate_subclass, Marginal
@@ -34,7 +34,10 @@ from .annotation import (
     Feature, FeatureKey, Label, LabelKey, GoldLabel, GoldLabelKey, StableLabel,
     Prediction, PredictionKey
 )
+from .job import UDFProgress, UDFQuarantine
 
 # This call must be performed after all classes that extend SnorkelBase are
 # declared to ensure the storage schema is initialized
 SnorkelBase.metadata.create_all(snorkel_engine)
+add_missing_columns(snorkel_engine)
+create_missing_indexes(snorkel_engine)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, Float, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, String, Integer, Float, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import relationship, backref
 
@@ -41,7 +41,8 @@ class GoldLabelKey(AnnotationKeyMixin, SnorkelBase):
 
 
 class LabelKey(AnnotationKeyMixin, SnorkelBase):
-    pass
+    # Fingerprint of the labeling function which generated the Labels, for incremental re-application
+    fingerprint = Column(String)
 
 
 class FeatureKey(AnnotationKeyMixin, SnorkelBase):
@@ -96,6 +97,11 @@ class AnnotationMixin(object):
         return relationship('Candidate', backref=backref(camel_to_under(cls.__name__) + 's', cascade='all, delete-orphan', cascade_backrefs=False),
                             cascade_backrefs=False)
 
+    # The primary key leads with key_id, so we also index by candidate, for loading the annotations of a split
+    @declared_attr
+    def __table_args__(cls):
+        return (Index('ix_%s_candidate_id_key_id' % cls.__tablename__, 'candidate_id', 'key_id'),)
+
     def __repr__(self):
         return self.__class__.__name__ + " (" + str(self.key.name) + " = " + str(self.value) + ")"
 
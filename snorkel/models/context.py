@@ -1,3 +1,5 @@
+from bisect import bisect_right
+
 from .meta import SnorkelBase, snorkel_postgres
 from sqlalchemy import Column, String, Integer, Text, ForeignKey, UniqueConstraint
 from sqlalchemy.dialects import postgresql
@@ -5,6 +7,15 @@ from sqlalchemy.orm import relationship, backref
 from sqlalchemy.types import PickleType
 from sqlalchemy.sql import select, text
 
+from ..utils import chunks
+
+
+# Maximum number of values in an IN clause (SQLite's default limit on host parameters is 999)
+IN_CLAUSE_SIZE = 500
+
+# Number of rows per multi-row INSERT ... RETURNING statement on Postgres
+INSERT_CHUNK_SIZE = 5000
+
 
 class Context(SnorkelBase):
     """
@@ -137,7 +148,11 @@ class TemporaryContext(object):
 
     A TemporaryContext must have specified equality / set membership semantics, a stable_id for checking
     uniqueness against the database, and a promote() method which returns a corresponding Context object.
+
+    As many TemporaryContexts are generated per Context, they declare __slots__ instead of having a __dict__.
     """
+    __slots__ = ('id',)
+
     def __init__(self):
         self.id = None
 
@@ -182,12 +197,16 @@ class TemporaryContext(object):
 
 class TemporarySpan(TemporaryContext):
     """The TemporaryContext version of Span"""
+    __slots__ = ('sentence', 'char_start', 'char_end', 'meta', '_word_start', '_word_end')
+
     def __init__(self, sentence, char_start, char_end, meta=None):
         super(TemporarySpan, self).__init__()
         self.sentence     = sentence  # The sentence Context of the Span
         self.char_end   = char_end
         self.char_start = char_start
         self.meta       = meta
+        self._word_start = None
+        self._word_end   = None
 
     def __len__(self):
         return self.char_end - self.char_start + 1
@@ -227,24 +246,25 @@ class TemporarySpan(TemporaryContext):
                 'char_end'  : self.char_end,
                 'meta'      : self.meta}
 
+    # The word indexes are computed on first use (Spans loaded from the DB do not call __init__)
     def get_word_start(self):
-        return self.char_to_word_index(self.char_start)
+        if getattr(self, '_word_start', None) is None:
+            self._word_start = self.char_to_word_index(self.char_start)
+        return self._word_start
 
     def get_word_end(self):
-        return self.char_to_word_index(self.char_end)
+        if getattr(self, '_word_end', None) is None:
+            self._word_end = self.char_to_word_index(self.char_end)
+        return self._word_end
 
     def get_n(self):
         return self.get_word_end() - self.get_word_start() + 1
 
     def char_to_word_index(self, ci):
         """Given a character-level index (offset), return the index of the **word this char is in**"""
-        i = None
-        for i, co in enumerate(self.sentence.char_offsets):
-            if ci == co:
-                return i
-            elif ci < co:
-                return i-1
-        return i
+        # The char_offsets are sorted, so this is the last word starting at or before ci
+        offsets = self.sentence.char_offsets
+        return bisect_right(offsets, ci) - 1 if len(offsets) > 0 else None
 
     def word_to_char_index(self, wi):
         """Given a word-level index, return the character-level index (offset) of the word's start"""
@@ -360,3 +380,50 @@ def construct_stable_id(parent_context, polymorphic_type, relative_char_offset_s
     start = parent_doc_char_start + relative_char_offset_start
     end   = parent_doc_char_start + relative_char_offset_end
     return "%s::%s:%s:%s" % (doc_id, polymorphic_type, start, end)
+
+
+def load_ids_or_insert(session, temp_contexts):
+    """
+    Sets the ids of TemporaryContexts, as load_id_or_insert does, but in bulk: the ids of those already
+    in the DB are loaded by stable id, with one IN query per IN_CLAUSE_SIZE contexts, and the missing
+    ones are inserted with one multi-row statement per table, rather than three statements per context.
+    TemporaryContexts with the same stable id (e.g. equal Spans) get the same id.
+    """
+    by_stable_id = {}
+    for tc in temp_contexts:
+        if tc.id is None:
+            by_stable_id.setdefault(tc.get_stable_id(), []).append(tc)
+    if len(by_stable_id) == 0:
+        return
+
+    # Load the ids of the existing contexts
+    ids = {}
+    for stable_ids in chunks(list(by_stable_id), IN_CLAUSE_SIZE):
+        ids.update(session.execute(select([Context.stable_id, Context.id])
+                                   .where(Context.stable_id.in_(stable_ids))).fetchall())
+
+    # Insert the missing contexts; on Postgres the ids are returned by the INSERT, otherwise they are
+    # loaded back by stable id
+    missing = [(stable_id, tcs[0]) for stable_id, tcs in by_stable_id.items() if stable_id not in ids]
+    rows    = [{'type': tc._get_table_name(), 'stable_id': stable_id} for stable_id, tc in missing]
+    if snorkel_postgres:
+        for rows_chunk in chunks(rows, INSERT_CHUNK_SIZE):
+            ids.update(session.execute(Context.__table__.insert().values(rows_chunk)
+                                       .returning(Context.stable_id, Context.id)).fetchall())
+    elif len(rows) > 0:
+        session.execute(Context.__table__.insert(), rows)
+        for stable_ids in chunks([stable_id for stable_id, _ in missing], IN_CLAUSE_SIZE):
+            ids.update(session.execute(select([Context.stable_id, Context.id])
+                                       .where(Context.stable_id.in_(stable_ids))).fetchall())
+
+    # Then the rows of their own tables, with one executemany per insert query
+    inserts = {}
+    for stable_id, tc in missing:
+        insert_args       = tc._get_insert_args()
+        insert_args['id'] = ids[stable_id]
+        inserts.setdefault(tc._get_insert_query(), []).append(insert_args)
+    for query, insert_args in inserts.items():
+        session.execute(text(query), insert_args)
+    for stable_id, tcs in by_stable_id.items():
+        for tc in tcs:
+            tc.id = ids[stable_id]
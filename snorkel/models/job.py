@@ -0,0 +1,34 @@
+from sqlalchemy import Column, Float, String, Text
+
+from .meta import SnorkelBase
+
+
+class UDFProgress(SnorkelBase):
+    """
+    Records an input which a UDFRunner job has finished processing, so that the job can be resumed.
+
+    The job is a name identifying the UDFRunner and its arguments (e.g. the split), and the key is a
+    stable identifier of the input, e.g. a Document or Context stable_id, or a Candidate id.
+    """
+    __tablename__ = 'udf_progress'
+    job           = Column(String, primary_key=True)
+    key           = Column(String, primary_key=True)
+
+    def __repr__(self):
+        return "%s (%s : %s)" % (self.__class__.__name__, self.job, self.key)
+
+
+class UDFQuarantine(SnorkelBase):
+    """
+    Records an input on which a UDFRunner job failed, with the exception raised, so that the job can
+    go on without it, and the failed inputs can be inspected and retried later.
+    """
+    __tablename__ = 'udf_quarantine'
+    job           = Column(String, primary_key=True)
+    key           = Column(String, primary_key=True)
+    exception     = Column(String)
+    traceback     = Column(Text)
+    elapsed       = Column(Float)
+
+    def __repr__(self):
+        return "%s (%s : %s : %s)" % (self.__class__.__name__, self.job, self.key, self.exception)
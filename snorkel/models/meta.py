@@ -1,8 +1,14 @@
+import csv
+import numpy as np
 import os
-from sqlalchemy import create_engine, event
+from sqlalchemy import create_engine, event, inspect, select
 from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 # Sets connection string
 snorkel_conn_string = os.environ['SNORKELDB'] if 'SNORKELDB' in os.environ and os.environ['SNORKELDB'] != '' \
@@ -22,22 +28,183 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
         cursor.close()
 
 
+def set_sqlite_query_only(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+
 # Defines procedure for setting up a sessionmaker
-def new_sessionmaker():
+def new_sessionmaker(read_only=False):
     
     # Turning on autocommit for Postgres, see http://oddbird.net/2014/06/14/sqlalchemy-postgres-autocommit/
     # Otherwise any e.g. query starts a transaction, locking tables... very bad for e.g. multiple notebooks
     # open, multiple processes, etc.
     if snorkel_postgres:
-        snorkel_engine = create_engine(snorkel_conn_string, isolation_level="AUTOCOMMIT")
+        connect_args = {'options': '-c default_transaction_read_only=on'} if read_only else {}
+        snorkel_engine = create_engine(snorkel_conn_string, isolation_level="AUTOCOMMIT",
+                                       connect_args=connect_args)
     else:
         snorkel_engine = create_engine(snorkel_conn_string)
+        if read_only:
+            event.listen(snorkel_engine, "connect", set_sqlite_query_only)
 
     # New sessionmaker
     SnorkelSession = sessionmaker(bind=snorkel_engine)
     return SnorkelSession
 
 
+def begin_transaction(session):
+    """
+    Starts an explicit transaction on the session, so that everything up to its next commit is
+    atomic; on Postgres, this overrides the AUTOCOMMIT isolation level for that transaction.
+    """
+    if snorkel_postgres:
+        session.connection(execution_options={'isolation_level': 'READ COMMITTED'})
+
+
+def stream_query(query, batch_size=1000):
+    """
+    Iterates over the rows of a Query without loading them all into memory.
+
+    Rows are fetched in batches over a dedicated connection, opened by whichever thread first
+    iterates; on Postgres this is a server-side cursor, which needs a transaction, so the
+    connection is taken out of AUTOCOMMIT mode.
+    """
+    for rows in stream_query_batches(query, batch_size):
+        for row in rows:
+            yield tuple(row)
+
+
+def stream_query_batches(query, batch_size=1000, raw=False):
+    """
+    Iterates over the rows of a Query in lists of (at most) batch_size rows; see stream_query.
+    If raw is True, the rows are fetched directly from the DBAPI cursor, as plain tuples, without any
+    of SQLAlchemy's result processing; this is much faster, e.g. for numeric columns.
+    """
+    connection = query.session.get_bind().connect()
+    if snorkel_postgres:
+        connection = connection.execution_options(isolation_level="READ COMMITTED", stream_results=True)
+    try:
+        result = connection.execute(query.statement)
+        cursor = result.cursor if raw else result
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+        result.close()
+    finally:
+        connection.close()
+
+
+def stream_ids(query, batch_size=1000):
+    """
+    Iterates over the distinct values of the first column of a Query, e.g. candidate ids, in increasing
+    order, as 1-tuples like stream_query.
+
+    Unlike stream_query, no cursor is held open between batches: each batch is selected by its own
+    keyset-paged query (WHERE id > last id ORDER BY id LIMIT batch_size), over a connection which is
+    then closed. The caller can thus commit while iterating, which an open read blocks on SQLite.
+    """
+    engine = query.session.get_bind()
+    column = list(query.subquery().c)[0]
+    last   = None
+    while True:
+        q = select([column]).distinct().order_by(column).limit(batch_size)
+        if last is not None:
+            q = q.where(column > last)
+        connection = engine.connect()
+        try:
+            rows = connection.execute(q).fetchall()
+        finally:
+            connection.close()
+        if len(rows) == 0:
+            return
+        for row in rows:
+            yield tuple(row)
+        last = rows[-1][0]
+
+
+def load_columns(query, dtypes, batch_size=100000):
+    """
+    Loads the result of a Query of numeric columns as one numpy array per column, of the given
+    dtypes, e.g. to build a sparse matrix with vectorized operations; the rows are streamed, and
+    converted batch by batch.
+    """
+    columns = [[np.zeros(0, dtype=dtype)] for dtype in dtypes]
+    for rows in stream_query_batches(query, batch_size, raw=True):
+        # Note: all columns are converted at once, to int64 or else float64 (exact for ids < 2^53)
+        rows = np.array(rows)
+        for i, dtype in enumerate(dtypes):
+            columns[i].append(rows[:, i].astype(dtype))
+    return [np.concatenate(column) for column in columns]
+
+
+def insert_columns(session, table, columns, batch_size=100000):
+    """
+    Inserts rows given as columns, i.e. as a list of (column name, array or list) pairs, into a Table,
+    in batches; this is the counterpart of load_columns. On Postgres, each batch is sent with COPY,
+    within the session's transaction; otherwise, with an executemany.
+    """
+    names   = [name for name, _ in columns]
+    values  = [np.asarray(column).tolist() for _, column in columns]
+    n_rows  = len(values[0]) if len(values) > 0 else 0
+    dialect = session.get_bind().dialect
+    quote   = dialect.identifier_preparer.quote
+    columns = ', '.join(quote(name) for name in names)
+    for start in range(0, n_rows, batch_size):
+        rows = zip(*[column[start:start + batch_size] for column in values])
+        if snorkel_postgres:
+            f = StringIO()
+            csv.writer(f).writerows(rows)
+            f.seek(0)
+            cursor = session.connection().connection.cursor()
+            cursor.copy_expert("COPY %s (%s) FROM STDIN WITH CSV" % (quote(table.name), columns), f)
+            cursor.close()
+
+        # With positional parameters (e.g. SQLite), we skip SQLAlchemy's processing of each row
+        elif dialect.paramstyle == 'qmark':
+            cursor = session.connection().connection.cursor()
+            cursor.executemany("INSERT INTO %s (%s) VALUES (%s)" % (quote(table.name), columns,
+                ', '.join('?' for _ in names)), rows)
+            cursor.close()
+        else:
+            session.execute(table.insert(), [dict(zip(names, row)) for row in rows])
+
+
+def add_missing_columns(engine):
+    """
+    Adds the nullable columns declared on tables which already exist in the database, e.g. columns
+    introduced since the database was created; create_all does not alter existing tables.
+    """
+    inspector = inspect(engine)
+    tables    = set(inspector.get_table_names())
+    quote     = engine.dialect.identifier_preparer.quote
+    for table in SnorkelBase.metadata.sorted_tables:
+        if table.name in tables:
+            existing = set(column['name'] for column in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    engine.execute("ALTER TABLE %s ADD COLUMN %s %s" % (quote(table.name),
+                        quote(column.name), column.type.compile(dialect=engine.dialect)))
+
+
+def create_missing_indexes(engine):
+    """
+    Creates the indexes declared on tables which already exist in the database; create_all only
+    creates the indexes of the tables it creates, so this adds new indexes to existing databases.
+    """
+    inspector = inspect(engine)
+    tables    = set(inspector.get_table_names())
+    for table in SnorkelBase.metadata.sorted_tables:
+        if table.name in tables and len(table.indexes) > 0:
+            existing = set(index['name'] for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(engine)
+
+
 # We initialize the engine within the models module because models' schema can depend on
 # which data types are supported by the engine
 SnorkelSession = new_sessionmaker()
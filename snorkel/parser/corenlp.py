@@ -5,7 +5,6 @@ import json
 import signal
 import socket
 import string
-import warnings
 
 from subprocess import Popen,PIPE
 from collections import defaultdict
@@ -222,8 +221,9 @@ class StanfordCoreNLPServer(Parser):
 
         try:
             blocks = json.loads(content, strict=False)['sentences']
-        except:
-            warnings.warn("CoreNLP skipped a malformed document.", RuntimeWarning)
+        except (ValueError, KeyError):
+            raise ValueError("CoreNLP returned a malformed response for document {0}.".format(
+                document.name if document else "?"))
 
         position = 0
         for block in blocks:
@@ -26,9 +26,20 @@ class CorpusParserUDF(UDF):
         self.req_handler = parser.connect()
         self.fn = fn
 
+    @staticmethod
+    def get_input_key(x):
+        doc, text = x
+        return doc.stable_id
+
     def apply(self, x, **kwargs):
         """Given a Document object and its raw text, parse into Sentences"""
         doc, text = x
         for parts in self.req_handler.parse(doc, text):
             parts = self.fn(parts) if self.fn is not None else parts
             yield Sentence(**parts)
+
+    def discard_batch(self, xs, **kwargs):
+        """Detaches the new Sentences of a failed batch from their Documents, which would persist them"""
+        for doc, text in xs:
+            for sentence in [sentence for sentence in doc.sentences if sentence.id is None]:
+                doc.sentences.remove(sentence)
@@ -1,15 +1,37 @@
-from multiprocessing import Process, JoinableQueue
+from multiprocessing import Event, Process, Queue
+from threading import Event as ThreadEvent, Thread
+from time import time
+import traceback
 try:
-    from queue import Empty
+    from queue import Empty, Full, Queue as ThreadQueue
 except:
-    from Queue import Empty
+    from Queue import Empty, Full, Queue as ThreadQueue
 
-from .models.meta import new_sessionmaker, snorkel_conn_string
+from .metrics import RunMetrics, WorkerMetrics
+from .models.job import UDFProgress, UDFQuarantine
+from .models.meta import begin_transaction, new_sessionmaker, snorkel_conn_string, snorkel_engine
 from .utils import ProgressBar
 
 
 QUEUE_TIMEOUT = 3
 
+# Kinds of the messages sent by the UDF processes on the out_queue
+OUTPUTS, METRICS, DONE, ERROR = 'outputs', 'metrics', 'done', 'error'
+
+BACKENDS = ('process', 'thread')
+
+# Maximum number of inputs buffered in the in_queue ahead of the UDF processes;
+# bounds the memory of apply_mt independently of the size of xs
+IN_QUEUE_MAX_SIZE = 1000
+
+# Maximum number of messages (e.g. the outputs of a batch) buffered in the out_queue; when the writer
+# falls behind, the UDF processes block rather than the outputs piling up in memory
+OUT_QUEUE_MAX_SIZE = 100
+
+# The writer commits after about this many inputs; when checkpointing, so do the UDF processes
+# (or single thread)
+CHECKPOINT_SIZE = 1000
+
 
 class UDFRunner(object):
     """Class to run UDFs in parallel using simple queue-based multiprocessing setup"""
@@ -23,12 +45,49 @@ class UDFRunner(object):
         else:
             self.reducer = None
 
-    def apply(self, xs, clear=True, parallelism=None, progress_bar=True, count=None, **kwargs):
+    def apply(self, xs, clear=True, parallelism=None, progress_bar=True, count=None, batch_size=1,
+        single_writer=None, checkpoint=False, resume=False, metrics=None, backend='process',
+        quarantine=False, retry_quarantined=False, **kwargs):
         """
-        Apply the given UDF to the set of objects xs, either single or multi-threaded, 
+        Apply the given UDF to the set of objects xs, either single or multi-threaded,
         and optionally calling clear() first.
+
+        batch_size: Number of input objects handed to UDF.apply_batch at once; in the
+            multi-threaded setting, this is also the number of inputs per queue message, with the
+            outputs of each batch sent back as a single message.
+        single_writer: If True, the UDF processes only compute, using read-only connections, and
+            all their outputs are persisted by this process. Defaults to True for SQLite, which
+            does not support concurrent writers, and to False otherwise. Note that on SQLite, this
+            switches the database to WAL journal mode, so that the UDF processes can keep reading
+            while the writer commits; the journal mode is stored in the database file, so stays set
+            after the run (PRAGMA journal_mode=DELETE reverts it).
+        checkpoint: If True, the keys of the inputs that have been processed are recorded in the
+            UDFProgress table, committed together with their outputs.
+        resume: If True, skips the inputs recorded as done by a previous checkpointed run of the
+            same job, and never clears; implies checkpoint=True.
+        metrics: A MetricsSink, or list of MetricsSinks, to periodically report the throughput, queue
+            depths, worker busy / idle times, commit latency and DB statements of the run to.
+        backend: How to run the UDF in parallel: 'process' forks a UDF process per unit of parallelism;
+            'thread' runs the UDFs as threads of this process, sharing one Engine. Threads suit I/O-bound
+            UDFs, e.g. CorpusParser with a CoreNLP server, where parallelism can well exceed the number
+            of cores, as the UDFs mostly wait on the server. There is no 'async' backend (it was dropped,
+            as UDF.apply is synchronous): use 'thread' with a high parallelism instead.
+        quarantine: If True, the inputs on which the UDF raises an exception are skipped, and recorded
+            with the exception in the UDFQuarantine table, instead of aborting the run; a batch which
+            raises is re-applied one input at a time, to find the inputs to skip.
+        retry_quarantined: If True, only applies the UDF to the inputs quarantined by previous runs
+            of the same job, and never clears; implies quarantine=True.
         """
+        job = None
+        if checkpoint or resume or quarantine or retry_quarantined:
+            job = self.get_job_name(**kwargs)
+        checkpoint = checkpoint or resume
+        quarantine = quarantine or retry_quarantined
+
         # Clear everything downstream of this UDF if requested
+        # When resuming or retrying, the outputs of the previous runs are kept, and may be updated
+        if resume or retry_quarantined:
+            clear = False
         if clear:
             print("Clearing existing...")
             SnorkelSession = new_sessionmaker()
@@ -37,134 +96,541 @@ class UDFRunner(object):
             session.commit()
             session.close()
 
+        # Load the inputs already done, or forget them if starting the job over
+        # When retrying, only the quarantined inputs are applied, so they are no longer done
+        if job is not None:
+            SnorkelSession = new_sessionmaker()
+            session = SnorkelSession()
+            progress    = session.query(UDFProgress).filter(UDFProgress.job == job)
+            quarantined = session.query(UDFQuarantine).filter(UDFQuarantine.job == job)
+            if retry_quarantined:
+                retry = frozenset(key for key, in quarantined.with_entities(UDFQuarantine.key))
+                print("Retrying %s quarantined inputs..." % len(retry))
+                progress.filter(UDFProgress.key.in_(quarantined.with_entities(UDFQuarantine.key)))\
+                        .delete(synchronize_session=False)
+                quarantined.delete(synchronize_session=False)
+                count = len(retry)
+                xs    = self._filter_inputs(xs, retry, keep=True)
+            elif resume:
+                done = frozenset(key for key, in progress.with_entities(UDFProgress.key))
+                print("Resuming, skipping %s inputs already done..." % len(done))
+                if count is None and hasattr(xs, '__len__'):
+                    count = len(xs)
+                count = max(0, count - len(done)) if count is not None else None
+                xs = self._filter_inputs(xs, done, keep=False)
+            else:
+                progress.delete(synchronize_session=False)
+                quarantined.delete(synchronize_session=False)
+            session.commit()
+            session.close()
+
+        # The job name is passed on as checkpoint and / or quarantine job
+        quarantine = job if quarantine else None
+        job        = job if checkpoint else None
+
         # Execute the UDF
         print("Running UDF...")
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend %s; must be one of %s." % (backend, ', '.join(BACKENDS)))
         if parallelism is None or parallelism < 2:
-            self.apply_st(xs, progress_bar, clear=clear, count=count, **kwargs)
+            self.apply_st(xs, progress_bar, clear=clear, count=count, batch_size=batch_size, job=job,
+                metrics=metrics, quarantine=quarantine, **kwargs)
         else:
-            self.apply_mt(xs, parallelism, clear=clear, **kwargs)
+            if single_writer is None:
+                single_writer = snorkel_conn_string.startswith('sqlite')
+            self.apply_mt(xs, parallelism, clear=clear, batch_size=batch_size,
+                single_writer=single_writer, job=job, metrics=metrics, backend=backend,
+                quarantine=quarantine, **kwargs)
+
+        # Report the quarantined inputs
+        if quarantine is not None:
+            SnorkelSession = new_sessionmaker()
+            session = SnorkelSession()
+            n_quarantined = session.query(UDFQuarantine).filter(UDFQuarantine.job == quarantine).count()
+            session.close()
+            if n_quarantined > 0:
+                print("%s inputs quarantined; see UDFQuarantine, or retry with retry_quarantined=True." % n_quarantined)
 
     def clear(self, session, **kwargs):
         raise NotImplementedError()
 
-    def apply_st(self, xs, progress_bar, count, **kwargs):
+    def get_job_name(self, **kwargs):
+        """Returns the name under which the progress and the quarantined inputs of a run are recorded"""
+        return self.__class__.__name__
+
+    def _filter_inputs(self, xs, keys, keep):
+        """Yields the inputs whose key is in keys if keep is True, or is not in keys otherwise"""
+        for x in xs:
+            if (self.udf_class.get_input_key(x) in keys) == keep:
+                yield x
+
+    def apply_st(self, xs, progress_bar, count, batch_size=1, job=None, metrics=None, quarantine=None,
+        **kwargs):
         """Run the UDF single-threaded, optionally with progress bar"""
-        udf = self.udf_class(**self.udf_init_kwargs)
+        udf            = self.udf_class(**self.udf_init_kwargs)
+        udf.quarantine = quarantine
+
+        # Set up metrics reporting if requested; the single UDF is both the worker and the writer
+        run_metrics = None
+        if metrics is not None:
+            udf.metrics.name = 'main'
+            udf.metrics.track(udf.session.get_bind())
+            run_metrics        = RunMetrics(self.__class__.__name__, metrics)
+            run_metrics.writer = udf.metrics
 
         # Set up ProgressBar if possible
         pb = None
         if progress_bar and hasattr(xs, '__len__') or count is not None:
             n = count if count is not None else len(xs)
             pb = ProgressBar(n)
-        
+
         # Run single-thread
-        for i, x in enumerate(xs):
+        i = 0
+        done, failed = [], []
+        if job is not None:
+            begin_transaction(udf.session)
+        for batch in batches(xs, batch_size):
             if pb:
-                pb.bar(i)
+                for j in range(i, i + len(batch)):
+                    pb.bar(j)
+            i += len(batch)
 
             # Apply UDF and add results to the session
-            for y in udf.apply(x, **kwargs):
-                
-                # Uf UDF has a reduce step, this will take care of the insert; else add to session
+            t = time()
+            chunks, failures = udf.apply_or_quarantine(batch, **kwargs)
+            failed.extend(failures)
+
+            # If UDF has a reduce step, this will take care of the insert; else add to session
+            for ys in chunks:
                 if hasattr(self.udf_class, 'reduce'):
-                    udf.reduce(y, **kwargs)
+                    udf.reduce_batch(ys, **kwargs)
                 else:
-                    udf.session.add(y)
+                    udf.persist_batch(ys, **kwargs)
+                udf.metrics.outputs += udf.count_outputs(ys)
+            udf.metrics.inputs += len(batch)
+            udf.metrics.busy   += time() - t
+            if run_metrics is not None and udf.metrics.due():
+                run_metrics.update(udf.metrics)
+                run_metrics.report()
+
+            # Periodically commit the outputs along with the progress, if checkpointing
+            if job is not None:
+                done.extend(udf.get_input_key(x) for x in batch)
+                if len(done) >= CHECKPOINT_SIZE:
+                    udf.commit(job, done, failed, **kwargs)
+                    done, failed = [], []
 
         # Commit session and close progress bar if applicable
-        udf.session.commit()
+        udf.commit(job, done, failed, **kwargs)
         if pb:
             pb.close()
-        
-    def apply_mt(self, xs, parallelism, **kwargs):
-        """Run the UDF multi-threaded using python multiprocessing"""
-        if snorkel_conn_string.startswith('sqlite'):
-            raise ValueError('Multiprocessing with SQLite is not supported. Please use a different database backend,'
-                             ' such as PostgreSQL.')
-
-        # Fill a JoinableQueue with input objects
-        in_queue = JoinableQueue()
-        for x in xs:
-            in_queue.put(x)
+        if run_metrics is not None:
+            udf.metrics.untrack()
+            run_metrics.update(udf.metrics)
+            run_metrics.report(final=True)
+
+    def apply_mt(self, xs, parallelism, batch_size=1, single_writer=False, job=None, metrics=None,
+        backend='process', quarantine=None, **kwargs):
+        """
+        Run the UDF multi-threaded using python multiprocessing, or using threads if backend='thread'
+
+        If single_writer is True, the UDF processes get read-only sessions, and all outputs are sent
+        back to be reduced / persisted by a single writer on this thread, in batched transactions.
+
+        The UDF processes report to this thread over a single out_queue: the outputs of each batch (if
+        there is a writer), their metrics, and finally either their completion or the traceback of the
+        exception they failed with; in the latter case, the run is aborted with a RuntimeError.
+        """
+        if snorkel_conn_string.startswith('sqlite') and not single_writer:
+            raise ValueError('Multiprocessing with SQLite is only supported with single_writer=True.')
+
+        # With threads, the queues need not be shared between processes, and the UDFs share one Engine
+        # (and thus one connection pool); with processes, each UDF starts its own Engine
+        threaded = backend == 'thread'
+        if threaded:
+            QueueClass, EventClass, SnorkelSession = ThreadQueue, ThreadEvent, new_sessionmaker(read_only=single_writer)
+        else:
+            QueueClass, EventClass, SnorkelSession = Queue, Event, None
+
+        # Stream the input objects into a bounded queue from a producer thread,
+        # so that the UDF processes can start right away and xs can be any iterator
+        # (e.g. a server-side cursor or a DocPreprocessor generator)
+        # The producer ends the stream with one sentinel per UDF process
+        in_queue  = QueueClass(IN_QUEUE_MAX_SIZE)
+        out_queue = QueueClass(OUT_QUEUE_MAX_SIZE)
+        stop      = EventClass()
+        producer  = Thread(target=self._fill_queue,
+                           args=(batches(xs, batch_size), in_queue, parallelism, stop))
+        producer.daemon = True
 
-        # If the UDF has a reduce step, we collect the output of apply in a Queue
-        out_queue = None
+        # If the UDF has a reduce step, or there is a single writer, we collect the output of apply
+        # in the out_queue, and write it from this thread
+        writer = None
         if hasattr(self.udf_class, 'reduce'):
-            out_queue = JoinableQueue()
+            writer = self.reducer
+        elif single_writer:
+            writer = self.udf_class(**self.udf_init_kwargs)
 
-        # Start UDF Processes
+        # With SQLite, WAL mode lets the read-only UDF processes keep reading while the writer commits
+        # Note: this persists in the database file, see apply
+        if single_writer and snorkel_conn_string.startswith('sqlite'):
+            snorkel_engine.execute('PRAGMA journal_mode=WAL')
+
+        # If metrics are requested, the UDF processes periodically send their counters back
+        run_metrics = None
+        if metrics is not None:
+            run_metrics = RunMetrics(self.__class__.__name__, metrics, in_queue=in_queue,
+                                     out_queue=out_queue)
+            # The reducer is kept between runs, so its counters are reset
+            if writer is not None:
+                writer.metrics = WorkerMetrics('writer')
+                writer.metrics.track(writer.session.get_bind())
+                run_metrics.writer = writer.metrics
+
+        # Start UDF Processes, or Threads running the UDFs
+        workers = []
         for i in range(parallelism):
-            udf              = self.udf_class(in_queue=in_queue, out_queue=out_queue, **self.udf_init_kwargs)
-            udf.apply_kwargs = kwargs
+            udf                = self.udf_class(in_queue=in_queue, out_queue=out_queue,
+                                                read_only=single_writer, sessionmaker=SnorkelSession,
+                                                **self.udf_init_kwargs)
+            udf.apply_kwargs   = kwargs
+            udf.job            = job
+            udf.quarantine     = quarantine
+            udf.send_outputs   = writer is not None
+            udf.report_metrics = metrics is not None
+            if metrics is not None:
+                udf.metrics.name = udf.name
+                # With threads, the statements on the shared Engine are all counted by the first UDF
+                if not threaded or i == 0:
+                    udf.metrics.track(udf.session.get_bind())
             self.udfs.append(udf)
+            if threaded:
+                worker        = Thread(target=udf.run, name=udf.name)
+                worker.daemon = True
+                workers.append(worker)
+            else:
+                workers.append(udf)
 
-        # Start the UDF processes, and then join on their completion
-        for udf in self.udfs:
-            udf.start()
+        # Start the UDF processes and the producer
+        self._producer_error = None
+        for worker in workers:
+            worker.start()
+        producer.start()
 
-        # If there is a reduce step, do now on this thread
-        if hasattr(self.udf_class, 'reduce'):
-            while any([udf.is_alive() for udf in self.udfs]):
-                while True:
-                    try:
-                        y = out_queue.get(True, QUEUE_TIMEOUT)
-                        self.reducer.reduce(y, **kwargs)
-                        out_queue.task_done()
-                    except Empty:
-                        break
-                self.reducer.session.commit()
-            self.reducer.session.close()
-
-        # Otherwise just join on the UDF.apply actions
-        else:
-            for i, udf in enumerate(self.udfs):
-                udf.join()
+        # Handle the messages of the UDF processes until they have all completed
+        # If there is a reduce step or a single writer, this is where it is done
+        finished     = set()
+        done, failed = [], []
+        n            = 0
+        if writer is not None and job is not None:
+            begin_transaction(writer.session)
+        try:
+            while len(finished) < len(workers):
+                try:
+                    message = out_queue.get(True, QUEUE_TIMEOUT)
+                except Empty:
+                    # Only used to notice UDF processes which died without reporting, e.g. killed
+                    for worker in workers:
+                        if worker.name not in finished and not worker.is_alive():
+                            raise RuntimeError("UDF process %s exited unexpectedly." % worker.name)
+                    message = (None,)
+                if message[0] == OUTPUTS:
+                    keys, chunks, failures = message[1:]
+                    for ys in chunks:
+                        if hasattr(self.udf_class, 'reduce'):
+                            writer.reduce_batch(ys, **kwargs)
+                        else:
+                            writer.persist_batch(ys, **kwargs)
+                    if keys is not None:
+                        done.extend(keys)
+                    failed.extend(failures)
+                    n += 1
+                    if n * batch_size >= CHECKPOINT_SIZE:
+                        writer.commit(job, done, failed, **kwargs)
+                        done, failed = [], []
+                        n            = 0
+                elif message[0] == METRICS:
+                    if run_metrics is not None:
+                        run_metrics.update(message[1])
+                elif message[0] == DONE:
+                    finished.add(message[1])
+                    if run_metrics is not None:
+                        run_metrics.update(message[2])
+                elif message[0] == ERROR:
+                    raise RuntimeError("UDF process %s failed:\n%s" % message[1:])
+                if run_metrics is not None and run_metrics.due():
+                    run_metrics.report()
+            if writer is not None:
+                writer.commit(job, done, failed, **kwargs)
+        finally:
+            if writer is not None:
+                writer.metrics.untrack()
+                writer.session.close()
+            if len(finished) < len(workers):
+                self._abort(workers, in_queue, out_queue, stop, threaded)
+            producer.join()
+            for worker in workers:
+                worker.join()
+            self.udfs = []
+
+        if run_metrics is not None:
+            run_metrics.report(final=True)
+        if self._producer_error is not None:
+            raise self._producer_error
+
+    def _abort(self, workers, in_queue, out_queue, stop, threaded):
+        """Stops the producer and the UDF processes of a failed run"""
+        stop.set()
+        if not threaded:
+            for worker in workers:
+                worker.terminate()
+
+            # Nothing will read the pending inputs anymore, so we must not wait to flush them on exit
+            in_queue.cancel_join_thread()
+            return
+
+        # Threads cannot be terminated, so we replace the pending inputs with sentinels; each thread
+        # then exits once done with its current batch, and its messages are discarded so that it does
+        # not block on the (bounded) out_queue
+        while True:
+            try:
+                in_queue.get_nowait()
+            except Empty:
+                break
+        for worker in workers:
+            in_queue.put(None)
+        while any(worker.is_alive() for worker in workers):
+            try:
+                out_queue.get(True, 0.1)
+            except Empty:
+                pass
 
-        # Terminate and flush the processes
-        for udf in self.udfs:
-            udf.terminate()
-        self.udfs = []
+    def _fill_queue(self, xs, in_queue, n_sentinels, stop):
+        """
+        Feeds the input objects to the in_queue, followed by n_sentinels end-of-stream sentinels;
+        blocks while the queue is full, and returns early if stop is set
+        """
+        try:
+            for x in xs:
+                if not put_unless_stopped(in_queue, x, stop):
+                    return
+        except Exception as e:
+            self._producer_error = e
+        for i in range(n_sentinels):
+            if not put_unless_stopped(in_queue, None, stop):
+                return
 
 
 class UDF(Process):
-    def __init__(self, in_queue=None, out_queue=None):
+    def __init__(self, in_queue=None, out_queue=None, read_only=False, sessionmaker=None):
         """
-        in_queue: A Queue of input objects to process; primarily for running in parallel
+        in_queue: A Queue of input batches to process, ended by a None sentinel; primarily for
+            running in parallel
+        out_queue: A Queue of messages to the parent: the outputs of each batch (if send_outputs),
+            the metrics (if report_metrics), and finally either completion or the error traceback
+        read_only: If True, the UDF gets a read-only session; its outputs must then be sent to the
+            out_queue, to be persisted by a single writer
+        sessionmaker: The sessionmaker to create the UDF's session with, e.g. shared by UDFs running
+            as threads; by default, a new one is created
         """
         Process.__init__(self)
-        self.daemon       = True
-        self.in_queue     = in_queue
-        self.out_queue    = out_queue
+        self.daemon    = True
+        self.in_queue  = in_queue
+        self.out_queue = out_queue
 
-        # Each UDF starts its own Engine
+        # Each UDF starts its own Engine, unless given a sessionmaker to share one (e.g. between threads)
         # See http://docs.sqlalchemy.org/en/latest/core/pooling.html#using-connection-pools-with-multiprocessing
-        SnorkelSession = new_sessionmaker()
+        SnorkelSession = sessionmaker or new_sessionmaker(read_only=read_only)
         self.session   = SnorkelSession()
 
-        # We use a workaround to pass in the apply kwargs
-        self.apply_kwargs = {}
+        # We use a workaround to pass in the apply kwargs, the job name if checkpointing or quarantining,
+        # and whether to send the outputs and metrics back to the parent
+        self.apply_kwargs   = {}
+        self.job            = None
+        self.quarantine     = None
+        self.send_outputs   = False
+        self.report_metrics = False
+
+        # Counters for reporting metrics
+        self.metrics = WorkerMetrics()
 
     def run(self):
         """
         This method is called when the UDF is run as a Process in a multiprocess setting
-        The basic routine is: get from JoinableQueue, apply, put / add outputs, loop
+        The basic routine is: get a batch from the in_queue, apply, put / add outputs, loop until
+        the sentinel; then report completion, or any exception, on the out_queue
         """
+        try:
+            self._run()
+        except Exception:
+            # The session is closed on this thread, as SQLite connections cannot be closed from another
+            self.session.close()
+            self.out_queue.put((ERROR, self.name, traceback.format_exc()))
+            return
+        self.out_queue.put((DONE, self.name, self.metrics.as_dict()))
+
+    def _run(self):
+        done, failed = [], []
+        if self.job is not None and not self.send_outputs:
+            begin_transaction(self.session)
+        t = time()
         while True:
-            try:
-                x = self.in_queue.get(True, QUEUE_TIMEOUT)
-                for y in self.apply(x, **self.apply_kwargs):
-
-                    # If an out_queue is provided, add to that, else add to session
-                    if self.out_queue is not None:
-                        self.out_queue.put(y, True, QUEUE_TIMEOUT)
-                    else:
-                        self.session.add(y)
-                self.in_queue.task_done()
-            except Empty:
+            xs = self.in_queue.get()
+            if xs is None:
                 break
-        self.session.commit()
+            t_got              = time()
+            self.metrics.idle += t_got - t
+            chunks, failures = self.apply_or_quarantine(xs, **self.apply_kwargs)
+            keys = [self.get_input_key(x) for x in xs] if self.job is not None else None
+
+            # Either send the outputs to the writer as a single message, or add them to the session
+            if self.send_outputs:
+                self.out_queue.put((OUTPUTS, keys, chunks, failures))
+            else:
+                for ys in chunks:
+                    self.persist_batch(ys, **self.apply_kwargs)
+                failed.extend(failures)
+
+                # Periodically commit the outputs along with the progress, if checkpointing
+                if keys is not None:
+                    done.extend(keys)
+                    if len(done) >= CHECKPOINT_SIZE:
+                        self.commit(self.job, done, failed, **self.apply_kwargs)
+                        done, failed = [], []
+            self.metrics.inputs  += len(xs)
+            self.metrics.outputs += sum(self.count_outputs(ys) for ys in chunks)
+            t                     = time()
+            self.metrics.busy    += t - t_got
+            if self.report_metrics and self.metrics.due():
+                self.out_queue.put((METRICS, self.metrics.as_dict()))
+        self.commit(self.job, done, failed, **self.apply_kwargs)
         self.session.close()
 
     def apply(self, x, **kwargs):
         """This function takes in an object, and returns a generator / set / list"""
         raise NotImplementedError()
+
+    def apply_batch(self, xs, **kwargs):
+        """
+        This function takes in a list of objects, and returns the outputs of apply for all of them.
+        UDFs can override this to process a batch at once, e.g. with a single DB query, and to return
+        their outputs in a more compact (e.g. columnar) form; if so, they must also override
+        reduce_batch to accept that form.
+        """
+        return [y for x in xs for y in self.apply(x, **kwargs)]
+
+    def apply_or_quarantine(self, xs, **kwargs):
+        """
+        Applies the UDF to a batch, returning a list of outputs of apply_batch, and a list of
+        quarantine records. This is the outputs of apply_batch for the whole batch, unless quarantining
+        and it raises; then the batch is discarded (see discard_batch), and if it has more than one
+        input, apply_batch is called on each input alone, so that the exception raised by an input can
+        be recorded without losing the outputs of the others.
+        """
+        t = time()
+        try:
+            return [self.apply_batch(xs, **kwargs)], []
+        except Exception as e:
+            if self.quarantine is None:
+                raise
+            self.discard_batch(xs, **kwargs)
+            if len(xs) == 1:
+                return [], [self._quarantine_record(xs[0], e, time() - t)]
+        chunks, failures = [], []
+        for x in xs:
+            t = time()
+            try:
+                chunks.append(self.apply_batch([x], **kwargs))
+            except Exception as e:
+                self.discard_batch([x], **kwargs)
+                failures.append(self._quarantine_record(x, e, time() - t))
+        return chunks, failures
+
+    def _quarantine_record(self, x, e, elapsed):
+        """Returns the quarantine record of the exception e raised on x; called while handling it"""
+        return {
+            'job'       : self.quarantine,
+            'key'       : self.get_input_key(x),
+            'exception' : repr(e),
+            'traceback' : traceback.format_exc(),
+            'elapsed'   : elapsed,
+        }
+
+    def discard_batch(self, xs, **kwargs):
+        """
+        Undoes the side effects of a call to apply_batch on xs which raised, before its inputs are
+        retried alone or quarantined. UDFs whose apply() attaches its outputs to the inputs or to the
+        session, e.g. CorpusParserUDF, must override this to detach them, or they would be persisted
+        along with those of the retries.
+        """
+        pass
+
+    def count_outputs(self, ys):
+        """Returns the number of outputs in the result of one call to apply_batch, for metrics"""
+        return len(ys)
+
+    @staticmethod
+    def get_input_key(x):
+        """
+        Returns a string which stably identifies the input object x across runs, used to record
+        progress when checkpointing; UDFs which support checkpointing must override this.
+        """
+        raise NotImplementedError()
+
+    def persist_batch(self, ys, **kwargs):
+        """
+        Adds the outputs of one call to apply_batch to the session; only used by UDFs which do not
+        define reduce(). This runs in the UDF process, or in the writer if single_writer=True, so
+        UDFs whose apply() defers DB writes can override this to perform them.
+        """
+        self.session.add_all(ys)
+
+    def reduce_batch(self, ys, **kwargs):
+        """Reduces the outputs of one call to apply_batch; only used by UDFs which define reduce()"""
+        for y in ys:
+            self.reduce(y, **kwargs)
+
+    def flush(self, **kwargs):
+        """Writes out anything buffered by reduce; called before each commit of the reducer session"""
+        pass
+
+    def commit(self, job=None, keys=(), failures=(), **kwargs):
+        """
+        Flushes and commits the session, along with the quarantine records of the failed inputs.
+        If a job name is given, also records the input keys as done in the same transaction, and then
+        starts the next one.
+        """
+        t = time()
+        self.flush(**kwargs)
+        if len(failures) > 0:
+            self.session.execute(UDFQuarantine.__table__.insert(), list(failures))
+        if job is not None and len(keys) > 0:
+            self.session.execute(UDFProgress.__table__.insert(), [{'job': job, 'key': key} for key in keys])
+        self.session.commit()
+        if job is not None:
+            begin_transaction(self.session)
+        self.metrics.commits     += 1
+        self.metrics.commit_time += time() - t
+
+
+def put_unless_stopped(queue, x, stop):
+    """Puts x in the queue, blocking while it is full; returns False if stop was set first"""
+    while not stop.is_set():
+        try:
+            queue.put(x, True, QUEUE_TIMEOUT)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def batches(xs, batch_size):
+    """Groups an iterable into lists of (at most) batch_size elements"""
+    batch = []
+    for x in xs:
+        batch.append(x)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
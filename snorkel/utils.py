@@ -70,12 +70,24 @@ def sparse_abs(X):
     return X_abs
 
 
+def label_entries(L):
+    """
+    Returns the row, column and value of each non-zero entry of a (sparse or dense) N x M label matrix,
+    as arrays ordered by row; the matrix statistics below are computed from these in one pass each.
+    """
+    L = sparse.csr_matrix(L, copy=True)
+    L.eliminate_zeros()
+    rows = np.repeat(np.arange(L.shape[0]), np.diff(L.indptr))
+    return rows, L.indices, L.data
+
+
 def matrix_coverage(L):
     """
     Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate:
     Return the **fraction of candidates that each LF labels.**
     """
-    return np.ravel(sparse_abs(L).sum(axis=0) / float(L.shape[0]))
+    rows, cols, values = label_entries(L)
+    return np.bincount(cols, minlength=L.shape[1]) / float(L.shape[0])
 
 
 def matrix_overlaps(L):
@@ -83,8 +95,9 @@ def matrix_overlaps(L):
     Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate:
     Return the **fraction of candidates that each LF _overlaps with other LFs on_.**
     """
-    L_abs = sparse_abs(L)
-    return np.ravel(np.where(L_abs.sum(axis=1) > 1, 1, 0).T * L_abs / float(L.shape[0]))
+    rows, cols, values = label_entries(L)
+    overlapped = np.bincount(rows, minlength=L.shape[0]) > 1
+    return np.bincount(cols, weights=overlapped[rows], minlength=L.shape[1]) / float(L.shape[0])
 
 
 def matrix_conflicts(L):
@@ -92,28 +105,70 @@ def matrix_conflicts(L):
     Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate:
     Return the **fraction of candidates that each LF _conflicts with other LFs on_.**
     """
-    L_abs = sparse_abs(L)
-    return np.ravel(np.where(L_abs.sum(axis=1) != sparse_abs(L.sum(axis=1)), 1, 0).T * L_abs / float(L.shape[0]))
+    rows, cols, values = label_entries(L)
+    return np.bincount(cols, weights=_conflicted_rows(rows, values, L.shape[0])[rows],
+                       minlength=L.shape[1]) / float(L.shape[0])
+
+
+def _conflicted_rows(rows, values, n):
+    """Returns whether each row has (at least) two different non-zero labels, given entries ordered by row"""
+    conflicted = np.zeros(n, dtype=bool)
+    if len(rows) > 0:
+        starts = np.concatenate([[0], np.nonzero(np.diff(rows))[0] + 1])
+        conflicted[rows[starts]] = np.minimum.reduceat(values, starts) != np.maximum.reduceat(values, starts)
+    return conflicted
+
+
+def _matrix_count(L, labels, value, label):
+    """Counts, per column, the entries with the given value on the candidates with the given label"""
+    rows, cols, values = label_entries(L)
+    labels = np.ravel(labels)
+    return np.bincount(cols, weights=(values == value) & (labels[rows] == label),
+                       minlength=L.shape[1]).astype(int)
+
 
 def matrix_tp(L, labels):
-    return np.ravel([
-        np.sum(np.ravel((L[:, j] == 1).todense()) * (labels == 1)) for j in range(L.shape[1])
-    ])
+    return _matrix_count(L, labels, 1, 1)
 
 def matrix_fp(L, labels):
-    return np.ravel([
-        np.sum(np.ravel((L[:, j] == 1).todense()) * (labels == -1)) for j in range(L.shape[1])
-    ])
+    return _matrix_count(L, labels, 1, -1)
 
 def matrix_tn(L, labels):
-    return np.ravel([
-        np.sum(np.ravel((L[:, j] == -1).todense()) * (labels == -1)) for j in range(L.shape[1])
-    ])
+    return _matrix_count(L, labels, -1, -1)
 
 def matrix_fn(L, labels):
-    return np.ravel([
-        np.sum(np.ravel((L[:, j] == -1).todense()) * (labels == 1)) for j in range(L.shape[1])
-    ])
+    return _matrix_count(L, labels, -1, 1)
+
+
+def matrix_lf_stats(L, labels=None):
+    """
+    Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate, and
+    optionally the N gold labels (0 if unknown), returns a dict of the per-LF statistics, computed
+    from one pass over the non-zero entries: Coverage, Overlaps and Conflicts; and given labels,
+    Correct and Incorrect (the number of labeled candidates on which the LF agrees / disagrees with
+    the gold label) and Empirical Acc., and for binary labels in {-1,1}, TP, FP, TN and FN.
+    """
+    n, m = L.shape
+    rows, cols, values = label_entries(L)
+    stats = {
+        'Coverage'  : np.bincount(cols, minlength=m) / float(n),
+        'Overlaps'  : np.bincount(cols, weights=(np.bincount(rows, minlength=n) > 1)[rows],
+                                  minlength=m) / float(n),
+        'Conflicts' : np.bincount(cols, weights=_conflicted_rows(rows, values, n)[rows],
+                                  minlength=m) / float(n),
+    }
+    if labels is not None:
+        gold    = np.ravel(labels)[rows]
+        labeled = gold != 0
+        stats['Correct']   = np.bincount(cols, weights=labeled & (values == gold), minlength=m).astype(int)
+        stats['Incorrect'] = np.bincount(cols, weights=labeled & (values != gold), minlength=m).astype(int)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stats['Empirical Acc.'] = stats['Correct'] / (stats['Correct'] + stats['Incorrect']).astype(float)
+        if np.all(np.abs(values) <= 1) and np.all(np.abs(gold) <= 1):
+            for name, value, label in [('TP', 1, 1), ('FP', 1, -1), ('TN', -1, -1), ('FN', -1, 1)]:
+                stats[name] = np.bincount(cols, weights=(values == value) & (gold == label),
+                                          minlength=m).astype(int)
+    return stats
 
 def get_as_dict(x):
     """Return an object as a dictionary of its attributes"""
@@ -126,6 +181,12 @@ def get_as_dict(x):
             return x.__dict__
 
 
+def chunks(xs, n):
+    """Splits a list into consecutive slices of (at most) n elements"""
+    for i in range(0, len(xs), n):
+        yield xs[i:i+n]
+
+
 def sort_X_on_Y(X, Y):
     return [x for (y,x) in sorted(zip(Y,X), key=lambda t : t[0])]
 
@@ -0,0 +1,85 @@
+"""
+Benchmarks LabelAnnotator.apply with candidates loaded one at a time vs. in batches.
+
+Creates n_sentences Sentences with one two-Span candidate per pair of words (up to CANDIDATES_PER_SENTENCE),
+and applies LFS, which access the candidates' Spans and Sentence, with batch_size=1 (one query per
+candidate, then lazy loads of its contexts) and with the default batch size (see
+AnnotatorUDF.load_candidates). The number of DB statements is counted with a MemorySink.
+
+Unless SNORKELDB is set, a temporary SQLite database is used.
+
+Usage:
+
+    python test/benchmarks/annotator_prefetch.py [n_sentences]
+"""
+import os
+import sys
+import tempfile
+from time import time
+
+if os.environ.get('SNORKELDB', '') == '':
+    os.environ['SNORKELDB'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'snorkel.db')
+
+from snorkel.annotations import LabelAnnotator
+from snorkel.metrics import MemorySink
+from snorkel.models import Document, Sentence, SnorkelSession, Span, candidate_subclass
+
+
+N_SENTENCES             = 500
+CANDIDATES_PER_SENTENCE = 10
+TEXT                    = 'aspirin causes headaches and ibuprofen treats fevers in most patients'
+
+Pair = candidate_subclass('BenchmarkPair', ['a', 'b'])
+
+
+def lf_causes(c):
+    return 1 if 'causes' in c.get_parent().words else 0
+
+
+def lf_order(c):
+    return -1 if c.a.char_start > c.b.char_start else 0
+
+
+def lf_same(c):
+    return -1 if c.a.get_span() == c.b.get_span() else 0
+
+
+LFS = [lf_causes, lf_order, lf_same]
+
+
+def build(session, n_sentences):
+    words   = TEXT.split()
+    offsets = [sum(len(w) + 1 for w in words[:i]) for i in range(len(words))]
+    for i in range(n_sentences):
+        doc = Document(name='doc-%s' % i, stable_id='doc-%s::document:0:0' % i, meta={})
+        sent = Sentence(document=doc, position=0, text=TEXT, words=words, char_offsets=offsets,
+                        abs_char_offsets=offsets, stable_id='doc-%s::sentence:0:%s' % (i, len(TEXT)))
+        spans = [Span(sentence=sent, char_start=o, char_end=o + len(w) - 1,
+                      stable_id='doc-%s::span:%s:%s' % (i, o, o + len(w) - 1))
+                 for w, o in zip(words, offsets)]
+        n = 0
+        for a in spans:
+            for b in spans:
+                if a is not b and n < CANDIDATES_PER_SENTENCE:
+                    session.add(Pair(a=a, b=b, split=0))
+                    n += 1
+        session.add(doc)
+    session.commit()
+
+
+if __name__ == '__main__':
+    n_sentences = int(sys.argv[1]) if len(sys.argv) > 1 else N_SENTENCES
+    session     = SnorkelSession()
+    build(session, n_sentences)
+    n_candidates = session.query(Pair).count()
+
+    print("\n%s candidates" % n_candidates)
+    print("%12s %12s %16s %14s" % ('batch_size', 'time (s)', 'candidates / s', 'statements'))
+    for batch_size in [1, None]:
+        sink  = MemorySink()
+        kwargs = {} if batch_size is None else {'batch_size': batch_size}
+        t0 = time()
+        LabelAnnotator(lfs=LFS).apply(split=0, progress_bar=False, metrics=sink, **kwargs)
+        t = time() - t0
+        print("%12s %12.2f %16.1f %14s" % (batch_size or 'default', t, n_candidates / t,
+                                           sink.last['statements']))
@@ -0,0 +1,74 @@
+"""
+Benchmarks CandidateExtractor.apply on synthetic sentences.
+
+Creates n_sentences Sentences of WORDS_PER_SENTENCE words drawn from VOCABULARY, and extracts binary
+candidates with DictionaryMatch over Ngrams for two dictionaries of DICTIONARY_SIZE terms each (a few
+of which occur in the vocabulary), then extracts them again with clear=False, as when re-running
+extraction incrementally on a grown corpus. The number of DB statements is counted with a MemorySink.
+
+Unless SNORKELDB is set, a temporary SQLite database is used.
+
+Usage:
+
+    python test/benchmarks/candidate_extraction.py [n_sentences] [batch_size]
+"""
+import os
+import sys
+import tempfile
+from time import time
+
+import numpy as np
+
+if os.environ.get('SNORKELDB', '') == '':
+    os.environ['SNORKELDB'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'snorkel.db')
+
+from snorkel.candidates import CandidateExtractor, Ngrams
+from snorkel.matchers import DictionaryMatch
+from snorkel.metrics import MemorySink
+from snorkel.models import Document, Sentence, SnorkelSession, Span, candidate_subclass
+
+
+N_SENTENCES        = 2000
+WORDS_PER_SENTENCE = 25
+DICTIONARY_SIZE    = 10000
+VOCABULARY         = ['aspirin', 'ibuprofen', 'acute', 'renal', 'failure', 'headache', 'fever', 'causes',
+                      'treats', 'the', 'patient', 'with', 'and', 'was', 'given', 'severe', 'liver', 'damage']
+
+Pair = candidate_subclass('BenchmarkExtractionPair', ['drug', 'disease'])
+
+
+def build(session, n_sentences):
+    rs = np.random.RandomState(0)
+    for i in range(n_sentences):
+        words   = [VOCABULARY[j] for j in rs.randint(len(VOCABULARY), size=WORDS_PER_SENTENCE)]
+        offsets = [sum(len(w) + 1 for w in words[:k]) for k in range(len(words))]
+        text    = ' '.join(words)
+        doc     = Document(name='doc-%s' % i, stable_id='doc-%s::document:0:0' % i, meta={})
+        Sentence(document=doc, position=0, text=text, words=words, char_offsets=offsets,
+                 abs_char_offsets=offsets, stable_id='doc-%s::sentence:0:%s' % (i, len(text)))
+        session.add(doc)
+    session.commit()
+
+
+if __name__ == '__main__':
+    n_sentences = int(sys.argv[1]) if len(sys.argv) > 1 else N_SENTENCES
+    batch_size  = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    session     = SnorkelSession()
+    build(session, n_sentences)
+    sentences   = session.query(Sentence).all()
+
+    drugs     = ['aspirin', 'ibuprofen'] + ['drug %s' % i for i in range(DICTIONARY_SIZE)]
+    diseases  = ['headache', 'fever', 'acute renal failure', 'liver damage'] + \
+                ['disease %s' % i for i in range(DICTIONARY_SIZE)]
+    extractor = CandidateExtractor(Pair, [Ngrams(n_max=3), Ngrams(n_max=3)],
+                                   [DictionaryMatch(d=drugs, longest_match_only=True),
+                                    DictionaryMatch(d=diseases, longest_match_only=True)])
+
+    for name, clear in [('fresh', True), ('re-run', False)]:
+        sink = MemorySink()
+        t0   = time()
+        extractor.apply(sentences, split=0, clear=clear, progress_bar=False, metrics=sink, batch_size=batch_size)
+        t    = time() - t0
+        print("%-6s extracted %s candidates (%s spans) from %s sentences in %.2fs (%.0f sentences / s), "
+              "%s statements" % (name, session.query(Pair).count(), session.query(Span).count(), n_sentences, t,
+                                 n_sentences / t, sink.last['statements']))
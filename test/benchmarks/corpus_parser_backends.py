@@ -0,0 +1,138 @@
+"""
+Benchmarks the UDFRunner backends on an I/O-bound UDF: CorpusParser with a parser server.
+
+A stub HTTP server stands in for the CoreNLP server: it waits LATENCY seconds per request, as the
+server would while parsing, and then returns one sentence per '. '-separated chunk of the text,
+in the same JSON format. The time spent in the UDFs is thus almost entirely spent blocked on
+URLParserConnection.post, which the 'thread' backend can overlap within one process.
+
+Unless SNORKELDB is set, the Documents and Sentences are written to a temporary SQLite database.
+
+Usage:
+
+    python test/benchmarks/corpus_parser_backends.py [n_docs] [latency]
+"""
+import json
+import os
+import sys
+import tempfile
+from threading import Thread
+from time import sleep, time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+if os.environ.get('SNORKELDB', '') == '':
+    os.environ['SNORKELDB'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'snorkel.db')
+
+from snorkel.models import Document, construct_stable_id
+from snorkel.parser import CorpusParser, Parser, URLParserConnection
+
+
+N_DOCS      = 200
+LATENCY     = 0.05
+PARALLELISM = [8, 32]
+BACKENDS    = ['process', 'thread']
+
+
+class StubCoreNLPHandler(BaseHTTPRequestHandler):
+    latency = LATENCY
+
+    def do_POST(self):
+        text = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        sleep(self.latency)
+        sentences, offset = [], 0
+        for chunk in text.split('. '):
+            tokens, o = [], offset
+            for word in chunk.split():
+                tokens.append({'word': word, 'originalText': word, 'lemma': word, 'pos': 'NN',
+                               'ner': 'O', 'characterOffsetBegin': o,
+                               'characterOffsetEnd': o + len(word)})
+                o += len(word) + 1
+            sentences.append({'tokens': tokens})
+            offset += len(chunk) + 2
+        content = json.dumps({'sentences': sentences}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads     = True
+    request_queue_size = 128
+
+
+class StubCoreNLP(Parser):
+    """Client for the stub server; parses its responses as StanfordCoreNLPServer does, minus deps"""
+    def __init__(self, port):
+        super(StubCoreNLP, self).__init__(name='StubCoreNLP')
+        self.endpoint = 'http://127.0.0.1:%d/' % port
+
+    def connect(self):
+        return URLParserConnection(self)
+
+    def parse(self, document, text, conn):
+        content = conn.post(self.endpoint, text.encode('utf-8'))
+        for position, block in enumerate(json.loads(content.decode('utf-8'))['sentences']):
+            tokens = block['tokens']
+            start  = tokens[0]['characterOffsetBegin']
+            words  = [t['word'] for t in tokens]
+            yield {
+                'words'            : words,
+                'lemmas'           : [t['lemma'] for t in tokens],
+                'pos_tags'         : [t['pos'] for t in tokens],
+                'ner_tags'         : [t['ner'] for t in tokens],
+                'char_offsets'     : [t['characterOffsetBegin'] - start for t in tokens],
+                'abs_char_offsets' : [t['characterOffsetBegin'] - start for t in tokens],
+                'dep_parents'      : [0 for _ in tokens],
+                'dep_labels'       : ['' for _ in tokens],
+                'entity_cids'      : ['O' for _ in tokens],
+                'entity_types'     : ['O' for _ in tokens],
+                'text'             : ' '.join(words),
+                'position'         : position,
+                'document'         : document,
+                'stable_id'        : construct_stable_id(document, 'sentence', start,
+                                                         tokens[-1]['characterOffsetEnd']),
+            }
+
+
+def docs(n_docs):
+    for i in range(n_docs):
+        name = 'doc-%s' % i
+        yield (Document(name=name, stable_id='%s::document:0:0' % name, meta={}),
+               'Aspirin causes headaches in doc %s. Ibuprofen treats fevers. Tylenol does neither' % i)
+
+
+if __name__ == '__main__':
+    n_docs  = int(sys.argv[1]) if len(sys.argv) > 1 else N_DOCS
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else LATENCY
+
+    StubCoreNLPHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubCoreNLPHandler)
+    server_thread = Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    parser = StubCoreNLP(server.server_address[1])
+
+    results = []
+    for parallelism in [1] + PARALLELISM:
+        for backend in BACKENDS if parallelism > 1 else ['process']:
+            corpus_parser = CorpusParser(parser=parser)
+            t0 = time()
+            corpus_parser.apply(docs(n_docs), parallelism=parallelism, backend=backend,
+                                progress_bar=False)
+            t = time() - t0
+            results.append((parallelism, backend, t, n_docs / t))
+    server.shutdown()
+
+    print("\n%s docs, %.3fs latency per request" % (n_docs, latency))
+    print("%12s %12s %12s %12s" % ('parallelism', 'backend', 'time (s)', 'docs / s'))
+    for parallelism, backend, t, docs_per_sec in results:
+        print("%12s %12s %12.2f %12.1f" % (parallelism, backend, t, docs_per_sec))
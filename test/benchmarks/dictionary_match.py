@@ -0,0 +1,65 @@
+"""
+Benchmarks DictionaryMatch over Ngrams, testing every n-gram (apply) vs. only extending n-grams while
+they are prefixes of dictionary phrases (scan_ngrams), for several values of n_max.
+
+The dictionary has dictionary_size synthetic phrases of one to four words, plus TERMS, which occur in
+the N_SENTENCES in-memory sentences of WORDS_PER_SENTENCE words; no DB is needed.
+
+Usage:
+
+    python test/benchmarks/dictionary_match.py [dictionary_size]
+"""
+import sys
+from time import time
+
+import numpy as np
+
+from snorkel.candidates import Ngrams
+from snorkel.matchers import DictionaryMatch
+
+
+DICTIONARY_SIZE    = 5000000
+N_SENTENCES        = 2000
+WORDS_PER_SENTENCE = 30
+N_MAXES            = [3, 5, 10]
+TERMS              = ['aspirin', 'acute renal failure', 'renal failure', 'tumor necrosis factor alpha']
+WORDS              = ['aspirin', 'acute', 'renal', 'failure', 'tumor', 'necrosis', 'factor', 'alpha', 'the',
+                      'patient', 'with', 'and', 'was', 'given', 'severe', 'of', 'in', 'a']
+
+
+class BenchmarkSentence(object):
+    """The attributes of a Sentence used by Ngrams and DictionaryMatch"""
+    def __init__(self, i, words):
+        self.id           = i
+        self.stable_id    = 'doc-%s::sentence:0:0' % i
+        self.words        = words
+        self.char_offsets = [sum(len(w) + 1 for w in words[:j]) for j in range(len(words))]
+        self.text         = ' '.join(words)
+
+
+if __name__ == '__main__':
+    dictionary_size = int(sys.argv[1]) if len(sys.argv) > 1 else DICTIONARY_SIZE
+    rs        = np.random.RandomState(0)
+    sentences = [BenchmarkSentence(i, [WORDS[j] for j in rs.randint(len(WORDS), size=WORDS_PER_SENTENCE)])
+                 for i in range(N_SENTENCES)]
+    phrases   = ['term%s' % i + ' word%s' % (i % 97) * (i % 4) for i in range(dictionary_size)] + TERMS
+
+    t0      = time()
+    matcher = DictionaryMatch(d=phrases, longest_match_only=True)
+    print("Built the dictionary of %s phrases in %.2fs" % (len(matcher.d), time() - t0))
+    del phrases
+
+    # The phrases are sorted for prefix searches on the first scan
+    t0 = time()
+    list(matcher.scan_ngrams(Ngrams(n_max=1), sentences[0]))
+    print("Sorted the dictionary in %.2fs" % (time() - t0))
+
+    print("%8s %14s %14s %10s" % ('n_max', 'apply (s)', 'scan (s)', 'matches'))
+    for n_max in N_MAXES:
+        ngrams  = Ngrams(n_max=n_max)
+        t0      = time()
+        matches = sum(len(list(matcher.apply(ngrams.apply(s)))) for s in sentences)
+        t_apply = time() - t0
+        t0      = time()
+        assert matches == sum(len(list(matcher.scan_ngrams(ngrams, s))) for s in sentences)
+        print("%8s %14.2f %14.2f %10s" % (n_max, t_apply, time() - t0, matches))
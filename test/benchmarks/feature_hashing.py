@@ -0,0 +1,56 @@
+"""
+Benchmarks writing features with many distinct names to a CSRAnnotationStore, with a column per
+feature name vs. hashed to 2**HASH_BITS columns (see HashedKeys).
+
+Each of n_candidates candidates gets FEATURES_PER_CANDIDATE features, with names drawn from
+n_names distinct names, appended in flushes of FLUSH_SIZE features as AnnotatorUDF.flush would; the
+peak memory (as traced by tracemalloc) and the size of the key group's keys.json are reported.
+
+Usage:
+
+    python test/benchmarks/feature_hashing.py [n_candidates] [n_names]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from time import time
+
+import numpy as np
+
+from snorkel.annotation_store import CSRAnnotationStore, HashedKeys
+
+
+N_CANDIDATES           = 200000
+N_NAMES                = 1000000
+FEATURES_PER_CANDIDATE = 20
+FLUSH_SIZE             = 50000
+HASH_BITS              = 18
+
+
+if __name__ == '__main__':
+    n_candidates = int(sys.argv[1]) if len(sys.argv) > 1 else N_CANDIDATES
+    n_names      = int(sys.argv[2]) if len(sys.argv) > 2 else N_NAMES
+    rs           = np.random.RandomState(0)
+    cids         = np.repeat(np.arange(n_candidates), FEATURES_PER_CANDIDATE)
+    name_ids     = rs.randint(n_names, size=len(cids))
+
+    for name, keys in [('named', []), ('hashed', HashedKeys(HASH_BITS, signed=True))]:
+        store = CSRAnnotationStore(tempfile.mkdtemp())
+        store.save_keys(keys)
+        tracemalloc.start()
+        t0 = time()
+        writer = store.writer('split_0')
+        for i in range(0, len(cids), FLUSH_SIZE):
+            writer.append(cids[i:i + FLUSH_SIZE], ['feature_%s' % j for j in name_ids[i:i + FLUSH_SIZE]],
+                          np.ones(len(cids[i:i + FLUSH_SIZE])))
+        store.close('split_0')
+        t = time() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        _, X = store.open_shard('split_0')
+        print("%-8s %s x %s (%s features) in %.2fs, peak memory %.0fMB, keys.json %.1fMB"
+              % (name, X.shape[0], X.shape[1], X.nnz, t, peak / 1e6,
+                 os.path.getsize(os.path.join(store.group_path(), 'keys.json')) / 1e6))
+        shutil.rmtree(store.path)
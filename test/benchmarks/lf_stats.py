@@ -0,0 +1,43 @@
+"""
+Benchmarks csr_LabelMatrix.lf_stats on a synthetic label matrix with gold labels.
+
+Each of n_lfs LFs labels each of n_candidates candidates with probability DENSITY, with a random label
+in {-1,1}; the LFs are named in the matrix's column index, so no DB is needed.
+
+Usage:
+
+    python test/benchmarks/lf_stats.py [n_candidates] [n_lfs]
+"""
+import sys
+from time import time
+
+import numpy as np
+import scipy.sparse as sparse
+
+from snorkel.annotations import csr_LabelMatrix
+
+
+N_CANDIDATES = 1000000
+N_LFS        = 2000
+DENSITY      = 0.005
+
+
+if __name__ == '__main__':
+    n_candidates = int(sys.argv[1]) if len(sys.argv) > 1 else N_CANDIDATES
+    n_lfs        = int(sys.argv[2]) if len(sys.argv) > 2 else N_LFS
+
+    # Duplicate (candidate, LF) entries are summed, then mapped back to {-1,0,1}
+    rs  = np.random.RandomState(0)
+    nnz = int(DENSITY * n_candidates * n_lfs)
+    X   = sparse.csr_matrix((rs.choice([-1, 1], size=nnz),
+                             (rs.randint(n_candidates, size=nnz), rs.randint(n_lfs, size=nnz))),
+                            shape=(n_candidates, n_lfs))
+    X.data = np.sign(X.data)
+    X.eliminate_zeros()
+    L  = csr_LabelMatrix(X, col_index=np.array(['LF_%s' % j for j in range(n_lfs)]))
+    labels = rs.choice([-1, 1], size=n_candidates)
+
+    t0    = time()
+    stats = L.lf_stats(None, labels=labels)
+    print("Computed the stats of %s LFs over %s candidates (%s labels) in %.2fs"
+          % (n_lfs, n_candidates, L.nnz, time() - t0))
@@ -0,0 +1,80 @@
+"""
+Benchmarks load_label_matrix on a synthetic label matrix.
+
+Inserts n_candidates candidates, a DEV_FRACTION of which are in split 1 and the rest in split 0, and
+n_lfs LabelKeys; each LF labels each candidate with probability DENSITY. Then times loading the label
+matrices of the (large) split 0 and of the (small) split 1, from the Label table and from a
+CSRAnnotationStore holding the same labels.
+The candidates have no arguments, and are only used through their ids and splits.
+
+Unless SNORKELDB is set, a temporary SQLite database is used.
+
+Usage:
+
+    python test/benchmarks/load_matrix.py [n_candidates] [n_lfs]
+"""
+import os
+import shutil
+import sys
+import tempfile
+from time import time
+
+import numpy as np
+
+if os.environ.get('SNORKELDB', '') == '':
+    os.environ['SNORKELDB'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'snorkel.db')
+
+from snorkel.annotation_store import CSRAnnotationStore, SHARD_NAME
+from snorkel.annotations import csr_LabelMatrix, load_label_matrix
+from snorkel.models import Candidate, Label, LabelKey, SnorkelSession
+
+
+N_CANDIDATES = 200000
+N_LFS        = 50
+DENSITY      = 0.2
+DEV_FRACTION = 0.05
+CHUNK_SIZE   = 100000
+
+
+def insert(session, table, rows):
+    for i in range(0, len(rows), CHUNK_SIZE):
+        session.execute(table.insert(), rows[i:i+CHUNK_SIZE])
+
+
+if __name__ == '__main__':
+    n_candidates = int(sys.argv[1]) if len(sys.argv) > 1 else N_CANDIDATES
+    n_lfs        = int(sys.argv[2]) if len(sys.argv) > 2 else N_LFS
+    session      = SnorkelSession()
+
+    t0 = time()
+    n_dev = int(DEV_FRACTION * n_candidates)
+    insert(session, Candidate.__table__,
+           [{'id': i + 1, 'type': 'benchmark', 'split': 1 if i < n_dev else 0} for i in range(n_candidates)])
+    insert(session, LabelKey.__table__,
+           [{'id': j + 1, 'name': 'LF_%s' % j, 'group': 0} for j in range(n_lfs)])
+    rs = np.random.RandomState(0)
+    cids, kids = np.nonzero(rs.rand(n_candidates, n_lfs) < DENSITY)
+    values     = rs.choice([-1, 1], size=len(cids))
+    insert(session, Label.__table__,
+           [{'candidate_id': int(c) + 1, 'key_id': int(k) + 1, 'value': int(v)}
+            for c, k, v in zip(cids, kids, values)])
+    session.commit()
+    print("Inserted %s labels in %.2fs" % (len(cids), time() - t0))
+
+    t0    = time()
+    store = CSRAnnotationStore(tempfile.mkdtemp(), dtype=np.int8)
+    for split, start, end in [(0, n_dev, n_candidates), (1, 0, n_dev)]:
+        in_split = (cids >= start) & (cids < end)
+        writer   = store.writer(SHARD_NAME % split)
+        writer.append(cids[in_split] + 1, ['LF_%s' % k for k in kids[in_split]], values[in_split])
+        store.close(SHARD_NAME % split, cids=np.arange(start, end) + 1)
+    print("Wrote the CSRAnnotationStore in %.2fs" % (time() - t0))
+
+    for split in [0, 1]:
+        for source in ['table', 'store']:
+            t0 = time()
+            L  = load_label_matrix(session, split=split, store=store if source == 'store' else None)
+            t  = time() - t0
+            print("Loaded split %s from the %s: %s x %s label matrix with %s non-zeros in %.3fs"
+                  % ((split, source) + L.shape + (L.nnz, t)))
+    shutil.rmtree(store.path)
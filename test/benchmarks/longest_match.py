@@ -0,0 +1,59 @@
+"""
+Benchmarks the longest_match_only filtering of Matcher.apply on long sentences, keeping the spans of the
+matches in a list tested one by one (SeenSpans) vs. in an IntervalIndex.
+
+Each of N_SENTENCES in-memory sentences has n_words words drawn from WORDS, and every word and some
+two-word phrases are in the dictionary, so the matches per sentence grow with n_words; no DB is needed.
+
+Usage:
+
+    python test/benchmarks/longest_match.py [n_words]
+"""
+import sys
+from time import time
+
+import numpy as np
+
+from snorkel.candidates import Ngrams
+from snorkel.matchers import DictionaryMatch, SeenSpans
+
+
+N_WORDS     = 5000
+N_SENTENCES = 5
+N_MAX       = 3
+WORDS       = ['the', 'patient', 'had', 'acute', 'renal', 'failure', 'and', 'fever']
+PHRASES     = WORDS + ['renal failure', 'acute renal failure']
+
+
+class BenchmarkSentence(object):
+    """The attributes of a Sentence used by Ngrams and DictionaryMatch"""
+    def __init__(self, i, words):
+        self.id           = i
+        self.stable_id    = 'doc-%s::sentence:0:0' % i
+        self.words        = words
+        self.char_offsets = list(np.cumsum([0] + [len(w) + 1 for w in words[:-1]]))
+        self.text         = ' '.join(words)
+
+
+class ListDictionaryMatch(DictionaryMatch):
+    """DictionaryMatch testing each match against the spans of all the earlier ones"""
+    def _seen_spans(self):
+        return SeenSpans(self)
+
+
+if __name__ == '__main__':
+    n_words   = int(sys.argv[1]) if len(sys.argv) > 1 else N_WORDS
+    rs        = np.random.RandomState(0)
+    sentences = [BenchmarkSentence(i, [WORDS[j] for j in rs.randint(len(WORDS), size=n_words)])
+                 for i in range(N_SENTENCES)]
+    ngrams    = Ngrams(n_max=N_MAX)
+    spans     = [list(ngrams.apply(s)) for s in sentences]
+
+    results = []
+    for name, matcher in [('list', ListDictionaryMatch(d=PHRASES)), ('interval', DictionaryMatch(d=PHRASES))]:
+        t0      = time()
+        matches = [[(c.char_start, c.char_end) for c in matcher.apply(s)] for s in spans]
+        print("%-8s %s matches of %s n-grams in %.2fs"
+              % (name, sum(len(m) for m in matches), sum(len(s) for s in spans), time() - t0))
+        results.append(matches)
+    assert results[0] == results[1]
@@ -0,0 +1,55 @@
+"""
+Benchmarks save_marginals and load_marginals.
+
+Inserts n_candidates candidates, then saves and loads random binary marginals for them; the candidates
+are given to save_marginals as a list of objects with an id, as their label matrix would be.
+
+Unless SNORKELDB is set, a temporary SQLite database is used.
+
+Usage:
+
+    python test/benchmarks/marginals.py [n_candidates]
+"""
+import os
+import sys
+import tempfile
+from time import time
+
+import numpy as np
+
+if os.environ.get('SNORKELDB', '') == '':
+    os.environ['SNORKELDB'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'snorkel.db')
+
+from snorkel.annotations import load_marginals, save_marginals
+from snorkel.models import Candidate, SnorkelSession
+
+
+N_CANDIDATES = 1000000
+CHUNK_SIZE   = 100000
+
+
+class BenchmarkCandidate(object):
+    cardinality = 2
+
+    def __init__(self, id):
+        self.id = id
+
+
+if __name__ == '__main__':
+    n_candidates = int(sys.argv[1]) if len(sys.argv) > 1 else N_CANDIDATES
+    session      = SnorkelSession()
+    for i in range(0, n_candidates, CHUNK_SIZE):
+        session.execute(Candidate.__table__.insert(), [{'id': j + 1, 'type': 'benchmark', 'split': 0}
+                                                       for j in range(i, min(i + CHUNK_SIZE, n_candidates))])
+    session.commit()
+    candidates = [BenchmarkCandidate(j + 1) for j in range(n_candidates)]
+    marginals  = np.random.RandomState(0).rand(n_candidates)
+
+    t0 = time()
+    save_marginals(session, candidates, marginals)
+    print("Saved %s marginals in %.2fs" % (n_candidates, time() - t0))
+
+    t0     = time()
+    loaded = load_marginals(session, candidates)
+    print("Loaded %s marginals in %.2fs" % (len(loaded), time() - t0))
+    assert np.allclose(loaded, marginals)
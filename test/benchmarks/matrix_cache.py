@@ -0,0 +1,53 @@
+"""
+Benchmarks load_label_matrix from the DB vs. from a cache saved by csr_AnnotationMatrix.save.
+
+Inserts n_candidates candidates with LABELS_PER_CANDIDATE labels each, from N_LFS LFs, then loads their
+label matrix without a cache, with an empty cache (loading and saving it), and with the saved cache
+(checking its watermark, then opening it memory-mapped).
+
+Unless SNORKELDB is set, a temporary SQLite database is used.
+
+Usage:
+
+    python test/benchmarks/matrix_cache.py [n_candidates]
+"""
+import os
+import sys
+import tempfile
+from time import time
+
+import numpy as np
+
+if os.environ.get('SNORKELDB', '') == '':
+    os.environ['SNORKELDB'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'snorkel.db')
+
+from snorkel.annotations import load_label_matrix
+from snorkel.models import Candidate, Label, LabelKey, SnorkelSession
+
+
+N_CANDIDATES         = 200000
+N_LFS                = 50
+LABELS_PER_CANDIDATE = 5
+CHUNK_SIZE           = 100000
+
+
+if __name__ == '__main__':
+    n_candidates = int(sys.argv[1]) if len(sys.argv) > 1 else N_CANDIDATES
+    session      = SnorkelSession()
+    rs           = np.random.RandomState(0)
+    session.execute(LabelKey.__table__.insert(), [{'id': j + 1, 'name': 'LF_%s' % j, 'group': 0}
+                                                  for j in range(N_LFS)])
+    for i in range(0, n_candidates, CHUNK_SIZE):
+        cids = range(i + 1, min(i + CHUNK_SIZE, n_candidates) + 1)
+        session.execute(Candidate.__table__.insert(), [{'id': cid, 'type': 'benchmark', 'split': 0}
+                                                       for cid in cids])
+        session.execute(Label.__table__.insert(), [{'candidate_id': cid, 'key_id': int(kid), 'value': int(v)}
+            for cid in cids for kid, v in zip(rs.choice(N_LFS, LABELS_PER_CANDIDATE, replace=False) + 1,
+                                              rs.choice([-1, 1], LABELS_PER_CANDIDATE))])
+    session.commit()
+    cache = os.path.join(tempfile.mkdtemp(), 'L_train')
+
+    for name, kwargs in [('no cache', {}), ('cache miss', {'cache': cache}), ('cache hit', {'cache': cache})]:
+        t0 = time()
+        L  = load_label_matrix(session, split=0, **kwargs)
+        print("%-12s loaded %s x %s (%s labels) in %.2fs" % (name, L.shape[0], L.shape[1], L.nnz, time() - t0))
@@ -0,0 +1,63 @@
+"""
+Micro-benchmarks the generation of TemporarySpans by Ngrams, and TemporarySpan.get_attrib_tokens.
+
+Generates the n-grams (up to N_MAX words) of n_sentences in-memory sentences of WORDS_PER_SENTENCE
+words each, then calls get_attrib_tokens TOKEN_CALLS times on each of them, as LFs and features
+do; no DB is needed. The memory used per TemporarySpan is measured with tracemalloc over the spans
+of SAMPLE_SENTENCES sentences.
+
+Usage:
+
+    python test/benchmarks/temporary_spans.py [n_sentences]
+"""
+import sys
+import tracemalloc
+from time import time
+
+from snorkel.candidates import Ngrams
+
+
+N_SENTENCES        = 1000000
+WORDS_PER_SENTENCE = 30
+N_MAX              = 5
+TOKEN_CALLS        = 3
+SAMPLE_SENTENCES   = 1000
+WORDS              = ['aspirin', 'causes', 'acute', 'renal', 'failure', 'in', 'some', 'patients']
+
+
+class BenchmarkSentence(object):
+    """The attributes of a Sentence used by Ngrams and TemporarySpan"""
+    def __init__(self, i):
+        self.id           = i
+        self.stable_id    = 'doc-%s::sentence:0:0' % i
+        self.words        = [WORDS[(i + j) % len(WORDS)] for j in range(WORDS_PER_SENTENCE)]
+        self.char_offsets = [sum(len(w) + 1 for w in self.words[:j]) for j in range(WORDS_PER_SENTENCE)]
+        self.text         = ' '.join(self.words)
+
+
+if __name__ == '__main__':
+    n_sentences = int(sys.argv[1]) if len(sys.argv) > 1 else N_SENTENCES
+    sentences   = [BenchmarkSentence(i) for i in range(len(WORDS))]
+    ngrams      = Ngrams(n_max=N_MAX)
+
+    # Generation, and then access to the tokens, of all the n-grams of each sentence in turn
+    t_generate, t_tokens, n_spans = 0.0, 0.0, 0
+    for i in range(n_sentences):
+        t0    = time()
+        spans = list(ngrams.apply(sentences[i % len(sentences)]))
+        t1    = time()
+        for _ in range(TOKEN_CALLS):
+            for span in spans:
+                span.get_attrib_tokens('words')
+        t_generate += t1 - t0
+        t_tokens   += time() - t1
+        n_spans    += len(spans)
+    print("Generated %s n-grams of %s sentences in %.2fs (%.0f spans / s)"
+          % (n_spans, n_sentences, t_generate, n_spans / t_generate))
+    print("Called get_attrib_tokens %s times on %s spans in %.2fs (%.0f calls / s)"
+          % (TOKEN_CALLS, n_spans, t_tokens, TOKEN_CALLS * n_spans / t_tokens))
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    spans  = [span for i in range(SAMPLE_SENTENCES) for span in ngrams.apply(sentences[i % len(sentences)])]
+    print("%.0f bytes per TemporarySpan" % ((tracemalloc.get_traced_memory()[0] - before) / float(len(spans))))
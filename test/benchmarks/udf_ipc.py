@@ -0,0 +1,80 @@
+"""
+Benchmarks the per-candidate IPC overhead of UDFRunner.apply_mt, with and without micro-batching.
+
+The UDFs used here do no work: for each input candidate id they emit N_KEYS annotation-style
+(cid, key_name, value) triples, which the reducer discards, so the measured time is almost
+entirely spent queueing and pickling inputs and outputs between processes. RowUDF sends its
+outputs back as a list of tuples, one message per candidate (the old behavior was one message
+per tuple, which is slower still); ColumnarUDF sends back one columnar chunk per batch, as
+AnnotatorUDF does.
+
+Usage:
+
+    python test/benchmarks/udf_ipc.py [n_candidates] [n_keys]
+"""
+import sys
+from time import time
+
+from snorkel.udf import UDF, UDFRunner
+
+
+N_CANDIDATES = 100000
+N_KEYS       = 20
+PARALLELISM  = [1, 8, 32]
+
+
+class RowUDF(UDF):
+    def __init__(self, n_keys, **kwargs):
+        self.key_names = ['LF_%s' % k for k in range(n_keys)]
+        super(RowUDF, self).__init__(**kwargs)
+
+    def apply(self, cid, **kwargs):
+        for key_name in self.key_names:
+            yield cid[0], key_name, 1
+
+    def reduce(self, y, **kwargs):
+        pass
+
+
+class ColumnarUDF(RowUDF):
+    def apply_batch(self, cids, **kwargs):
+        chunk = ([], [], [])
+        for cid in cids:
+            for y in self.apply(cid, **kwargs):
+                for column, v in zip(chunk, y):
+                    column.append(v)
+        return chunk
+
+    def reduce_batch(self, chunk, **kwargs):
+        pass
+
+
+class NoOpRunner(UDFRunner):
+    def __init__(self, udf_class, n_keys):
+        super(NoOpRunner, self).__init__(udf_class, n_keys=n_keys)
+
+    def clear(self, session, **kwargs):
+        pass
+
+
+if __name__ == '__main__':
+    n_candidates = int(sys.argv[1]) if len(sys.argv) > 1 else N_CANDIDATES
+    n_keys       = int(sys.argv[2]) if len(sys.argv) > 2 else N_KEYS
+    cids         = [(cid,) for cid in range(n_candidates)]
+
+    results = []
+    for parallelism in PARALLELISM:
+        for udf_class, batch_size in [(RowUDF, 1), (ColumnarUDF, 1), (ColumnarUDF, 100)]:
+            runner = NoOpRunner(udf_class, n_keys)
+            t0 = time()
+            if parallelism < 2:
+                runner.apply_st(cids, progress_bar=False, count=None, batch_size=batch_size)
+            else:
+                runner.apply_mt(cids, parallelism, batch_size=batch_size, single_writer=True)
+            t = time() - t0
+            results.append((parallelism, udf_class.__name__, batch_size, t, 1e6 * t / n_candidates))
+
+    print("\n%s candidates x %s keys" % (n_candidates, n_keys))
+    print("%12s %12s %12s %12s %16s" % ('parallelism', 'udf', 'batch_size', 'time (s)', 'us / candidate'))
+    for parallelism, name, batch_size, t, us in results:
+        print("%12s %12s %12s %12.2f %16.1f" % (parallelism, name, batch_size, t, us))
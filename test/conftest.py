@@ -0,0 +1,6 @@
+# The pipeline tests (test/pipeline) run against a fresh database, which must be chosen before snorkel
+# is first imported, e.g. by the learning tests; see test/pipeline/fixtures.py
+import os
+import tempfile
+
+os.environ['SNORKELDB'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='snorkel-test-'), 'snorkel.db')
@@ -0,0 +1,57 @@
+"""
+Setup shared by the pipeline tests, which run the UDFs against a fresh SQLite database.
+
+The database must be chosen before snorkel is first imported, so the test modules import this module
+before anything from snorkel; under pytest, test/conftest.py chooses it before any test is collected.
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+TEST_DB_PREFIX = 'snorkel-test-'
+
+if 'snorkel' not in sys.modules:
+    os.environ['SNORKELDB'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix=TEST_DB_PREFIX), 'snorkel.db')
+
+from snorkel.candidates import CandidateExtractor, Ngrams
+from snorkel.matchers import DictionaryMatch
+from snorkel.models import Document, Sentence, SnorkelBase, SnorkelSession, candidate_subclass, snorkel_engine
+from snorkel.models.meta import snorkel_conn_string
+
+# Never drop the tables of a database which was not created for the tests
+if TEST_DB_PREFIX not in snorkel_conn_string:
+    raise unittest.SkipTest("The pipeline tests need a fresh database, but snorkel uses %s." % snorkel_conn_string)
+
+
+WORDS = ['aspirin', 'ibuprofen', 'acute', 'renal', 'failure', 'headache', 'fever', 'causes', 'treats',
+         'the', 'patient', 'with', 'and', 'was', 'given', 'severe', 'liver', 'damage']
+
+Mention = candidate_subclass('TestMention', ['mention'])
+
+
+def reset_db():
+    """Drops and re-creates all the tables"""
+    SnorkelBase.metadata.drop_all(snorkel_engine)
+    SnorkelBase.metadata.create_all(snorkel_engine)
+
+
+def build_corpus(session, n_sentences, words_per_sentence=25):
+    """Adds n_sentences Sentences, in a Document each, of words cycling through WORDS; returns them"""
+    sentences = []
+    for i in range(n_sentences):
+        words   = [WORDS[(i + j) % len(WORDS)] for j in range(words_per_sentence)]
+        offsets = [sum(len(w) + 1 for w in words[:k]) for k in range(len(words))]
+        text    = ' '.join(words)
+        doc     = Document(name='doc-%s' % i, stable_id='doc-%s::document:0:0' % i, meta={})
+        sentences.append(Sentence(document=doc, position=0, text=text, words=words, char_offsets=offsets,
+                                  abs_char_offsets=offsets, stable_id='doc-%s::sentence:0:%s' % (i, len(text))))
+        session.add(doc)
+    session.commit()
+    return sentences
+
+
+def extract_mentions(sentences, split=0, **kwargs):
+    """Extracts a Mention for each word of the Sentences which is in d (by default, each word)"""
+    extractor = CandidateExtractor(Mention, [Ngrams(n_max=1)], [DictionaryMatch(d=kwargs.pop('d', WORDS))])
+    extractor.apply(sentences, split=split, progress_bar=False, **kwargs)
@@ -0,0 +1,590 @@
+# -*- coding: utf-8 -*-
+from fixtures import Mention, SnorkelSession, build_corpus, extract_mentions, reset_db
+from snorkel import annotation_store, annotations
+from snorkel.annotation_store import CSRAnnotationStore, HashedKeys
+from snorkel.annotations import (FeatureAnnotator, LabelAnnotator, lf_fingerprint, load_label_matrix,
+                                  load_marginals, save_marginals)
+from snorkel.models import Label, LabelKey, Marginal, candidate_subclass
+from snorkel.utils import (matrix_conflicts, matrix_coverage, matrix_fn, matrix_fp, matrix_lf_stats,
+                           matrix_overlaps, matrix_tn, matrix_tp, sparse_abs)
+from scipy import sparse
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+
+
+# Module-level LFs, which count their calls on a function attribute, so that counting does not
+# change their fingerprints
+WEIGHTS = np.ones(5000)
+
+
+def parity(cid):
+    return 1 if cid % 2 == 0 else -1
+
+
+def lf_a(c):
+    lf_a.calls += 1
+    return parity(c.id)
+
+
+def lf_b_v1(c):
+    lf_b_v1.calls += 1
+    return parity(c.id)
+
+
+def lf_b_v2(c):
+    lf_b_v2.calls += 1
+    return -parity(c.id)
+
+
+def lf_c(c):
+    lf_c.calls += 1
+    return 1
+
+
+def lf_even(c):
+    return -1 if c.id % 2 == 0 else 0
+
+
+def lf_odd(c):
+    return -1 if c.id % 2 == 1 else 0
+
+
+def lf_weighted(c):
+    lf_weighted.calls += 1
+    return 1 if WEIGHTS[2500] > 0 else -1
+
+
+def make_lf(body):
+    """Returns an LF named lf_edited which returns the expression body, compiled from source"""
+    namespace = {'parity': parity}
+    exec('def lf_edited(c):\n    lf_edited.calls += 1\n    return %s\n' % body, namespace)
+    lf       = namespace['lf_edited']
+    lf.calls = 0
+    return lf
+
+
+def feats(c):
+    # Feature names which are not ASCII
+    yield u'mot_%s_café' % c.mention.get_span(), 1
+    yield u'parité', parity(c.id)
+
+
+lf_b_v1.__name__ = lf_b_v2.__name__ = 'lf_b'
+lf_even.__name__ = lf_odd.__name__   = 'lf_parity'
+LFS = [lf_a, lf_b_v1, lf_b_v2, lf_c, lf_weighted]
+
+Categorical = candidate_subclass('TestCategorical', ['mention'], cardinality=3)
+
+
+class TestLabelAnnotator(unittest.TestCase):
+
+    def setUp(self):
+        reset_db()
+        self.session = SnorkelSession()
+        extract_mentions(build_corpus(self.session, 20))
+        self.n = self.session.query(Mention).count()
+        self.reset_calls()
+
+    def tearDown(self):
+        self.session.close()
+        WEIGHTS[:] = 1
+
+    def reset_calls(self):
+        for lf in LFS:
+            lf.calls = 0
+
+    def test_incremental(self):
+        L = LabelAnnotator(lfs=[lf_a, lf_b_v1, lf_c]).apply(incremental=True, progress_bar=False)
+        self.assertEqual(L.shape, (self.n, 3))
+        self.assertEqual([lf_a.calls, lf_b_v1.calls, lf_c.calls], [self.n, self.n, self.n])
+
+        # The unchanged LF is not re-applied, the changed one is, and the removed one is deleted
+        self.reset_calls()
+        L = LabelAnnotator(lfs=[lf_a, lf_b_v2]).apply(incremental=True, progress_bar=False)
+        self.assertEqual([lf_a.calls, lf_b_v2.calls], [0, self.n])
+        self.assertEqual(L.get_key_names(self.session), ['lf_a', 'lf_b'])
+        expected = np.array([[parity(cid), -parity(cid)] for cid in L.row_index])
+        self.assertTrue(np.array_equal(L.toarray(), expected))
+        self.assertEqual(sorted(name for name, in self.session.query(LabelKey.name)), ['lf_a', 'lf_b'])
+        self.assertEqual(self.session.query(Label).count(), 2 * self.n)
+
+        # Nothing is re-applied if nothing changed
+        self.reset_calls()
+        L = LabelAnnotator(lfs=[lf_a, lf_b_v2]).apply(incremental=True, progress_bar=False)
+        self.assertEqual([lf_a.calls, lf_b_v2.calls], [0, 0])
+        self.assertTrue(np.array_equal(L.toarray(), expected))
+
+    def test_incremental_edited(self):
+        # Editing the body of an LF re-applies it alone; recompiling the same body does not
+        lf = make_lf('parity(c.id)')
+        LabelAnnotator(lfs=[lf_a, lf]).apply(incremental=True, progress_bar=False)
+        self.assertEqual([lf_a.calls, lf.calls], [self.n, self.n])
+        for body, calls in [('-parity(c.id)', self.n), ('-parity(c.id)', 0)]:
+            self.reset_calls()
+            lf = make_lf(body)
+            L  = LabelAnnotator(lfs=[lf_a, lf]).apply(incremental=True, progress_bar=False)
+            self.assertEqual([lf_a.calls, lf.calls], [0, calls])
+            expected = np.array([[parity(cid), -parity(cid)] for cid in L.row_index])
+            self.assertTrue(np.array_equal(L.toarray(), expected))
+
+    def test_incremental_global_array(self):
+        # Editing a large array which an LF reads changes its fingerprint, though not the array's repr
+        fingerprint = lf_fingerprint(lf_weighted)
+        WEIGHTS[2500] = -1
+        self.assertNotEqual(lf_fingerprint(lf_weighted), fingerprint)
+        WEIGHTS[2500] = 1
+
+        LabelAnnotator(lfs=[lf_weighted]).apply(incremental=True, progress_bar=False)
+        WEIGHTS[2500] = -1
+        self.reset_calls()
+        L = LabelAnnotator(lfs=[lf_weighted]).apply(incremental=True, progress_bar=False)
+        self.assertEqual(lf_weighted.calls, self.n)
+        self.assertEqual(L.toarray().ravel().tolist(), [-1] * self.n)
+
+    def test_fingerprint_opaque_value(self):
+        # An LF which depends on an object which cannot be hashed by content is always re-applied
+        class Threshold(object):
+            value = 0
+        threshold = Threshold()
+        lf = lambda c: 1 if c.id > threshold.value else -1
+        self.assertNotEqual(lf_fingerprint(lf), lf_fingerprint(lf))
+        self.assertEqual(lf_fingerprint(lf_a), lf_fingerprint(lf_a))
+
+
+class TestApplyInMemory(unittest.TestCase):
+
+    def setUp(self):
+        reset_db()
+        self.session = SnorkelSession()
+        extract_mentions(build_corpus(self.session, 20))
+        self.candidates = self.session.query(Mention).order_by(Mention.id).all()
+        for lf in LFS:
+            lf.calls = 0
+
+    def tearDown(self):
+        self.session.close()
+
+    def assertMatrixEqual(self, L, expected):
+        self.assertEqual(L.row_index.tolist(), expected.row_index.tolist())
+        self.assertEqual(L.col_index.tolist(), expected.col_index.tolist())
+        self.assertTrue(np.array_equal(L.toarray(), expected.toarray()))
+
+    def test_apply_in_memory(self):
+        # The matrix is that of apply, but no Labels are written until it is persisted
+        for parallelism in [None, 2]:
+            self.session.query(Label).delete()
+            self.session.query(LabelKey).delete()
+            self.session.commit()
+            annotator = LabelAnnotator(lfs=[lf_a, lf_b_v1, lf_c])
+            L         = annotator.apply_in_memory(self.candidates, parallelism=parallelism, progress_bar=False)
+            self.assertEqual(self.session.query(Label).count(), 0)
+            self.assertEqual(L.get_key_names(self.session), ['lf_a', 'lf_b', 'lf_c'])
+            annotator.persist(L)
+            self.assertMatrixEqual(load_label_matrix(self.session), L)
+            self.assertMatrixEqual(annotator.apply(progress_bar=False), L)
+
+    def test_persist_replaces(self):
+        # Persisting replaces the Labels of the matrix's LFs, and keeps those of the others
+        LabelAnnotator(lfs=[lf_a, lf_b_v1]).apply(progress_bar=False)
+        annotator = LabelAnnotator(lfs=[lf_b_v2])
+        annotator.persist(annotator.apply_in_memory(self.candidates, progress_bar=False))
+        L        = load_label_matrix(self.session)
+        expected = np.array([[parity(cid), -parity(cid)] for cid in L.row_index])
+        self.assertEqual(L.get_key_names(self.session), ['lf_a', 'lf_b'])
+        self.assertTrue(np.array_equal(L.toarray(), expected))
+
+
+class TestMatrixCache(unittest.TestCase):
+
+    def setUp(self):
+        reset_db()
+        self.session = SnorkelSession()
+        extract_mentions(build_corpus(self.session, 20))
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache   = os.path.join(self.tmp_dir, 'L_train')
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def load_cached(self):
+        return load_label_matrix(self.session, cache=self.cache).toarray().ravel().tolist()
+
+    def test_cache_invalidation(self):
+        LabelAnnotator(lfs=[lf_even]).apply(progress_bar=False)
+        L = LabelAnnotator(lfs=[lf_even]).load_matrix(self.session)
+        self.assertEqual(self.load_cached(), L.toarray().ravel().tolist())
+        self.assertEqual(self.load_cached(), L.toarray().ravel().tolist())
+
+        # The same number of labels with the same values, on other candidates, is a different matrix
+        LabelAnnotator(lfs=[lf_odd]).apply(progress_bar=False)
+        L = LabelAnnotator(lfs=[lf_odd]).load_matrix(self.session)
+        self.assertEqual(self.session.query(Label).count(), len(L.row_index) // 2)
+        self.assertEqual(self.load_cached(), L.toarray().ravel().tolist())
+
+    def test_cache_writable(self):
+        # A cached matrix can be modified in place, as by GenerativeModel.train, without changing the cache
+        LabelAnnotator(lfs=[lf_even]).apply(progress_bar=False)
+        expected = self.load_cached()
+        L = load_label_matrix(self.session, cache=self.cache)
+        i = expected.index(-1)
+        L[i, 0] = 2
+        L.data *= -1
+        self.assertEqual(L[i, 0], -2)
+        self.assertEqual(self.load_cached(), expected)
+
+
+class TestMarginals(unittest.TestCase):
+
+    def setUp(self):
+        reset_db()
+        self.session = SnorkelSession()
+        extract_mentions(build_corpus(self.session, 20))
+        self.candidates = self.session.query(Mention).order_by(Mention.id).all()
+        self.rng        = np.random.RandomState(0)
+
+    def tearDown(self):
+        self.session.close()
+
+    def binary_marginals(self):
+        # Some marginals are exactly 0 or 1, which are stored as no Marginal or a single one
+        m = self.rng.rand(len(self.candidates))
+        m[::7]  = 0.0
+        m[::11] = 1.0
+        return m
+
+    def categorical_marginals(self, n):
+        m = self.rng.rand(n, 3)
+        m[::5, 1] = 0.0
+        m[::7, 0] = 0.0
+        return m / m.sum(axis=1)[:, np.newaxis]
+
+    def test_binary(self):
+        L = LabelAnnotator(lfs=[lf_even]).apply(progress_bar=False)
+        for X in [self.candidates, L]:
+            m = self.binary_marginals()
+            save_marginals(self.session, X, m)
+            self.assertTrue(np.allclose(load_marginals(self.session), m))
+            self.assertTrue(np.allclose(load_marginals(self.session, X=L), m))
+            self.assertTrue(np.allclose(load_marginals(self.session, X=self.candidates), m))
+
+            # The marginals are returned in the order of the candidates given
+            permuted = list(reversed(self.candidates))
+            self.assertTrue(np.allclose(load_marginals(self.session, X=permuted), m[::-1]))
+
+    def test_overwrite(self):
+        # Saving marginals replaces all the previous ones, with the same training flag only
+        m_train = self.binary_marginals()
+        m_test  = self.binary_marginals()
+        save_marginals(self.session, self.candidates, m_train)
+        save_marginals(self.session, self.candidates, m_test, training=False)
+        n_test = self.session.query(Marginal).filter(Marginal.training == False).count()
+
+        m_new = self.binary_marginals()
+        save_marginals(self.session, self.candidates, m_new)
+        self.assertTrue(np.allclose(load_marginals(self.session), m_new))
+        self.assertTrue(np.allclose(load_marginals(self.session, training=False), m_test))
+        self.assertEqual(self.session.query(Marginal).filter(Marginal.training == True).count(),
+                         np.count_nonzero(m_new))
+        self.assertEqual(self.session.query(Marginal).filter(Marginal.training == False).count(), n_test)
+
+        # Including with marginals of a subset of the candidates, whose others then have marginals 0
+        save_marginals(self.session, self.candidates[:10], m_new[:10])
+        expected      = np.zeros(len(self.candidates))
+        expected[:10] = m_new[:10]
+        self.assertTrue(np.allclose(load_marginals(self.session), expected))
+
+    def test_categorical(self):
+        for c in self.candidates[:100]:
+            self.session.add(Categorical(mention_id=c.mention_id, split=0))
+        self.session.commit()
+        candidates = self.session.query(Categorical).order_by(Categorical.id).all()
+
+        for _ in range(2):
+            m = self.categorical_marginals(len(candidates))
+            save_marginals(self.session, candidates, m)
+            self.assertEqual(load_marginals(self.session, X=candidates).shape, (100, 3))
+            self.assertTrue(np.allclose(load_marginals(self.session, X=candidates), m))
+            self.assertEqual(self.session.query(Marginal).count(), np.count_nonzero(m[:, 1:]))
+
+
+# The per-LF statistics as they were computed before matrix_lf_stats, column by column
+def loop_coverage(L):
+    return np.ravel(sparse_abs(L).sum(axis=0) / float(L.shape[0]))
+
+
+def loop_overlaps(L):
+    L_abs = sparse_abs(L)
+    return np.ravel(np.where(L_abs.sum(axis=1) > 1, 1, 0).T * L_abs / float(L.shape[0]))
+
+
+def loop_conflicts(L):
+    L_abs = sparse_abs(L)
+    return np.ravel(np.where(L_abs.sum(axis=1) != sparse_abs(L.sum(axis=1)), 1, 0).T * L_abs / float(L.shape[0]))
+
+
+def loop_count(L, labels, value, label):
+    return np.ravel([np.sum(np.ravel((L[:, j] == value).todense()) * (labels == label)) for j in range(L.shape[1])])
+
+
+class TestLFStats(unittest.TestCase):
+
+    def setUp(self):
+        # Abstains (0), agreeing and conflicting labels, a row with no labels, and an LF with none
+        self.L = sparse.csr_matrix(np.array([
+            [ 1,  1,  0,  0],
+            [ 1, -1,  0,  0],
+            [ 0,  0,  0,  0],
+            [-1,  0, -1,  0],
+            [ 0,  1,  0,  0],
+            [ 1, -1,  1,  0],
+            [ 0,  0, -1,  0],
+            [-1, -1, -1,  0],
+        ]))
+        self.labels = np.array([1, -1, 1, -1, 0, 1, 1, -1])
+        rng         = np.random.RandomState(0)
+        self.L_rand = sparse.csr_matrix(rng.choice([-1, 0, 0, 1], size=(200, 6)))
+        self.labels_rand = rng.choice([-1, 0, 1], size=200)
+
+    def assertStatsEqual(self, L, labels):
+        self.assertTrue(np.allclose(matrix_coverage(L), loop_coverage(L)))
+        self.assertTrue(np.allclose(matrix_overlaps(L), loop_overlaps(L)))
+        self.assertTrue(np.allclose(matrix_conflicts(L), loop_conflicts(L)))
+        for f, value, label in [(matrix_tp, 1, 1), (matrix_fp, 1, -1), (matrix_tn, -1, -1), (matrix_fn, -1, 1)]:
+            self.assertEqual(f(L, labels).tolist(), loop_count(L, labels, value, label).tolist())
+
+        # matrix_lf_stats computes the same statistics at once, from a sparse or a dense matrix
+        for X in [L, L.toarray()]:
+            stats = matrix_lf_stats(X, labels)
+            self.assertTrue(np.allclose(stats['Coverage'], loop_coverage(L)))
+            self.assertTrue(np.allclose(stats['Overlaps'], loop_overlaps(L)))
+            self.assertTrue(np.allclose(stats['Conflicts'], loop_conflicts(L)))
+            for name, value, label in [('TP', 1, 1), ('FP', 1, -1), ('TN', -1, -1), ('FN', -1, 1)]:
+                self.assertEqual(stats[name].tolist(), loop_count(L, labels, value, label).tolist())
+            self.assertEqual((stats['Correct'] + stats['Incorrect']).tolist(),
+                             (stats['TP'] + stats['FP'] + stats['TN'] + stats['FN']).tolist())
+        self.assertEqual(sorted(matrix_lf_stats(L)), ['Conflicts', 'Coverage', 'Overlaps'])
+
+    def test_binary(self):
+        self.assertStatsEqual(self.L, self.labels)
+        self.assertEqual(matrix_coverage(self.L).tolist(), [5 / 8.0, 5 / 8.0, 4 / 8.0, 0.0])
+        self.assertEqual(matrix_overlaps(self.L).tolist(), [5 / 8.0, 4 / 8.0, 3 / 8.0, 0.0])
+        self.assertEqual(matrix_conflicts(self.L).tolist(), [2 / 8.0, 2 / 8.0, 1 / 8.0, 0.0])
+        self.assertStatsEqual(self.L_rand, self.labels_rand)
+
+    def test_explicit_zeros(self):
+        # Explicitly stored abstains are not counted as labels
+        L = self.L.copy()
+        L.data[L.data == -1] = 0
+        self.assertStatsEqual(L, self.labels)
+
+    def test_categorical(self):
+        # A row is conflicted if its LFs give different (non-zero) labels
+        L      = np.array([[1, 2, 0], [3, 3, 0], [0, 2, 2], [1, 0, 3], [0, 0, 1]])
+        labels = np.array([1, 3, 0, 3, 2])
+        stats  = matrix_lf_stats(sparse.csr_matrix(L), labels)
+        self.assertEqual(stats['Conflicts'].tolist(), [2 / 5.0, 1 / 5.0, 1 / 5.0])
+        self.assertEqual(stats['Overlaps'].tolist(), [3 / 5.0, 3 / 5.0, 2 / 5.0])
+        self.assertEqual(stats['Correct'].tolist(), [2, 1, 1])
+        self.assertEqual(stats['Incorrect'].tolist(), [1, 1, 1])
+        self.assertTrue(np.allclose(stats['Empirical Acc.'], [2 / 3.0, 0.5, 0.5]))
+        self.assertNotIn('TP', stats)
+
+
+class TestAnnotationMatrixIndexing(unittest.TestCase):
+
+    def setUp(self):
+        reset_db()
+        self.session = SnorkelSession()
+        extract_mentions(build_corpus(self.session, 20))
+        for lf in LFS:
+            lf.calls = 0
+        self.tmp_dir = tempfile.mkdtemp()
+        self.L       = LabelAnnotator(lfs=[lf_a, lf_b_v2, lf_c, lf_even]).apply(progress_bar=False)
+        store        = CSRAnnotationStore(os.path.join(self.tmp_dir, 'store'))
+        self.F       = FeatureAnnotator(f=feats, store=store).apply(progress_bar=False)
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def keys(self, n, m):
+        """Returns indexing keys of an n x m matrix, each with the rows and columns it selects"""
+        rng       = np.random.RandomState(0)
+        row_mask  = rng.rand(n) < 0.3
+        col_mask  = np.arange(m) % 2 == 1
+        row_array = rng.randint(0, n, size=20)
+        return [
+            (slice(10, 50),                          np.arange(10, 50),         np.arange(m)),
+            (slice(None, None, -3),                  np.arange(n)[::-3],        np.arange(m)),
+            ((slice(5, -5, 2), slice(1, None)),      np.arange(n)[5:-5:2],      np.arange(1, m)),
+            (row_mask,                               np.nonzero(row_mask)[0],   np.arange(m)),
+            (row_array,                              row_array,                 np.arange(m)),
+            (row_array.tolist(),                     row_array,                 np.arange(m)),
+            ((slice(None), [m - 1, 0, 0]),           np.arange(n),              np.array([m - 1, 0, 0])),
+            ((slice(None), col_mask),                np.arange(n),              np.nonzero(col_mask)[0]),
+            ((row_mask, slice(1, None)),             np.nonzero(row_mask)[0],   np.arange(1, m)),
+            (7,                                      np.array([7]),             np.arange(m)),
+            (-1,                                     np.array([n - 1]),         np.arange(m)),
+        ]
+
+    def assertIndexed(self, X, X_sub, rows, cols):
+        """Checks the values, row / column indexes and the Candidates and keys of an indexed matrix"""
+        names = X.get_key_names(self.session)
+        self.assertEqual(X_sub.shape, (len(rows), len(cols)))
+        self.assertTrue(np.array_equal(X_sub.toarray(), X.toarray()[rows][:, cols]))
+        self.assertEqual(X_sub.row_index.tolist(), X.row_index[rows].tolist())
+        self.assertEqual(X_sub.col_index.tolist(), X.col_index[cols].tolist())
+        self.assertEqual(X_sub.get_key_names(self.session), [names[j] for j in cols])
+        for i in [0, len(rows) // 2, len(rows) - 1]:
+            candidate = X_sub.get_candidate(self.session, i)
+            self.assertEqual(candidate.id, X.row_index[rows[i]])
+            self.assertEqual(X_sub.get_row_index(candidate), list(rows).index(rows[i]))
+        for j in [0, len(cols) - 1]:
+            key = X_sub.get_key(self.session, j)
+            self.assertEqual(key.name, names[cols[j]])
+            self.assertEqual(X_sub.get_col_index(key), list(cols).index(cols[j]))
+
+    def test_indexing(self):
+        # Matrices loaded from the DB (whose columns are key ids) and from a store (key names)
+        for X in [self.L, self.F]:
+            for key, rows, cols in self.keys(*X.shape):
+                self.assertIndexed(X, X[key], rows, cols)
+
+    def test_indexing_nested(self):
+        for X in [self.L, self.F]:
+            X_sub = X[10:200][::-1]
+            self.assertIndexed(X, X_sub[[0, 5, 5]], np.arange(10, 200)[::-1][[0, 5, 5]], np.arange(X.shape[1]))
+
+    def test_indexing_values(self):
+        # Keys which select entries, not rows and columns, return their values
+        L    = self.L.toarray()
+        i, j = np.nonzero(L)
+        self.assertEqual(self.L[i[0], j[0]], L[i[0], j[0]])
+        self.assertEqual(np.ravel(self.L[self.L > 0]).tolist(), L[L > 0].tolist())
+
+
+class TestCSRAnnotationStore(unittest.TestCase):
+
+    def setUp(self):
+        reset_db()
+        self.session = SnorkelSession()
+        extract_mentions(build_corpus(self.session, 20))
+        self.n       = self.session.query(Mention).count()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store   = CSRAnnotationStore(os.path.join(self.tmp_dir, 'store'))
+        self.X_db    = FeatureAnnotator(f=feats).apply(progress_bar=False)
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.tmp_dir)
+        annotation_store.PART_SIZE    = 2**20
+        annotations.REDUCE_FLUSH_SIZE = 50000
+
+    def entries(self, X):
+        """Returns the entries of a matrix as a dict from (candidate id, key name) to value"""
+        names = X.get_key_names(self.session)
+        X_coo = X.tocoo()
+        return dict(((int(X.row_index[i]), names[j]), v) for i, j, v in zip(X_coo.row, X_coo.col, X_coo.data))
+
+    def assertEntriesEqual(self, entries, expected):
+        """Checks that two dicts of entries are equal, reporting the first keys where they differ"""
+        keys = sorted(key for key in set(entries) | set(expected) if entries.get(key) != expected.get(key))
+        self.assertEqual([(key, entries.get(key), expected.get(key)) for key in keys[:10]], [])
+
+    def assertStoreEqual(self, X):
+        """Checks that a matrix loaded from the store has the same features as the one from the DB"""
+        self.assertEqual(X.shape[0], self.n)
+        self.assertEqual(X.row_index.tolist(), self.X_db.row_index.tolist())
+        self.assertEntriesEqual(self.entries(X), self.entries(self.X_db))
+
+    def test_store(self):
+        annotator = FeatureAnnotator(f=feats, store=self.store)
+        X         = annotator.apply(progress_bar=False)
+        self.assertStoreEqual(X)
+
+        # The matrix can be modified in place without changing the shard
+        X.data *= 2
+        self.assertStoreEqual(annotator.load_matrix(self.session))
+
+        # Writing the shard in many parts gives the same matrix, and leaves no temporary files behind
+        annotation_store.PART_SIZE = 7
+        self.assertStoreEqual(FeatureAnnotator(f=feats, store=self.store).apply(progress_bar=False))
+        self.assertEqual(sorted(os.listdir(self.store.group_path())), ['keys.json', 'split_0'])
+
+    def test_store_parallel(self):
+        for backend in ['process', 'thread']:
+            X = FeatureAnnotator(f=feats, store=self.store).apply(parallelism=2, backend=backend,
+                                                                  progress_bar=False)
+            self.assertStoreEqual(X)
+
+    def test_store_rerun(self):
+        # The features appended to the shard by a run which raises are not written by the next one
+        annotations.REDUCE_FLUSH_SIZE = 10
+        last_cid = max(cid for cid, in self.session.query(Mention.id))
+        def failing_feats(c):
+            if c.id == last_cid:
+                raise ValueError("Failing on candidate %s" % c.id)
+            yield 'stale', 1
+        with self.assertRaises(ValueError):
+            FeatureAnnotator(f=failing_feats, store=self.store).apply(progress_bar=False)
+        self.assertEqual(self.store.writers, {})
+        for clear in [True, False]:
+            X = FeatureAnnotator(f=feats, store=self.store).apply(clear=clear, progress_bar=False)
+            self.assertStoreEqual(X)
+
+    def test_store_unicode_keys(self):
+        X     = FeatureAnnotator(f=feats, store=self.store).apply(progress_bar=False)
+        names = X.get_key_names(self.session)
+        self.assertIn(u'parité', names)
+        self.assertEqual(X.get_key(self.session, names.index(u'parité')).name, u'parité')
+        self.assertEqual(sorted(names), sorted(self.X_db.get_key_names(self.session)))
+
+    def hashed_entries(self, hash_bits, signed):
+        """Returns the entries of the DB matrix with the features hashed, as a dict like entries"""
+        keys    = HashedKeys(hash_bits, signed)
+        entries = {}
+        for (cid, name), value in self.entries(self.X_db).items():
+            cols, signs = keys.columns([name])
+            key = (cid, keys[int(cols[0])])
+            entries[key] = entries.get(key, 0) + value * int(signs[0])
+        return dict((key, value) for key, value in entries.items() if value != 0)
+
+    def test_hashed(self):
+        # With enough bits for the features not to collide, the columns are those of the unhashed matrix
+        names = self.X_db.get_key_names(self.session)
+        cols  = HashedKeys(16).columns(names)[0]
+        self.assertEqual(len(set(cols.tolist())), len(names))
+        for signed in [False, True]:
+            X = FeatureAnnotator(f=feats, store=self.store, hash_bits=16, signed_hash=signed)\
+                .apply(progress_bar=False)
+            self.assertEqual(X.shape, (self.n, 2**16))
+            self.assertEqual(X.get_key_names(self.session), ['hash_%s' % j for j in range(2**16)])
+            self.assertEntriesEqual(self.entries(X), self.hashed_entries(16, signed))
+            if not signed:
+                # Then the hashed matrix is the unhashed one, with its columns moved
+                self.assertTrue(np.array_equal(X.tocsc()[:, cols].toarray(), self.X_db.toarray()))
+
+    def test_hashed_collisions(self):
+        # The features hashed to the same column are summed, with their signs if signed_hash is True
+        for signed in [False, True]:
+            annotator = FeatureAnnotator(f=feats, store=self.store, hash_bits=2, signed_hash=signed,
+                                         sample_names=3)
+            X = annotator.apply(progress_bar=False)
+            self.assertEqual(X.shape, (self.n, 4))
+            self.assertEqual(X.get_key_names(self.session), ['hash_0', 'hash_1', 'hash_2', 'hash_3'])
+            self.assertEntriesEqual(self.entries(X), self.hashed_entries(2, signed))
+
+            # Up to sample_names of the names hashed to each column are kept
+            keys = self.store.keys()
+            self.assertEqual(sorted(keys.names), [0, 1, 2, 3])
+            for j, sampled in keys.names.items():
+                self.assertEqual(len(sampled), 3)
+                self.assertEqual(keys.columns(sampled)[0].tolist(), [j] * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
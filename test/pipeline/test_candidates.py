@@ -0,0 +1,91 @@
+from fixtures import WORDS, Mention, SnorkelSession, build_corpus, extract_mentions, reset_db
+from snorkel.candidates import CandidateExtractorUDF, Ngrams, PretaggedCandidateExtractor
+from snorkel.matchers import DictionaryMatch
+from snorkel.models import Sentence, Span, candidate_subclass
+import pickle
+import unittest
+
+
+Relation = candidate_subclass('TestRelation', ['chemical', 'disease'])
+
+ENTITY_TYPES = {'aspirin': 'Chemical', 'ibuprofen': 'Chemical', 'headache': 'Disease', 'fever': 'Disease'}
+
+
+class TestCandidateExtractor(unittest.TestCase):
+
+    def setUp(self):
+        reset_db()
+        self.session   = SnorkelSession()
+        self.sentences = build_corpus(self.session, 20)
+
+    def tearDown(self):
+        self.session.close()
+
+    def assertNoDuplicates(self, candidate_class):
+        """Checks that no two Candidates have the same arguments, and returns their number"""
+        arg_columns = [getattr(candidate_class, arg_name + '_id') for arg_name in candidate_class.__argnames__]
+        arg_ids     = self.session.query(*arg_columns).all()
+        self.assertEqual(len(set(arg_ids)), len(arg_ids))
+        return len(arg_ids)
+
+    def test_reextract(self):
+        extract_mentions(self.sentences)
+        n = self.assertNoDuplicates(Mention)
+        self.assertEqual(n, 20 * 25)
+
+        # Re-extracting the same Candidates, in the same or another split, adds none
+        extract_mentions(self.sentences, clear=False)
+        self.assertEqual(self.assertNoDuplicates(Mention), n)
+        extract_mentions(self.sentences, split=1, clear=False)
+        self.assertEqual(self.assertNoDuplicates(Mention), n)
+        self.assertEqual(self.session.query(Mention).filter(Mention.split == 1).count(), 0)
+
+    def test_reextract_new(self):
+        # Re-extracting with a larger dictionary only adds the Candidates of its new words
+        extract_mentions(self.sentences, d=WORDS[:9])
+        n_old = self.assertNoDuplicates(Mention)
+        extract_mentions(self.sentences, clear=False)
+        self.assertEqual(self.assertNoDuplicates(Mention), 20 * 25)
+        self.assertEqual(self.session.query(Mention).filter(Mention.split == 0).count(), 20 * 25)
+        self.assertLess(n_old, 20 * 25)
+
+    def mention_spans(self):
+        return sorted(self.session.query(Span.sentence_id, Span.char_start, Span.char_end).join(
+            Mention, Mention.mention_id == Span.id))
+
+    def test_single_writer(self):
+        # The UDF processes send the spans to the single writer as ids and offsets, not with their Sentences
+        udf = CandidateExtractorUDF(Mention, [Ngrams(n_max=1)], [DictionaryMatch(d=WORDS)], False, False, False)
+        udf.send_outputs = True
+        outputs = udf.apply_batch(self.sentences[:2])
+        self.assertEqual(len(outputs), 2 * 25)
+        self.assertTrue(all(isinstance(arg, tuple) and len(arg) == 3 for args in outputs for arg in args))
+        self.assertNotIn(b'Sentence', pickle.dumps(outputs))
+        udf.session.close()
+
+        # The same Candidates are extracted as serially
+        extract_mentions(self.sentences)
+        expected = self.mention_spans()
+        extract_mentions(self.sentences, parallelism=2, single_writer=True)
+        self.assertEqual(self.mention_spans(), expected)
+        self.assertEqual(self.assertNoDuplicates(Mention), 20 * 25)
+        extract_mentions(self.sentences, parallelism=2, single_writer=True, clear=False)
+        self.assertEqual(self.assertNoDuplicates(Mention), 20 * 25)
+
+    def test_reextract_pretagged(self):
+        for sentence in self.sentences:
+            sentence.entity_types = [ENTITY_TYPES.get(word) for word in sentence.words]
+            sentence.entity_cids  = [word if word in ENTITY_TYPES else None for word in sentence.words]
+        self.session.commit()
+        sentences = self.session.query(Sentence).all()
+
+        extractor = PretaggedCandidateExtractor(Relation, ['Chemical', 'Disease'])
+        extractor.apply(sentences, progress_bar=False)
+        n = self.assertNoDuplicates(Relation)
+        self.assertGreater(n, 0)
+        extractor.apply(sentences, clear=False, progress_bar=False)
+        self.assertEqual(self.assertNoDuplicates(Relation), n)
+
+
+if __name__ == '__main__':
+    unittest.main()
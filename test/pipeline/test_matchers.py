@@ -0,0 +1,138 @@
+from fixtures import Sentence
+from collections import namedtuple
+from snorkel.candidates import Ngrams
+from snorkel.matchers import DictionaryMatch, IntervalIndex, NgramMatcher, SeenSpans
+import numpy as np
+import unittest
+
+
+TEXTS = [
+    'The patient was given aspirin and developed acute renal failure with severe liver damage .',
+    'Acute Renal Failure , acute renal failure and renal failure ; aspirin/ibuprofen and pre-renal failure .',
+    'Severe headache and fever , Fever/headache and liver damage after ibuprofen-induced acute liver failure .',
+]
+
+DICTIONARY = ['aspirin', 'ibuprofen', 'acute renal failure', 'renal failure', 'renal', 'Renal Failure',
+              'severe liver damage', 'liver damage', 'liver', 'headache', 'fever', 'acute liver failure',
+              'acute', 'pre', 'renal failure with severe liver']
+
+
+class SuffixStemmer(object):
+    """Strips a trailing 's' or 'e', so that stemmed phrases are not prefixes of stemmed n-grams"""
+    def stem(self, w):
+        return w[:-1] if w[-1:] in ('s', 'e') else w
+
+
+def sentence(text):
+    """Returns an (unsaved) Sentence of the space-separated words of text, lemmatized as lower-case"""
+    words   = text.split(' ')
+    offsets = [sum(len(w) + 1 for w in words[:k]) for k in range(len(words))]
+    return Sentence(text=text, words=words, lemmas=[w.lower() for w in words], char_offsets=offsets,
+                    abs_char_offsets=offsets, position=0, stable_id='doc::sentence:0:%s' % len(text))
+
+
+Span = namedtuple('Span', ['char_start', 'char_end'])
+
+
+class LinearMatcher(NgramMatcher):
+    """Matches any n-gram, testing longest_match_only against each of the spans seen, in turn"""
+    def _seen_spans(self):
+        return SeenSpans(self)
+
+
+def spans(tcs):
+    return [(tc.char_start, tc.char_end) for tc in tcs]
+
+
+def random_spans(rng, n, length=60):
+    """Returns n random Spans, of which some are within, overlapping or adjacent to earlier ones"""
+    result = []
+    for k in range(n):
+        kind = rng.randint(4) if result else 0
+        if kind == 0:
+            start = rng.randint(length)
+            end   = min(start + rng.randint(15), length - 1)
+        else:
+            prev = result[rng.randint(len(result))]
+            if kind == 1:
+                start = rng.randint(prev.char_start, prev.char_end + 1)
+                end   = rng.randint(start, prev.char_end + 1)
+            elif kind == 2:
+                start = prev.char_end + rng.randint(2)
+                end   = start + rng.randint(10)
+            else:
+                end   = prev.char_start - rng.randint(2)
+                start = end - rng.randint(10)
+        result.append(Span(max(start, 0), max(end, 0)))
+    return result
+
+
+class TestDictionaryMatch(unittest.TestCase):
+
+    def setUp(self):
+        self.sentences = [sentence(text) for text in TEXTS]
+
+    def assertScanEquivalent(self, **kwargs):
+        """Checks that scan_ngrams yields the same spans, in the same order, as apply over all n-grams"""
+        for n_max in [1, 2, 3, 5, 10]:
+            for split_tokens in [('-', '/'), None]:
+                ngrams = Ngrams(n_max=n_max, split_tokens=split_tokens)
+                for longest_match_only in [True, False]:
+                    for context in self.sentences:
+                        matcher  = DictionaryMatch(d=DICTIONARY, longest_match_only=longest_match_only, **kwargs)
+                        expected = spans(matcher.apply(ngrams.apply(context)))
+                        matcher  = DictionaryMatch(d=DICTIONARY, longest_match_only=longest_match_only, **kwargs)
+                        self.assertEqual(spans(matcher.scan_ngrams(ngrams, context)), expected,
+                                         (n_max, split_tokens, longest_match_only, context.text))
+
+    def test_scan(self):
+        self.assertScanEquivalent()
+
+    def test_scan_case_sensitive(self):
+        self.assertScanEquivalent(ignore_case=False)
+
+    def test_scan_attrib(self):
+        self.assertScanEquivalent(attrib='lemmas', ignore_case=False)
+
+    def test_scan_fallback(self):
+        self.assertScanEquivalent(stemmer=SuffixStemmer())
+        self.assertScanEquivalent(reverse=True)
+
+    def test_scan_matches(self):
+        # Phrases of more than one word are found, and with longest_match_only, not their subspans
+        matcher = DictionaryMatch(d=DICTIONARY)
+        matches = [tc.get_span() for tc in matcher.scan_ngrams(Ngrams(n_max=5), self.sentences[0])]
+        self.assertEqual(matches, ['renal failure with severe liver', 'acute renal failure',
+                                   'severe liver damage', 'aspirin'])
+
+
+class TestIntervalIndex(unittest.TestCase):
+
+    def test_covers(self):
+        # An IntervalIndex covers the same spans as the set of spans added to it, tested one by one
+        rng = np.random.RandomState(0)
+        for trial in range(200):
+            index    = IntervalIndex()
+            expected = SeenSpans(NgramMatcher())
+            for c in random_spans(rng, rng.randint(1, 40)):
+                self.assertEqual(index.covers(c), expected.covers(c), (trial, c, sorted(expected.spans)))
+                index.add(c)
+                expected.add(c)
+                self.assertTrue(index.covers(c))
+
+                # Only the maximal intervals are kept, so both their starts and ends are increasing
+                self.assertTrue(all(np.diff(index.starts) > 0) and all(np.diff(index.ends) > 0))
+
+    def test_select(self):
+        # longest_match_only selects the same matches, in the same order, as with the linear filter
+        rng = np.random.RandomState(1)
+        for trial in range(200):
+            candidates = random_spans(rng, rng.randint(1, 40))
+            if trial % 2 == 0:
+                candidates.sort(key=lambda c: (c.char_start - c.char_end, c.char_start))
+            self.assertEqual(list(NgramMatcher().apply(candidates)), list(LinearMatcher().apply(candidates)))
+            self.assertEqual(list(NgramMatcher(longest_match_only=False).apply(candidates)), candidates)
+
+
+if __name__ == '__main__':
+    unittest.main()
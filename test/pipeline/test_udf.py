@@ -0,0 +1,216 @@
+from fixtures import Mention, SnorkelSession, build_corpus, extract_mentions, reset_db
+from snorkel.annotations import AnnotatorUDF, LabelAnnotator
+from snorkel.metrics import MemorySink
+from snorkel.models import Document, Sentence, UDFProgress, UDFQuarantine
+from snorkel.parser import CorpusParser
+from snorkel.udf import CHECKPOINT_SIZE, QUEUE_TIMEOUT
+from time import time
+import unittest
+
+
+def parity(cid):
+    return 1 if cid % 2 == 0 else -1
+
+
+def lf_parity(c):
+    return parity(c.id)
+
+
+class TestUDFRunner(unittest.TestCase):
+
+    def setUp(self):
+        reset_db()
+        self.session = SnorkelSession()
+        # More candidates than CHECKPOINT_SIZE, so that checkpointed runs commit along the way
+        extract_mentions(build_corpus(self.session, 60))
+        self.n = self.session.query(Mention).count()
+
+    def tearDown(self):
+        self.session.close()
+
+    def assertLabels(self, L):
+        """Checks that L has the labels of lf_parity for all the candidates"""
+        self.assertEqual(L.shape, (self.n, 1))
+        self.assertEqual(L.nnz, self.n)
+        self.assertEqual(L.toarray().ravel().tolist(), [parity(cid) for cid in L.row_index])
+
+    def test_checkpoint(self):
+        # A single-threaded checkpointed run commits while the candidate ids are being streamed, which
+        # an open cursor would block on SQLite
+        self.assertGreater(self.n, CHECKPOINT_SIZE)
+        L = LabelAnnotator(lfs=[lf_parity]).apply(checkpoint=True, progress_bar=False)
+        self.assertLabels(L)
+        self.assertEqual(self.session.query(UDFProgress).count(), self.n)
+
+    def test_resume(self):
+        # The first run fails after its first checkpoint
+        cids   = sorted(cid for cid, in self.session.query(Mention.id))
+        failed = cids[CHECKPOINT_SIZE + 100]
+        fail   = [True]
+        calls  = []
+        def lf(c):
+            calls.append(c.id)
+            if fail[0] and c.id == failed:
+                raise ValueError("Failing on candidate %s" % c.id)
+            return parity(c.id)
+        with self.assertRaises(ValueError):
+            LabelAnnotator(lfs=[lf]).apply(checkpoint=True, progress_bar=False)
+        self.assertEqual(self.session.query(UDFProgress).count(), CHECKPOINT_SIZE)
+
+        # Resuming only applies the LFs to the candidates which were not checkpointed
+        fail[0] = False
+        del calls[:]
+        L = LabelAnnotator(lfs=[lf]).apply(resume=True, progress_bar=False)
+        self.assertEqual(sorted(calls), cids[CHECKPOINT_SIZE:])
+        self.assertLabels(L)
+        self.assertEqual(self.session.query(UDFProgress).count(), self.n)
+
+    def test_worker_error(self):
+        # An exception in a UDF process aborts the run as soon as it is reported, with its traceback,
+        # rather than after the queue timeout
+        def lf(c):
+            raise ValueError("Failing on candidate %s" % c.id)
+        for backend in ['process', 'thread']:
+            t = time()
+            with self.assertRaises(RuntimeError) as e:
+                LabelAnnotator(lfs=[lf]).apply(parallelism=2, backend=backend, progress_bar=False)
+            self.assertLess(time() - t, QUEUE_TIMEOUT)
+            self.assertIn("ValueError: Failing on candidate", str(e.exception))
+
+    def test_quarantine(self):
+        # The inputs on which the LF fails are quarantined, and the others labeled
+        cids  = sorted(cid for cid, in self.session.query(Mention.id))
+        bad   = set([cids[10], cids[500]])
+        fail  = [True]
+        calls = []
+        def lf(c):
+            calls.append(c.id)
+            if fail[0] and c.id in bad:
+                raise ValueError("Failing on candidate %s" % c.id)
+            return parity(c.id)
+
+        # Only the batches which raise are re-applied one candidate at a time
+        sizes       = []
+        apply_batch = AnnotatorUDF.apply_batch
+        def counted_apply_batch(udf, cids, **kwargs):
+            sizes.append(len(cids))
+            return apply_batch(udf, cids, **kwargs)
+        AnnotatorUDF.apply_batch = counted_apply_batch
+        try:
+            L = LabelAnnotator(lfs=[lf]).apply(quarantine=True, batch_size=100, progress_bar=False)
+        finally:
+            AnnotatorUDF.apply_batch = apply_batch
+        self.assertEqual(L.nnz, self.n - len(bad))
+        quarantined = [key for key, in self.session.query(UDFQuarantine.key)]
+        self.assertEqual(sorted(quarantined), sorted(str(cid) for cid in bad))
+        self.assertEqual(sizes.count(1), 2 * 100)
+        self.assertEqual(len(sizes), self.n // 100 + 2 * 100)
+
+        # Retrying only applies the LF to the quarantined candidates
+        fail[0] = False
+        del calls[:]
+        L = LabelAnnotator(lfs=[lf]).apply(retry_quarantined=True, progress_bar=False)
+        self.assertEqual(sorted(calls), sorted(bad))
+        self.assertLabels(L)
+        self.assertEqual(self.session.query(UDFQuarantine).count(), 0)
+
+    def test_metrics(self):
+        # The reducer is reused by each run of an Annotator, but its metrics must not carry over
+        annotator = LabelAnnotator(lfs=[lf_parity])
+        records   = []
+        for i in range(2):
+            sink = MemorySink()
+            annotator.apply(parallelism=2, metrics=sink, progress_bar=False)
+            records.append(sink.last)
+        for record in records:
+            self.assertTrue(record['final'])
+            self.assertEqual(record['inputs'], self.n)
+            # The writer commits after each CHECKPOINT_SIZE inputs, and at the end
+            self.assertEqual(record['commits'], self.n // CHECKPOINT_SIZE + 1)
+        self.assertEqual(records[0]['statements'], records[1]['statements'])
+
+    def test_single_writer_parallel(self):
+        # On SQLite, parallel runs default to a single writer, with processes or threads
+        for backend in ['process', 'thread']:
+            L = LabelAnnotator(lfs=[lf_parity]).apply(parallelism=2, backend=backend, batch_size=10,
+                progress_bar=False)
+            self.assertLabels(L)
+
+        # Concurrent writers are not supported by SQLite
+        with self.assertRaises(ValueError):
+            LabelAnnotator(lfs=[lf_parity]).apply(parallelism=2, single_writer=False, progress_bar=False)
+
+
+class WordParser(object):
+    """
+    Parses each '.'-separated sentence of a text into its space-separated words, in place of a
+    CoreNLP server; raises on the sentences containing FAIL, after yielding the previous ones
+    """
+    def __init__(self):
+        self.calls = []
+
+    def connect(self):
+        return self
+
+    def parse(self, doc, text):
+        self.calls.append(doc.name)
+        offset = 0
+        for position, sentence_text in enumerate(text.split('.')):
+            if 'FAIL' in sentence_text:
+                raise ValueError("Failing on document %s" % doc.name)
+            words   = sentence_text.split()
+            offsets = [offset + sentence_text.index(w) for w in words]
+            yield {
+                'document'         : doc,
+                'position'         : position,
+                'text'             : sentence_text,
+                'words'            : words,
+                'char_offsets'     : offsets,
+                'abs_char_offsets' : offsets,
+                'stable_id'        : '%s::sentence:%s:%s' % (doc.name, offset, offset + len(sentence_text)),
+            }
+            offset += len(sentence_text) + 1
+
+
+class TestCorpusParser(unittest.TestCase):
+
+    def setUp(self):
+        reset_db()
+        self.session = SnorkelSession()
+
+    def tearDown(self):
+        self.session.close()
+
+    def docs(self, bad):
+        for i in range(10):
+            doc  = Document(name='doc-%s' % i, stable_id='doc-%s::document:0:0' % i, meta={})
+            text = 'aspirin treats headache . the patient was given %s' % ('FAIL' if i in bad else 'ibuprofen')
+            yield doc, text
+
+    def test_quarantine(self):
+        # The Sentences parsed from the documents of a batch before another one fails are not persisted
+        # along with those parsed when re-applying the documents one at a time
+        parser = CorpusParser(parser=WordParser())
+        parser.apply(list(self.docs(bad=[2, 9])), quarantine=True, batch_size=4, progress_bar=False)
+        quarantined = sorted(key for key, in self.session.query(UDFQuarantine.key))
+        self.assertEqual(quarantined, ['doc-2::document:0:0', 'doc-9::document:0:0'])
+        self.assertEqual(self.session.query(Document).count(), 8)
+        self.assertEqual(self.session.query(Sentence).count(), 16)
+
+        # Retrying parses the quarantined documents
+        parser.apply(list(self.docs(bad=[])), retry_quarantined=True, progress_bar=False)
+        self.assertEqual(self.session.query(UDFQuarantine).count(), 0)
+        self.assertEqual(self.session.query(Document).count(), 10)
+        self.assertEqual(self.session.query(Sentence).count(), 20)
+
+    def test_quarantine_single(self):
+        # A batch of a single input which fails is quarantined without being re-applied
+        word_parser = WordParser()
+        CorpusParser(parser=word_parser).apply(list(self.docs(bad=[2])), quarantine=True, progress_bar=False)
+        self.assertEqual(word_parser.calls, ['doc-%s' % i for i in range(10)])
+        self.assertEqual(self.session.query(UDFQuarantine).count(), 1)
+        self.assertEqual(self.session.query(Sentence).count(), 18)
+
+
+if __name__ == '__main__':
+    unittest.main()